@@ -0,0 +1,78 @@
+import random
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+from typing import Callable, Iterator
+
+from config import DBConfig, DBEngineType
+from src.core.category import ProductCategory
+from src.core.product import Product
+from src.db.connection import Database
+from src.utils.logging import level
+from src.utils.logging.handler import ConsoleHandler
+from src.utils.logging.logger import Logger
+
+PRODUCERS: int = 200
+_WORDS: tuple[str, ...] = ("notebook", "pen", "pencil", "marker", "folder", "binder", "stapler", "eraser", "ruler",
+                           "backpack", "case", "crayon", "paint", "brush", "puzzle", "card", "paper", "glue")
+_CATEGORIES: tuple[int, ...] = tuple(ProductCategory.members().values())
+
+
+def quiet_logger(name: str = "BENCH") -> Logger:
+    """
+    Console only logger which drops everything below ERROR, so logging doesn't skew the numbers
+    """
+    return Logger(name, level.ERROR, [ConsoleHandler(name, level.ERROR)])
+
+
+def fresh_database(name: str, directory: Path = None, **options) -> Database:
+    """
+    Create an empty SQLite database. Any previous file with the same name is removed.
+    """
+    directory = directory or Path(tempfile.gettempdir())
+    db_name = str(directory / name)
+    Path(f"{db_name}.db").unlink(missing_ok=True)
+    return Database(DBConfig(db_name=db_name, engine=DBEngineType.SQLITE, **options), quiet_logger())
+
+
+def synthetic_products(count: int, seed: int = 0) -> Iterator[Product]:
+    rng = random.Random(seed)
+    for i in range(count):
+        words = rng.sample(_WORDS, 3)
+        category = 0
+        for _ in range(rng.randint(1, 3)):
+            category |= rng.choice(_CATEGORIES)
+        yield Product(
+            name=f"{' '.join(words)} {i}",
+            category=category,
+            price=Decimal(rng.randint(50, 50_000)) / 100,
+            description=" ".join(rng.choice(_WORDS) for _ in range(80)),
+            image_path=f"/images/{i}.png",
+            producer=f"producer {rng.randrange(PRODUCERS)}",
+            characteristics={"color": rng.choice(("red", "green", "blue", "black")), "pages": rng.randint(10, 500),
+                             "sku": f"SKU-{i:08d}"},
+            quantity=rng.randint(0, 100),
+        )
+
+
+def seed_catalog(db: Database, count: int, seed: int = 0, chunk_size: int = 5000) -> list[int]:
+    """
+    :return: The ids of the inserted products
+    """
+    result = db.insert_products(synthetic_products(count, seed), chunk_size=chunk_size)
+    if result.failed:
+        raise RuntimeError(f"Could not seed catalog: {result.failed[0].error}")
+    return [product.id for product in result.inserted]
+
+
+def measure(func: Callable[[], object], repeat: int) -> list[float]:
+    """
+    :return: Wall time of every call in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
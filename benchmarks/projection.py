@@ -0,0 +1,36 @@
+"""
+Listing query cost: full `Product` hydration (search_products) vs. the column projection (search_product_rows).
+
+    python -m benchmarks.projection --size 100000 --repeat 5
+"""
+import argparse
+import statistics
+
+from benchmarks.common import fresh_database, measure, seed_catalog
+from src.core.category import ProductCategory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000, help="number of products in the catalog")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = fresh_database("bench_projection")
+    seed_catalog(db, args.size)
+
+    cases = {
+        "full hydration": lambda: db.search_products(category=ProductCategory.TOYS),
+        "projection": lambda: db.search_product_rows(category=ProductCategory.TOYS),
+    }
+    rows = len(db.search_product_rows(category=ProductCategory.TOYS))
+    print(f"catalog: {args.size} products, {rows} matching rows")
+    results = {}
+    for name, func in cases.items():
+        results[name] = statistics.median(measure(func, args.repeat))
+        print(f"{name:>15}: {results[name] * 1000:9.1f} ms (median of {args.repeat})")
+    print(f"{'speedup':>15}: {results['full hydration'] / results['projection']:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Search cost: SQL (search_products without a snapshot) vs. the in-memory catalog snapshot, for a few filter shapes.
+
+    python -m benchmarks.snapshot --size 100000 --repeat 5
+"""
+import argparse
+import statistics
+
+from benchmarks.common import fresh_database, measure, quiet_logger, seed_catalog
+from config import DBConfig, DBEngineType
+from src.core.category import ProductCategory
+from src.db.connection import Database
+from src.db.filters import ProductFilters
+
+SEARCHES: dict[str, dict] = {
+    "category": {"category": ProductCategory.TOYS | ProductCategory.ARTS},
+    "producer": {"producer": "producer 7"},
+    "price range": {"min_price": 100, "max_price": 110},
+    "combined": {"category": ProductCategory.TOYS, "min_price": 50, "max_price": 250},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000, help="number of products in the catalog")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = fresh_database("bench_snapshot")
+    seed_catalog(db, args.size)
+    snapshot_db = Database(DBConfig(db_name=db.name, engine=DBEngineType.SQLITE, catalog_snapshot=True,
+                                    snapshot_refresh_s=60), quiet_logger())
+    load = measure(lambda: snapshot_db.snapshot.reload(), 1)[0]
+    print(f"catalog: {args.size} products, snapshot loaded in {load * 1000:.0f} ms")
+
+    for name, search in SEARCHES.items():
+        sql = statistics.median(measure(lambda: db.search_products(**search), args.repeat))
+        ids = statistics.median(measure(lambda: snapshot_db.snapshot.search_ids(ProductFilters.build(**search)),
+                                        args.repeat))
+        products = statistics.median(measure(lambda: snapshot_db.search_products(**search), args.repeat))
+        rows = len(snapshot_db.search_products(**search))
+        print(f"{name:>12} ({rows:6} rows): sql {sql * 1000:8.1f} ms, snapshot {products * 1000:8.1f} ms "
+              f"({sql / products:5.1f}x), ids only {ids * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Worker boot cost: time from `Database(...)` to the first query answered, with the schema stamp matching (fast path)
+vs. missing (full setup: create_all, column and index checks, full text index).
+
+    python -m benchmarks.startup --size 10000 --repeat 20
+"""
+import argparse
+import sqlite3
+import statistics
+
+from benchmarks.common import fresh_database, measure, quiet_logger, seed_catalog
+from config import DBConfig, DBEngineType
+from src.db.connection import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=10_000, help="number of products in the catalog")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    db = fresh_database("bench_startup")
+    seed_catalog(db, args.size)
+    cfg = DBConfig(db_name=db.name, engine=DBEngineType.SQLITE)
+
+    def boot():
+        Database(cfg, quiet_logger()).get_product(1)
+
+    def boot_unstamped():
+        with sqlite3.connect(f"{cfg.db_name}.db") as conn:
+            conn.execute("DELETE FROM schema_meta")
+        boot()
+
+    cases = {
+        "construction": lambda: Database(cfg, quiet_logger()),
+        "full setup": boot_unstamped,
+        "stamped": boot,
+    }
+    print(f"catalog: {args.size} products")
+    results = {}
+    for name, func in cases.items():
+        results[name] = statistics.median(measure(func, args.repeat))
+        print(f"{name:>12}: {results[name] * 1000:9.2f} ms (median of {args.repeat})")
+    print(f"{'speedup':>12}: {results['full setup'] / results['stamped']:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
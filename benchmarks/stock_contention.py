@@ -0,0 +1,75 @@
+"""
+Checkout contention on a few hot products: many threads taking one item at a time, with the read-modify-write of
+`update_product` vs. the conditional UPDATE of `reserve_stock`. Reports throughput and whether stock was oversold.
+
+    python -m benchmarks.stock_contention --threads 16 --orders 200 --stock 1000
+"""
+import argparse
+import threading
+import time
+
+from benchmarks.common import fresh_database, synthetic_products
+from src.db.connection import Database
+
+
+def read_modify_write(db: Database, product_id: int) -> bool:
+    product = db.get_product(product_id)
+    if product is None or product.quantity < 1:
+        return False
+    product.quantity -= 1
+    return db.update_product(product)
+
+
+def reserve(db: Database, product_id: int) -> bool:
+    return db.reserve_stock([(product_id, 1)]).ok
+
+
+def run(db: Database, product_ids: list[int], take, threads: int, orders: int) -> tuple[float, int]:
+    """
+    :return: (seconds, number of successful orders)
+    """
+    succeeded = []
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        count = 0
+        for i in range(orders):
+            count += take(db, product_ids[(offset + i) % len(product_ids)])
+        with lock:
+            succeeded.append(count)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, sum(succeeded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--orders", type=int, default=200, help="orders placed by every thread")
+    parser.add_argument("--products", type=int, default=4, help="number of hot products")
+    parser.add_argument("--stock", type=int, default=1000, help="initial quantity of every hot product")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads x {args.orders} orders over {args.products} products "
+          f"with {args.stock} items each")
+    for name, take in (("read-modify-write", read_modify_write), ("reserve_stock", reserve)):
+        db = fresh_database("bench_stock", pool_size=args.threads)
+        products = list(synthetic_products(args.products))
+        for product in products:
+            product.quantity = args.stock
+        db.insert_products(products)
+        product_ids = [product.id for product in products]
+
+        elapsed, succeeded = run(db, product_ids, take, args.threads, args.orders)
+        sold = sum(args.stock - db.get_product(product_id).quantity for product_id in product_ids)
+        print(f"{name:>18}: {succeeded / elapsed:9.0f} orders/s, {succeeded} orders accepted, {sold} items sold, "
+              f"{'consistent' if sold == succeeded else f'{succeeded - sold} lost updates'}")
+
+
+if __name__ == "__main__":
+    main()
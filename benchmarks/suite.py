@@ -0,0 +1,205 @@
+"""
+Database benchmark suite: seeds synthetic SQLite catalogs of the given sizes and runs single-operation and mixed
+workloads against each, reporting throughput and p50/p95/p99 latencies as JSON.
+
+    python -m benchmarks.suite --sizes 10000,100000,1000000 --output results.json
+    python -m benchmarks.suite --sizes 10000 --baseline results.json --threshold 0.2
+
+With --baseline, every workload is compared with the stored run and the exit status is 1 if any of them got slower
+than the threshold allows (lower throughput or higher p95).
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import sqlite3
+import sys
+import time
+from decimal import Decimal
+from typing import Callable
+
+import sqlalchemy
+
+from benchmarks.common import PRODUCERS, fresh_database, seed_catalog, synthetic_products
+from src.core.category import ProductCategory
+from src.db.connection import Database
+
+DEFAULT_SIZES: tuple[int, ...] = (10_000, 100_000)
+# share of every operation in the mixed workload, roughly a storefront: mostly reads, a few writes
+MIXED: dict[str, float] = {"get_product": 0.80, "search_products": 0.15, "update_product": 0.04,
+                           "insert_product": 0.01}
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """
+    Nearest rank percentile of already sorted samples
+    """
+    if not samples:
+        return 0.0
+    return samples[max(0, math.ceil(pct / 100 * len(samples)) - 1)]
+
+
+def summarize(latencies: list[float], elapsed_s: float) -> dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "throughput_ops_s": len(latencies) / elapsed_s if elapsed_s else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+class Workloads:
+    """
+    The operations benchmarked on one seeded catalog. Every random choice comes from one seeded generator, so two runs
+    with the same arguments issue the same operations.
+    """
+
+    def __init__(self, db: Database, product_ids: list[int], seed: int):
+        self._db: Database = db
+        self._ids: list[int] = product_ids
+        self._rng: random.Random = random.Random(seed)
+        self._new = synthetic_products(10 ** 9, seed=seed + 1)
+        self._inserted: list[int] = []
+        # names to search for, looked up once so the search workload doesn't time them
+        sample = self._rng.sample(product_ids, min(256, len(product_ids)))
+        self._names: list[str] = [db.get_product(product_id).name for product_id in sample]
+
+    def insert_product(self):
+        product = next(self._new)
+        if self._db.insert_product(product):
+            self._inserted.append(product.id)
+
+    def get_product(self):
+        self._db.get_product(self._rng.choice(self._ids))
+
+    def search_products(self):
+        # selective shapes, as issued by the storefront, so results stay small at every catalog size
+        shape = self._rng.randrange(4)
+        if shape == 0:
+            self._db.search_products(name=self._rng.choice(self._names))
+        elif shape == 1:
+            low = Decimal(self._rng.randint(50, 49_000)) / 100
+            self._db.search_products(producer=f"producer {self._rng.randrange(PRODUCERS)}", min_price=low,
+                                     max_price=low + 10)
+        elif shape == 2:
+            low = Decimal(self._rng.randint(50, 49_000)) / 100
+            self._db.search_products(min_price=low, max_price=low + Decimal("0.1"))
+        else:
+            self._db.search_products(category=ProductCategory.TOYS | ProductCategory.ARTS,
+                                     producer=f"producer {self._rng.randrange(PRODUCERS)}")
+
+    def update_product(self):
+        product = self._db.get_product(self._rng.choice(self._ids))
+        product.quantity = self._rng.randint(0, 100)
+        self._db.update_product(product)
+
+    def delete_product(self):
+        # only deletes what the insert workload added, so every run sees the same catalog
+        if self._inserted:
+            self._db.delete_product(self._inserted.pop())
+
+    def mixed(self):
+        operation = self._rng.choices(list(MIXED), weights=list(MIXED.values()))[0]
+        getattr(self, operation)()
+
+
+def run_workload(operation: Callable[[], object], ops: int) -> dict[str, float]:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(ops):
+        op_start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - op_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_suite(sizes: list[int], ops: int, seed: int, log: Callable[[str], None] = print) -> dict:
+    results = {}
+    for size in sizes:
+        log(f"seeding {size} products...")
+        db = fresh_database(f"bench_suite_{size}")
+        seed_start = time.perf_counter()
+        product_ids = seed_catalog(db, size, seed=seed)
+        log(f"seeded in {time.perf_counter() - seed_start:.1f} s")
+
+        workloads = Workloads(db, product_ids, seed)
+        size_results = {}
+        # delete after insert: it removes the inserted products
+        for name in ("insert_product", "get_product", "search_products", "update_product", "delete_product", "mixed"):
+            size_results[name] = run_workload(getattr(workloads, name), ops)
+            log(format_row(size, name, size_results[name]))
+        results[str(size)] = size_results
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "ops": ops,
+            "seed": seed,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def format_row(size: int | str, name: str, stats: dict[str, float]) -> str:
+    return (f"{size:>8} {name:>16}: {stats['throughput_ops_s']:9.0f} ops/s  p50 {stats['p50_ms']:8.3f} ms  "
+            f"p95 {stats['p95_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms")
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    :return: One message for every workload which regressed by more than `threshold` (0.2 = 20%) in throughput or p95
+    latency. Workloads missing from either run are ignored.
+    """
+    regressions = []
+    for size, workloads in current["results"].items():
+        for name, stats in workloads.items():
+            if (reference := baseline["results"].get(size, {}).get(name)) is None:
+                continue
+            if stats["throughput_ops_s"] < reference["throughput_ops_s"] * (1 - threshold):
+                regressions.append(f"{size} {name}: throughput {stats['throughput_ops_s']:.0f} ops/s, "
+                                   f"baseline {reference['throughput_ops_s']:.0f} ops/s")
+            if stats["p95_ms"] > reference["p95_ms"] * (1 + threshold):
+                regressions.append(f"{size} {name}: p95 {stats['p95_ms']:.3f} ms, "
+                                   f"baseline {reference['p95_ms']:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated catalog sizes")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    # progress goes to stderr so stdout stays valid JSON
+    results = run_suite([int(size) for size in args.sizes.split(",")], args.ops, args.seed,
+                        log=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions beyond {args.threshold:.0%}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
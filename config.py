@@ -1,6 +1,6 @@
 import json
 from typing import Any
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 import os
 
@@ -9,11 +9,62 @@ from src.utils.logging.level import LogLevelLookup
 from src.utils.types import nullable
 
 
+def _optional(t_: type, value: Any) -> Any:
+    return t_(value) if value is not None else None
+
+
+def _flag(value: Any) -> bool:
+    # env vars are strings
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def _list(value: nullable(str)) -> list[str]:
+    # comma separated env vars
+    return [item.strip() for item in value.split(",") if item.strip()] if value else []
+
+
 class DBEngineType:
     SQLITE: str = "sqlite"
     POSTGRESQL: str = "postgresql"
 
 
+class CategoryStorage:
+    BITMASK: str = "bitmask"
+    BITS: str = "bits"
+
+
+class ReplicaRouting:
+    ROUND_ROBIN: str = "round_robin"
+    LEAST_BUSY: str = "least_busy"
+
+
+@dataclass
+class CacheConfig:
+    product_cache_size: int = 0  # 0 disables the product cache
+    product_ttl_s: float = 60
+    product_negative_ttl_s: float = 5
+    search_cache_items: int = 0  # max number of cached products across all results, 0 disables the search cache
+    search_ttl_s: float = 30
+    search_stale_s: float = 5
+    # encoded JSON of the most read products, 0 disables it; entries live for `product_ttl_s`
+    payload_cache_size: int = 0
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'CacheConfig':
+        return cls(
+            product_cache_size=int(data.get("product_cache_size", os.getenv("DATABASE_PRODUCT_CACHE_SIZE", 0))),
+            product_ttl_s=float(data.get("product_ttl_s", os.getenv("DATABASE_PRODUCT_CACHE_TTL_S", 60))),
+            product_negative_ttl_s=float(data.get("product_negative_ttl_s",
+                                                  os.getenv("DATABASE_PRODUCT_CACHE_NEGATIVE_TTL_S", 5))),
+            search_cache_items=int(data.get("search_cache_items", os.getenv("DATABASE_SEARCH_CACHE_ITEMS", 0))),
+            search_ttl_s=float(data.get("search_ttl_s", os.getenv("DATABASE_SEARCH_CACHE_TTL_S", 30))),
+            search_stale_s=float(data.get("search_stale_s", os.getenv("DATABASE_SEARCH_CACHE_STALE_S", 5))),
+            payload_cache_size=int(data.get("payload_cache_size", os.getenv("DATABASE_PAYLOAD_CACHE_SIZE", 0))),
+        )
+
+
 @dataclass(repr=False)
 class DBConfig:
     db_name: str
@@ -22,6 +73,30 @@ class DBConfig:
     port: int = None
     username: str = None
     password: str = None
+    bulk_chunk_size: int = 1000
+    category_storage: str = CategoryStorage.BITMASK
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    # connection pool, unset values keep SQLAlchemy's defaults
+    pool_size: nullable(int) = None
+    max_overflow: nullable(int) = None
+    pool_timeout_s: nullable(float) = None
+    pool_recycle_s: nullable(int) = None
+    pool_pre_ping: bool = False
+    # characteristic keys which get an expression index on SQLite (Postgres indexes every key with a GIN index)
+    indexed_characteristics: list[str] = field(default_factory=list)
+    # read-only replicas, reads are spread over them unless the caller is pinned to the primary
+    replicas: list['DBConfig'] = field(default_factory=list)
+    replica_routing: str = ReplicaRouting.ROUND_ROBIN
+    # how long reads of a thread stay on the primary after it wrote something
+    read_your_writes_s: float = 5
+    # how long the product change log is kept by `Database.prune_changes`
+    change_retention_s: float = 7 * 24 * 60 * 60
+    # serve searches without characteristic filters from an in-memory copy of the catalog
+    catalog_snapshot: bool = False
+    # how often the snapshot looks for writes made by other processes
+    snapshot_refresh_s: float = 1
+    # statements running longer than this are logged as warnings, None disables the log
+    slow_query_ms: nullable(float) = 200
 
     def __str__(self) -> str:
         match self.engine:
@@ -41,8 +116,40 @@ class DBConfig:
             host=data.get("host", os.getenv("DATABASE_HOST", "localhost")),
             port=data.get("port", os.getenv("DATABASE_PORT", -1)),
             db_name=data.get("db_name", os.getenv("DATABASE_NAME", "bookshop")),
+            bulk_chunk_size=int(data.get("bulk_chunk_size", os.getenv("DATABASE_BULK_CHUNK_SIZE", 1000))),
+            category_storage=data.get("category_storage",
+                                      os.getenv("DATABASE_CATEGORY_STORAGE", CategoryStorage.BITMASK)),
+            cache=CacheConfig.from_dict(data.get("cache", {})),
+            pool_size=_optional(int, data.get("pool_size", os.getenv("DATABASE_POOL_SIZE"))),
+            max_overflow=_optional(int, data.get("max_overflow", os.getenv("DATABASE_POOL_MAX_OVERFLOW"))),
+            pool_timeout_s=_optional(float, data.get("pool_timeout_s", os.getenv("DATABASE_POOL_TIMEOUT_S"))),
+            pool_recycle_s=_optional(int, data.get("pool_recycle_s", os.getenv("DATABASE_POOL_RECYCLE_S"))),
+            pool_pre_ping=_flag(data.get("pool_pre_ping", os.getenv("DATABASE_POOL_PRE_PING", False))),
+            indexed_characteristics=data.get("indexed_characteristics",
+                                             _list(os.getenv("DATABASE_INDEXED_CHARACTERISTICS"))),
+            replicas=cls._replicas_from_dict(data),
+            replica_routing=data.get("replica_routing",
+                                     os.getenv("DATABASE_REPLICA_ROUTING", ReplicaRouting.ROUND_ROBIN)),
+            read_your_writes_s=float(data.get("read_your_writes_s", os.getenv("DATABASE_READ_YOUR_WRITES_S", 5))),
+            change_retention_s=float(data.get("change_retention_s",
+                                              os.getenv("DATABASE_CHANGE_RETENTION_S", 7 * 24 * 60 * 60))),
+            catalog_snapshot=_flag(data.get("catalog_snapshot", os.getenv("DATABASE_CATALOG_SNAPSHOT", False))),
+            snapshot_refresh_s=float(data.get("snapshot_refresh_s", os.getenv("DATABASE_SNAPSHOT_REFRESH_S", 1))),
+            slow_query_ms=_optional(float, data.get("slow_query_ms", os.getenv("DATABASE_SLOW_QUERY_MS", 200))),
         )
 
+    @classmethod
+    def _replicas_from_dict(cls, data: dict[str, Any]) -> list['DBConfig']:
+        """
+        Replicas inherit every setting of the primary they don't override. They're given either as a list of dicts
+        under "replicas" or as comma separated hosts in DATABASE_REPLICA_HOSTS.
+        """
+        primary = {key: value for key, value in data.items() if key != "replicas"}
+        replicas = data.get("replicas")
+        if replicas is None:
+            replicas = [{"host": host} for host in _list(os.getenv("DATABASE_REPLICA_HOSTS"))]
+        return [cls.from_dict({**primary, **replica, "replicas": []}) for replica in replicas]
+
 
 @dataclass
 class LoggingConfig:
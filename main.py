@@ -1,10 +1,7 @@
-from time import sleep
-
 from config import Config
-from src.core.category import ProductCategory
-from src.core.product import Product
 from src.db.connection import Database
 from src.utils.logging.logger import Logger
+from src.web.app import create_app
 
 
 def main():
@@ -12,28 +9,11 @@ def main():
     logger = Logger.from_config("MAIN", cfg.logging)
     logger.info("Initializing database...")
     db = Database(cfg.database, logger.clone("DB"))
-    product = Product(name="proba",
-                      category=ProductCategory.ARTS.value,
-                      price=1,
-                      description="",
-                      image_path="",
-                      producer="",
-                      characteristics={"1": 2},
-                      quantity=1)
-    if not db.insert_product(product):
-        logger.error("Failed to insert product")
-    else:
-        logger.info(f"Product inserted with id: {product.id}")
-
-    # extracted_product = db.get_product(product_id=product.id)
-    # logger.info(f"Product extracted: {extracted_product}")
-    #
-    # extracted_product.name = "proba4"
-    # if not db.update_product(extracted_product):
-    #     logger.error("Could not update product in main")
-    # else:
-    #     logger.info(f"Updated {extracted_product}")
-    db.delete_product(product_id=99)
+    # fail at boot rather than on the first request
+    db.connect()
+    app = create_app(db, logger.clone("HTTP"))
+    logger.info(f"Serving the product API on port {cfg.port}")
+    app.run(host="0.0.0.0", port=cfg.port, debug=cfg.debug_mode)
 
 
 if __name__ == "__main__":
@@ -1 +1,2 @@
 from ._context import ThreadLocalContextTable, GlobalContextTable
+from ._thread import ContextThread
@@ -1,5 +1,7 @@
 from src.utils.types import const
 
+CATEGORY_BITS: const(int) = 64  # categories are stored in a signed 64-bit integer
+
 
 class ProductCategory:
     STATIONERY: const(int) = 1
@@ -10,3 +12,17 @@ class ProductCategory:
     NOTEBOOKS: const(int) = 32
     ARTS: const(int) = 64
     TOYS: const(int) = 128
+
+    @classmethod
+    def members(cls) -> dict[str, int]:
+        """
+        Every named category, e.g. {'STATIONERY': 1, 'DOCUMENTS': 2, ...}
+        """
+        return {name: value for name, value in vars(cls).items() if name.isupper()}
+
+    @staticmethod
+    def set_bits(category: int) -> list[int]:
+        """
+        Positions of the bits set in a category mask, e.g. `STATIONERY | OFFICE` -> [0, 2]
+        """
+        return [bit for bit in range(CATEGORY_BITS) if (category >> bit) & 1]
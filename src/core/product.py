@@ -1,7 +1,11 @@
+import copy
 import dataclasses
+import datetime
+import json
+from decimal import Decimal, InvalidOperation
 from typing import Any
 
-from src.db.models import ProductModel
+from src.db.models import ProductModel, as_utc
 from src.utils.types import nullable
 
 
@@ -16,6 +20,15 @@ class Product:
     characteristics: dict[str, Any]
     quantity: int
     id: nullable(int) = None
+    # maintained by the database on every write, never written from here and not part of equality
+    version: nullable(int) = dataclasses.field(default=None, compare=False)
+    updated_at: nullable(datetime.datetime) = dataclasses.field(default=None, compare=False)
+
+    def copy(self) -> 'Product':
+        """
+        Copy that can be changed without affecting this product, characteristics included
+        """
+        return dataclasses.replace(self, characteristics=copy.deepcopy(self.characteristics))
 
     def to_db_model(self) -> ProductModel:
         return ProductModel(
@@ -30,6 +43,25 @@ class Product:
             quantity=self.quantity
         )
 
+    def to_db_row(self) -> dict[str, Any]:
+        """
+        Plain column -> value mapping used by the bulk (executemany) write paths. The id is left out when it's not set,
+        so the database can generate it.
+        """
+        row = {
+            "name": self.name,
+            "category": self.category,
+            "price": self.price,
+            "description": self.description,
+            "image_path": self.image_path,
+            "producer": self.producer,
+            "characteristics": self.characteristics,
+            "quantity": self.quantity
+        }
+        if self.id is not None:
+            row["id"] = self.id
+        return row
+
     @classmethod
     def from_db_model(cls, db_model: ProductModel) -> 'Product':
         return cls(
@@ -41,5 +73,88 @@ class Product:
             image_path=db_model.image_path,
             producer=db_model.producer,
             characteristics=db_model.characteristics,
-            quantity=db_model.quantity
+            quantity=db_model.quantity,
+            version=db_model.version,
+            updated_at=as_utc(db_model.updated_at)
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        JSON serializable mapping of every field. The price is a string so no precision is lost.
+        """
+        data = dataclasses.asdict(self)
+        data["price"] = str(self.price) if self.price is not None else None
+        data["updated_at"] = self.updated_at.isoformat() if self.updated_at is not None else None
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], keep_id: bool = True) -> 'Product':
+        """
+        Validating counterpart of `to_dict`, for data coming from outside (imports, request bodies). Numbers may be
+        given as strings and `characteristics` as a JSON string, as happens with CSV. `version` and `updated_at` are
+        ignored, the database maintains them.
+
+        :raises ValueError: With a message naming the offending field
+        """
+        name = data.get("name")
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError("name is required")
+        characteristics = data.get("characteristics") or {}
+        if isinstance(characteristics, str):
+            try:
+                characteristics = json.loads(characteristics)
+            except ValueError:
+                raise ValueError("characteristics is not valid JSON") from None
+        if not isinstance(characteristics, dict):
+            raise ValueError("characteristics must be an object")
+        return cls(
+            id=_optional_int(data, "id", minimum=1) if keep_id else None,
+            name=name,
+            category=_optional_int(data, "category"),
+            price=_optional_price(data.get("price")),
+            description=_optional_str(data, "description"),
+            image_path=_optional_str(data, "image_path"),
+            producer=_optional_str(data, "producer"),
+            characteristics=characteristics,
+            quantity=_optional_int(data, "quantity", minimum=0),
         )
+
+
+def _blank(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _optional_int(data: dict[str, Any], field: str, minimum: int = None) -> nullable(int):
+    value = data.get(field)
+    if _blank(value):
+        return None
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{field} must be an integer, got {value!r}")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an integer, got {value!r}") from None
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{field} must be at least {minimum}, got {value}")
+    return value
+
+
+def _optional_str(data: dict[str, Any], field: str) -> nullable(str):
+    value = data.get(field)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"{field} must be a string, got {value!r}")
+    return value
+
+
+def _optional_price(value: Any) -> nullable(Decimal):
+    if _blank(value):
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"price must be a number, got {value!r}")
+    try:
+        price = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"price must be a number, got {value!r}") from None
+    if not price.is_finite() or price < 0:
+        raise ValueError(f"price must be a non-negative number, got {value!r}")
+    return price
@@ -0,0 +1,329 @@
+import dataclasses
+import datetime
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable
+
+from src.core.product import Product
+from src.utils.types import nullable
+
+
+@dataclasses.dataclass(repr=True)
+class CacheStats:
+    hits: int = 0
+    negative_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+    size: int = 0
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    product: nullable(Product)
+    expires_at: float
+
+
+class ProductCache:
+    """
+    Thread safe LRU cache of products by id with a TTL on every entry. Misses are cached as well (with their own,
+    usually shorter, TTL) so repeated lookups of ids which don't exist don't reach the database.
+
+    Products are copied on the way in and on the way out, so callers are free to mutate what they get.
+
+    To avoid caching a value read before a concurrent write was committed, readers take a `token()` before querying
+    the database and pass it to `put()`. If anything was invalidated in the meantime, the put is ignored.
+    """
+
+    def __init__(self, max_size: int, ttl_s: float, negative_ttl_s: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self._max_size: int = max_size
+        self._ttl_s: float = ttl_s
+        self._negative_ttl_s: float = negative_ttl_s
+        self._clock: Callable[[], float] = clock
+        self._entries: OrderedDict[int, _CacheEntry] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self._generation: int = 0
+        self._stats: CacheStats = CacheStats()
+
+    def token(self) -> int:
+        return self._generation
+
+    def get(self, product_id: int) -> tuple[bool, nullable(Product)]:
+        """
+        :return: (True, product) on a hit, (True, None) on a cached miss and (False, None) when the id isn't cached
+        """
+        with self._lock:
+            entry = self._entries.get(product_id)
+            if entry is None:
+                self._stats.misses += 1
+                return False, None
+            if entry.expires_at <= self._clock():
+                del self._entries[product_id]
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return False, None
+            self._entries.move_to_end(product_id)
+            if entry.product is None:
+                self._stats.negative_hits += 1
+                return True, None
+            self._stats.hits += 1
+            product = entry.product
+        return True, product.copy()
+
+    def put(self, product_id: int, product: nullable(Product), token: int = None):
+        """
+        Cache a product, or a miss when `product` is None.
+
+        :param token: The value of `token()` taken before the product was read from the database
+        """
+        ttl_s = self._ttl_s if product is not None else self._negative_ttl_s
+        if ttl_s <= 0:
+            return
+        product = product.copy() if product is not None else None
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            self._entries[product_id] = _CacheEntry(product=product, expires_at=self._clock() + ttl_s)
+            self._entries.move_to_end(product_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def invalidate(self, product_ids: Iterable[int]):
+        with self._lock:
+            self._generation += 1
+            for product_id in product_ids:
+                if self._entries.pop(product_id, None) is not None:
+                    self._stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._stats.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return dataclasses.replace(self._stats, size=len(self._entries))
+
+
+class ProductPayload:
+    """
+    A product encoded as ready to send JSON bytes, together with what's needed to answer conditional requests. The
+    gzip compressed body is built on first use and kept.
+    """
+
+    def __init__(self, product_id: int, version: nullable(int), updated_at: nullable(datetime.datetime), body: bytes):
+        self.product_id: int = product_id
+        self.version: nullable(int) = version
+        self.updated_at: nullable(datetime.datetime) = updated_at
+        self.body: bytes = body
+        self._gzipped: nullable(bytes) = None
+
+    @classmethod
+    def encode(cls, product: Product) -> 'ProductPayload':
+        body = json.dumps(product.to_dict(), separators=(",", ":")).encode()
+        return cls(product_id=product.id, version=product.version, updated_at=product.updated_at, body=body)
+
+    def gzipped(self) -> bytes:
+        # two threads may both compress it the first time, either result is fine
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, mtime=0)
+        return self._gzipped
+
+
+@dataclasses.dataclass
+class _PayloadEntry:
+    payload: ProductPayload
+    expires_at: float
+
+
+class PayloadCache:
+    """
+    Thread safe LRU cache of encoded products by id with a TTL on every entry, so a hot product is sent without being
+    read, converted or serialized again. Every entry carries the version it was encoded from; payloads are immutable
+    and shared between callers.
+
+    Same invalidation scheme as `ProductCache`: readers take a `token()` before reading the product and pass it to
+    `put()`, which is ignored if anything was invalidated in the meantime.
+    """
+
+    def __init__(self, max_size: int, ttl_s: float, clock: Callable[[], float] = time.monotonic):
+        self._max_size: int = max_size
+        self._ttl_s: float = ttl_s
+        self._clock: Callable[[], float] = clock
+        self._entries: OrderedDict[int, _PayloadEntry] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self._generation: int = 0
+        self._stats: CacheStats = CacheStats()
+
+    def token(self) -> int:
+        return self._generation
+
+    def get(self, product_id: int, version: int = None) -> nullable(ProductPayload):
+        """
+        :param version: Only return a payload encoded from this version of the product
+        """
+        with self._lock:
+            entry = self._entries.get(product_id)
+            if entry is None or version is not None and entry.payload.version != version:
+                self._stats.misses += 1
+                return None
+            if entry.expires_at <= self._clock():
+                del self._entries[product_id]
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(product_id)
+            self._stats.hits += 1
+            return entry.payload
+
+    def put(self, payload: ProductPayload, token: int = None):
+        """
+        :param token: The value of `token()` taken before the product was read from the database
+        """
+        if self._ttl_s <= 0:
+            return
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            self._entries[payload.product_id] = _PayloadEntry(payload=payload, expires_at=self._clock() + self._ttl_s)
+            self._entries.move_to_end(payload.product_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def invalidate(self, product_ids: Iterable[int]):
+        with self._lock:
+            self._generation += 1
+            for product_id in product_ids:
+                if self._entries.pop(product_id, None) is not None:
+                    self._stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._stats.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return dataclasses.replace(self._stats, size=len(self._entries))
+
+
+@dataclasses.dataclass
+class _SearchEntry:
+    products: list[Product]
+    generation: int
+    stored_at: float
+
+
+class SearchCache:
+    """
+    Thread safe cache of search results keyed by the normalized filters. The total number of cached products is
+    bounded, the least recently used results are evicted first.
+
+    Every write to the catalog bumps a generation counter, which makes every result stored before it stale without
+    touching the entries. A stale result can still be served for `stale_s` seconds after it went stale (by the bump or
+    by its TTL), while a single caller refreshes it in the background.
+    """
+
+    _GENERATION_HISTORY: int = 1024
+
+    def __init__(self, max_items: int, ttl_s: float, stale_s: float, clock: Callable[[], float] = time.monotonic):
+        self._max_items: int = max_items
+        self._ttl_s: float = ttl_s
+        self._stale_s: float = stale_s
+        self._clock: Callable[[], float] = clock
+        self._entries: OrderedDict[Hashable, _SearchEntry] = OrderedDict()
+        self._items: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._generation: int = 0
+        # generation -> when it was superseded, for the last few generations
+        self._superseded_at: OrderedDict[int, float] = OrderedDict()
+        self._refreshing: set[Hashable] = set()
+        self._stats: CacheStats = CacheStats()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def bump(self):
+        with self._lock:
+            self._superseded_at[self._generation] = self._clock()
+            if len(self._superseded_at) > self._GENERATION_HISTORY:
+                self._superseded_at.popitem(last=False)
+            self._generation += 1
+
+    def _stale_since(self, entry: _SearchEntry) -> nullable(float):
+        """
+        :return: None if the entry is fresh, otherwise the moment it went stale. Entries from generations too old to
+        remember are treated as stale forever.
+        """
+        stale_since = None
+        if entry.generation != self._generation:
+            stale_since = self._superseded_at.get(entry.generation, float("-inf"))
+        expires_at = entry.stored_at + self._ttl_s
+        if expires_at <= self._clock():
+            stale_since = expires_at if stale_since is None else min(stale_since, expires_at)
+        return stale_since
+
+    def get(self, key: Hashable) -> tuple[nullable(list[Product]), bool]:
+        """
+        :return: (products, refresh). Products is None when nothing usable is cached. When `refresh` is True the
+        result is stale and the caller is the one who should refresh it (and call `refresh_done()` afterwards).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return None, False
+            refresh = False
+            if (stale_since := self._stale_since(entry)) is not None:
+                if self._clock() - stale_since > self._stale_s:
+                    self._remove(key)
+                    self._stats.expirations += 1
+                    self._stats.misses += 1
+                    return None, False
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    refresh = True
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            products = entry.products
+        return [product.copy() for product in products], refresh
+
+    def put(self, key: Hashable, products: list[Product], generation: int):
+        """
+        :param generation: The value of `generation` taken before the products were read from the database
+        """
+        products = [product.copy() for product in products]
+        with self._lock:
+            if (existing := self._entries.get(key)) is not None:
+                if existing.generation > generation:
+                    return
+                self._remove(key)
+            if len(products) + 1 > self._max_items:
+                return
+            self._entries[key] = _SearchEntry(products=products, generation=generation, stored_at=self._clock())
+            self._items += len(products) + 1
+            while self._items > self._max_items:
+                self._remove(next(iter(self._entries)))
+                self._stats.evictions += 1
+
+    def refresh_done(self, key: Hashable):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self._items -= len(entry.products) + 1
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return dataclasses.replace(self._stats, size=len(self._entries))
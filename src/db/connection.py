@@ -1,36 +1,256 @@
 import contextlib
+import datetime
+import itertools
+import threading
+from collections import Counter
 from decimal import Decimal
+from typing import Any, Iterable, Iterator
 
-from sqlalchemy import Engine, create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Engine, Row, create_engine, event, exc, exists, select, text
+from sqlalchemy.orm import Session as SQLAlchemySession, sessionmaker
 
-from config import DBConfig, DBEngineType
+from config import CategoryStorage, DBConfig, DBEngineType
+from src.core.category import ProductCategory
 from src.core.product import Product
-from src.db.models import Base
+from src.context import ContextThread, ThreadLocalContextTable
+from src.db.cache import CacheStats, PayloadCache, ProductCache, ProductPayload, SearchCache
+from src.db.filters import SORTABLE_COLUMNS, CharacteristicsFilter, KeysetCursor, ProductFilters, fulltext_terms
+from src.db.models import Base, ProductModel, ProductCategoryBitModel, as_utc
+from src.db.pool import InstrumentedQueuePool, PoolStats
+from src.db.routing import ReplicaRouter
+from src.db.snapshot import CatalogSnapshot
+from src.db.timing import StatementTimer
+from src.db.unit_of_work import UnitOfWork
+from src.db.results import (BulkInsertResult, CatalogVersion, ChangeBatch, FacetCounts, FailedRow, PriceBucket,
+                            ProductChange, ProductPage, ProductVersion, QueryPlanCheck, SearchHit, StockResult)
+from src.db.schema import (SEARCH_SHAPES, ensure_characteristic_indexes, ensure_columns, ensure_fulltext,
+                           ensure_indexes, is_full_scan, is_sequential_scan, read_schema_stamp, schema_stamp,
+                           stamp_category_storage, write_schema_stamp)
 from src.utils.logging.logger import Logger
 from src.db.session import Session
-from src.utils.types import nullable
+from src.utils.types import nullable, const
+
+DEFAULT_PAGE_SIZE: const(int) = 50
+MAX_PAGE_SIZE: const(int) = 1000
+# a cursor value of every sortable column, for checking the plan of the pages after it
+_PAGE_CURSOR_VALUES: const(dict[str, Any]) = {"id": 1, "name": "name", "price": Decimal(10), "producer": "producer",
+                                              "quantity": 1}
+DEFAULT_STREAM_BATCH_SIZE: const(int) = 500
+DEFAULT_CHANGE_BATCH_SIZE: const(int) = 1000
+DEFAULT_TOP_PRODUCERS: const(int) = 10
+DEFAULT_PRICE_BOUNDARIES: const(tuple[Decimal, ...]) = tuple(Decimal(p) for p in (10, 25, 50, 100, 250))
+# what a product listing needs, everything but the description and characteristics
+LISTING_COLUMNS: const(tuple[str, ...]) = ("id", "name", "price", "category", "image_path")
+
+
+class _StockRejected(Exception):
+    """
+    Raised inside a stock session to roll back every adjustment made so far
+    """
 
 
 class Database:
 
     def __init__(self, cfg: DBConfig, logger: Logger) -> None:
+        """
+        Nothing is connected here: the engines are created and the schema is checked on first use (or by `connect()`)
+        """
         self._cfg: DBConfig = cfg
         self._logger: Logger = logger
-        self._db: Engine = self._create_engine()
-        self._session = sessionmaker(bind=self._db)
-        self.create_tables()
+        self._engine: nullable(Engine) = None
+        self._sessionmaker: nullable(sessionmaker) = None
+        self._replica_router: nullable(ReplicaRouter) = None
+        self._started: bool = False
+        self._start_lock: threading.RLock = threading.RLock()
+        self._product_cache: nullable(ProductCache) = self._create_product_cache()
+        self._search_cache: nullable(SearchCache) = self._create_search_cache()
+        self._payload_cache: nullable(PayloadCache) = self._create_payload_cache()
+        self._snapshot: nullable(CatalogSnapshot) = self._create_snapshot()
+        self._statement_timer: StatementTimer = StatementTimer(logger.clone("SQL"), cfg.slow_query_ms)
+        self._session_logger: Logger = logger.clone("Session")
+        # one context key per database, a thread can have a unit of work open on several of them
+        self._unit_of_work_key: str = f"db_unit_of_work_{id(self)}"
+
+    def connect(self):
+        """
+        Create the engines and make sure the schema is up to date now rather than on the first query, e.g. to fail
+        fast at boot
+        """
+        if self._started:
+            return
+        with self._start_lock:
+            # an engine without `_started` means this thread is still preparing the schema and came back through
+            # one of the properties below
+            if self._started or self._engine is not None:
+                return
+            self._engine = self._create_engine()
+            self._sessionmaker = sessionmaker(bind=self._engine)
+            self._replica_router = ReplicaRouter(
+                primary=self._sessionmaker,
+                replicas=[self._create_replica_engine(replica) for replica in self._cfg.replicas],
+                policy=self._cfg.replica_routing, read_your_writes_s=self._cfg.read_your_writes_s)
+            try:
+                self._prepare_schema()
+            except Exception:
+                self._engine = self._sessionmaker = self._replica_router = None
+                raise
+            self._started = True
+
+    @property
+    def _db(self) -> Engine:
+        self.connect()
+        return self._engine
+
+    @property
+    def _session(self) -> sessionmaker:
+        self.connect()
+        return self._sessionmaker
+
+    @property
+    def _router(self) -> ReplicaRouter:
+        self.connect()
+        return self._replica_router
 
     @property
     def name(self) -> str:
         return self._cfg.db_name
 
+    def _create_product_cache(self) -> nullable(ProductCache):
+        cache_cfg = self._cfg.cache
+        if cache_cfg.product_cache_size <= 0:
+            return None
+        self._logger.debug(f"Product cache enabled with size {cache_cfg.product_cache_size}")
+        return ProductCache(max_size=cache_cfg.product_cache_size, ttl_s=cache_cfg.product_ttl_s,
+                            negative_ttl_s=cache_cfg.product_negative_ttl_s)
+
+    def _create_search_cache(self) -> nullable(SearchCache):
+        cache_cfg = self._cfg.cache
+        if cache_cfg.search_cache_items <= 0:
+            return None
+        self._logger.debug(f"Search cache enabled with {cache_cfg.search_cache_items} items")
+        return SearchCache(max_items=cache_cfg.search_cache_items, ttl_s=cache_cfg.search_ttl_s,
+                           stale_s=cache_cfg.search_stale_s)
+
+    def _create_payload_cache(self) -> nullable(PayloadCache):
+        cache_cfg = self._cfg.cache
+        if cache_cfg.payload_cache_size <= 0:
+            return None
+        self._logger.debug(f"Payload cache enabled with size {cache_cfg.payload_cache_size}")
+        return PayloadCache(max_size=cache_cfg.payload_cache_size, ttl_s=cache_cfg.product_ttl_s)
+
+    def _create_snapshot(self) -> nullable(CatalogSnapshot):
+        if not self._cfg.catalog_snapshot:
+            return None
+        self._logger.debug("Catalog snapshot enabled, it's loaded on the first search")
+        return CatalogSnapshot(self, refresh_interval_s=self._cfg.snapshot_refresh_s)
+
+    @property
+    def snapshot(self) -> nullable(CatalogSnapshot):
+        """
+        The in-memory catalog serving searches, None unless `catalog_snapshot` is enabled
+        """
+        return self._snapshot
+
+    def search_cache_stats(self) -> nullable(CacheStats):
+        if self._search_cache is not None:
+            return self._search_cache.stats()
+
+    def product_cache_stats(self) -> nullable(CacheStats):
+        if self._product_cache is not None:
+            return self._product_cache.stats()
+
+    def payload_cache_stats(self) -> nullable(CacheStats):
+        if self._payload_cache is not None:
+            return self._payload_cache.stats()
+
+    def _products_changed(self, product_ids: nullable(Iterable[int])):
+        """
+        Must be called after every committed write to the products table. `None` means every product may have changed.
+        Inside a unit of work the write isn't committed yet, it's handled when the unit of work commits.
+        """
+        if (unit := self._current_unit_of_work()) is not None:
+            unit.products_changed(product_ids)
+            return
+        self._router.wrote()
+        if self._snapshot is not None:
+            self._snapshot.mark_dirty()
+        if self._search_cache is not None:
+            self._search_cache.bump()
+        for cache in (self._product_cache, self._payload_cache):
+            if cache is None:
+                continue
+            if product_ids is None:
+                cache.clear()
+            else:
+                cache.invalidate(product_ids)
+
     def _create_engine(self) -> Engine:
-        if self._cfg.engine == DBEngineType.POSTGRESQL:
-            self._instrument_postgres_db()
         self._logger.debug(
             f"Creating {self._cfg.engine} database engine with user {self._cfg.username} and database {self._cfg.db_name}")
-        return create_engine(str(self._cfg))
+        engine = create_engine(str(self._cfg), **self._engine_options(self._cfg))
+        self._statement_timer.attach(engine)
+        if self._cfg.engine == DBEngineType.SQLITE:
+            self._begin_sqlite_transactions(engine)
+        return engine
+
+    def _create_replica_engine(self, cfg: DBConfig) -> Engine:
+        # replicas are expected to exist already, schema changes reach them through replication
+        self._logger.debug(f"Creating {cfg.engine} replica engine for database {cfg.db_name} on {cfg.host}")
+        engine = create_engine(str(cfg), **self._engine_options(cfg))
+        self._statement_timer.attach(engine)
+        return engine
+
+    @staticmethod
+    def _begin_sqlite_transactions(engine: Engine):
+        """
+        pysqlite only opens a transaction right before a write and none before a SAVEPOINT, so a SAVEPOINT taken first
+        starts its own transaction and releasing it commits everything so far. Let SQLAlchemy emit the BEGIN instead,
+        so savepoints nest inside the session's transaction.
+        """
+        @event.listens_for(engine, "connect")
+        def _connect(dbapi_connection, _):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _begin(conn):
+            # straight to the driver, it's not a statement worth timing or counting
+            conn.connection.driver_connection.execute("BEGIN")
+
+    @staticmethod
+    def _engine_options(cfg: DBConfig) -> dict[str, Any]:
+        options = {"poolclass": InstrumentedQueuePool, "pool_pre_ping": cfg.pool_pre_ping}
+        if cfg.pool_size is not None:
+            options["pool_size"] = cfg.pool_size
+        if cfg.max_overflow is not None:
+            options["max_overflow"] = cfg.max_overflow
+        if cfg.pool_timeout_s is not None:
+            options["pool_timeout"] = cfg.pool_timeout_s
+        if cfg.pool_recycle_s is not None:
+            options["pool_recycle"] = cfg.pool_recycle_s
+        return options
+
+    def pool_stats(self) -> PoolStats:
+        """
+        Live statistics of the connection pool: connections checked out, overflow in use, checkouts with their wait
+        times and checkout timeouts.
+        """
+        return self._db.pool.stats()
+
+    def replica_pool_stats(self) -> list[PoolStats]:
+        """
+        Same as `pool_stats` for every replica, in configuration order
+        """
+        return [engine.pool.stats() for engine in self._router.replicas]
+
+    def primary_only(self):
+        """
+        Context manager sending every read of the current thread to the primary while it's active, for callers which
+        can't tolerate replication lag (e.g. read-modify-write sequences).
+
+            with db.primary_only():
+                product = db.get_product(product_id)
+        """
+        return self._router.pinned()
 
     def _instrument_postgres_db(self):
         self._logger.debug("instrumenting postgres database")
@@ -47,15 +267,189 @@ class Database:
                 self._logger.debug(f"Database {self._cfg.db_name} already exists")
             conn.execute(text('commit'))
 
-    def create_tables(self):
+    def _prepare_schema(self):
+        """
+        Skip every schema check when the database is stamped with the schema this code and configuration expect.
+        Otherwise (new database, older schema, changed settings) run the full setup and stamp it.
+        """
+        try:
+            stamp = read_schema_stamp(self._engine)
+        except exc.OperationalError:
+            if self._cfg.engine != DBEngineType.POSTGRESQL:
+                raise
+            # most likely the database doesn't exist yet
+            self._instrument_postgres_db()
+            stamp = None
+
+        expected = schema_stamp(self._cfg.category_storage, self._cfg.indexed_characteristics)
+        if stamp == expected:
+            self._logger.debug(f"Schema of {self._cfg.db_name} is up to date")
+            return
+        self._logger.info(f"Schema of {self._cfg.db_name} is stamped {stamp}, expected {expected}, migrating...")
+        # writes made in another storage mode didn't maintain the bits table, even if it isn't empty
+        self.create_tables(rebuild_category_bits=stamp_category_storage(stamp) != self._cfg.category_storage)
+        write_schema_stamp(self._engine, expected)
+
+    def create_tables(self, rebuild_category_bits: bool = False):
+        """
+        Full schema setup: create missing tables, columns and indexes and fill the category bits if needed. Safe to
+        run on a database which is already up to date, just slow.
+
+        :param rebuild_category_bits: Rebuild the category bits table even if it already has rows
+        """
         Base.metadata.create_all(self._db)
         self._logger.debug("Tables created")
+        for column in ensure_columns(self._db):
+            self._logger.info(f"Added missing column {column}")
+        self.ensure_indexes()
+        if self._category_bits and (rebuild_category_bits or self._category_bits_missing()):
+            if not self.migrate_category_storage():
+                # stamping the schema now would leave the bits out of date for good
+                raise RuntimeError(f"Could not fill the category bits table of {self._cfg.db_name}")
+
+    def ensure_indexes(self) -> list[str]:
+        """
+        Create the indexes declared on the models which don't exist yet. Needed for databases created before the
+        index was added, since `create_all` leaves existing tables alone.
+        """
+        if ensure_fulltext(self._db):
+            self._logger.info("Created the full text index")
+        created = ensure_indexes(self._db)
+        created += ensure_characteristic_indexes(self._db, self._cfg.indexed_characteristics)
+        for index in created:
+            self._logger.info(f"Created missing index {index}")
+        return created
+
+    def check_query_plans(self) -> list[QueryPlanCheck]:
+        """
+        Run EXPLAIN on the standard search shapes and flag the ones which still need a sequential scan of the products
+        table. Note that the category shape can only be served by an index with the `bits` category storage.
+
+        The "page by <column>" shapes are keyset pages in the middle of the results. They must seek to the cursor, so
+        walking an index from its start is flagged too: it costs as much as an OFFSET.
+        """
+        shapes = dict(SEARCH_SHAPES)
+        for key in self._cfg.indexed_characteristics:
+            shapes[f"characteristic {key}"] = ProductFilters.build(characteristics=[(key, ">=", 1)])
+        checks = []
+        with self.in_session() as session:
+            for shape, filters in shapes.items():
+                plan = session.explain_search(filters)
+                checks.append(QueryPlanCheck(shape=shape, plan=plan,
+                                             sequential_scan=is_sequential_scan(plan, ProductModel.__tablename__)))
+            for order_by, value in _PAGE_CURSOR_VALUES.items():
+                cursor = KeysetCursor(order_by=order_by, descending=False, last_value=value, last_id=1,
+                                      filters_fingerprint=ProductFilters().fingerprint())
+                plan = session.explain_page(ProductFilters(), cursor, DEFAULT_PAGE_SIZE + 1)
+                checks.append(QueryPlanCheck(shape=f"page by {order_by}", plan=plan,
+                                             sequential_scan=is_full_scan(plan, ProductModel.__tablename__)))
+        for check in checks:
+            if check.sequential_scan:
+                self._logger.warning(f"Search by {check.shape} falls back to a sequential scan", plan=check.plan)
+        return checks
+
+    @property
+    def _category_bits(self) -> bool:
+        return self._cfg.category_storage == CategoryStorage.BITS
+
+    def _category_bits_missing(self) -> bool:
+        with self._db.connect() as conn:
+            has_products = conn.scalar(select(exists().where(ProductModel.id.is_not(None))))
+            has_bits = conn.scalar(select(exists().where(ProductCategoryBitModel.bit.is_not(None))))
+        return has_products and not has_bits
+
+    def migrate_category_storage(self) -> bool:
+        """
+        Fill the category bits table from the existing `category` values. It's run automatically when the `bits`
+        storage is enabled on a database last set up with another storage mode, since writes made in `bitmask` mode
+        don't maintain the bits table.
+        """
+        try:
+            with self.in_session() as session:
+                inserted = session.rebuild_category_bits()
+                self._logger.debug(f"Category bits table rebuilt with {inserted} rows")
+                return True
+        except Exception as exc:
+            self._logger.error(f"Could not migrate category storage: {exc}")
+        return False
 
     @contextlib.contextmanager
-    def in_session(self) -> Session:
+    def unit_of_work(self) -> Iterator[UnitOfWork]:
+        """
+        Make every call to this database from the current thread inside the block share one session and one
+        transaction, committed once when the block exits and rolled back if it raises, e.g. for a whole API request:
+
+            with db.unit_of_work():
+                product = db.get_product(product_id)
+                db.reserve_stock([(product.id, 1)])
+
+        The calls keep their usual results: a failed write is rolled back to a savepoint taken before it and reported
+        as usual, without undoing the rest of the unit. Reads made before the unit's first write are served as they
+        would be outside of it, replicas included. From then on they see the unit's own writes, so they go to the
+        primary and skip the caches and the snapshot; the caches are invalidated after the commit.
+        Ids assigned by inserts are set on the products right away and stay set if the unit is rolled back.
+
+        Nested blocks join the outermost one. Without an open unit every call runs in its own session, as always.
+        """
+        if (unit := self._current_unit_of_work()) is not None:
+            yield unit
+            return
         raw_session = self._session()
-        sess = Session(raw_session, self._logger.clone("Session"))
+        unit = UnitOfWork(raw_session, self._wrap_session(raw_session))
+        try:
+            with ThreadLocalContextTable().in_context(**{self._unit_of_work_key: unit}):
+                yield unit
+            raw_session.commit()
+        except Exception as e:
+            self._logger.debug(f"Exception in unit of work: {e}, rolling back...")
+            raw_session.rollback()
+            raise
+        finally:
+            raw_session.close()
+        if unit.written:
+            self._products_changed(unit.changed_products)
+
+    def _wrap_session(self, raw_session: SQLAlchemySession) -> Session:
+        return Session(raw_session, self._session_logger, category_bits=self._category_bits,
+                       statement_timer=self._statement_timer)
+
+    def _current_unit_of_work(self) -> nullable(UnitOfWork):
+        unit = ThreadLocalContextTable().get(self._unit_of_work_key)
+        return unit if unit is not None and unit.owned_by_current_thread() else None
+
+    def _caches_usable(self) -> bool:
+        """
+        False while the current unit of work has uncommitted writes, which the caches and the snapshot don't see
+        """
+        unit = self._current_unit_of_work()
+        return unit is None or not unit.written
+
+    @contextlib.contextmanager
+    def in_session(self, read_only: bool = False) -> Session:
+        """
+        :param read_only: The session only reads, so it may be served by a replica. Within `read_your_writes_s` of a
+        write by the same thread, or inside `primary_only()`, it still goes to the primary.
+
+        Writing sessions start by taking the change log lock (see `Session.lock_change_log()`), before any row lock.
+        Inside a unit of work writes use the unit's session instead, in a savepoint so an error rolls back only this
+        block. Reads join it too from the unit's first write on, before that they're routed as usual.
+        """
+        if (unit := self._current_unit_of_work()) is not None and (unit.pinned or not read_only):
+            if read_only:
+                yield unit.session
+            else:
+                if not unit.pinned:
+                    # nothing ran in the unit's transaction yet, so no row is locked
+                    unit.session.lock_change_log()
+                    unit.pinned = True
+                with unit.session.savepoint():
+                    yield unit.session
+            return
+        raw_session = self._router.read_session()() if read_only else self._session()
+        sess = self._wrap_session(raw_session)
         try:
+            if not read_only:
+                sess.lock_change_log()
             yield sess
             raw_session.commit()
         except Exception as e:
@@ -65,68 +459,464 @@ class Database:
         finally:
             raw_session.close()
 
+    @contextlib.contextmanager
+    def _read_session(self, fills_cache: bool) -> Iterator[Session]:
+        """
+        `in_session(read_only=True)`, except that reads which fill a cache go to the primary, like the snapshot's. A
+        lagging replica could still return what a write just invalidated, and the cache would then serve it for its
+        whole TTL, long after the replica caught up.
+        """
+        with self.primary_only() if fills_cache else contextlib.nullcontext():
+            with self.in_session(read_only=True) as session:
+                yield session
+
     def get_product(self, product_id: int) -> nullable(Product):
+        token = None
+        use_cache = self._product_cache is not None and self._caches_usable()
+        if use_cache:
+            found, product = self._product_cache.get(product_id)
+            if found:
+                return product
+            token = self._product_cache.token()
         try:
-            with self.in_session() as session:
+            with self._read_session(fills_cache=use_cache) as session:
                 db_product = session.get_product(product_id)
-                if db_product:
-                    self._logger.debug(f"Found product with {db_product.id=}")
-                    return Product.from_db_model(db_product)
-                self._logger.debug(f"No product with {product_id=}")
+                product = Product.from_db_model(db_product) if db_product else None
         except Exception as exc:
             self._logger.debug(f"Could not get product with id {product_id}: {exc}")
+            return None
+
+        if product:
+            self._logger.debug(f"Found product with {product.id=}")
+        else:
+            self._logger.debug(f"No product with {product_id=}")
+        if use_cache:
+            self._product_cache.put(product_id, product, token)
+        return product
+
+    def get_products(self, product_ids: Iterable[int]) -> list[nullable(Product)]:
+        """
+        Look up many products at once, e.g. for a cart. Ids found in the product cache are served from it, the rest
+        are read in one session with an IN query per `bulk_chunk_size` ids.
+
+        :return: One entry per requested id, in the requested order: the product, or None if it doesn't exist. A
+        repeated id gets the same product object every time.
+        """
+        product_ids = list(product_ids)
+        unique_ids = list(dict.fromkeys(product_ids))
+        found: dict[int, nullable(Product)] = {}
+        token = None
+        use_cache = self._product_cache is not None and self._caches_usable()
+        if use_cache:
+            for product_id in unique_ids:
+                hit, product = self._product_cache.get(product_id)
+                if hit:
+                    found[product_id] = product
+            token = self._product_cache.token()
+
+        missing = [product_id for product_id in unique_ids if product_id not in found]
+        if missing:
+            try:
+                with self._read_session(fills_cache=use_cache) as session:
+                    for start in range(0, len(missing), self._cfg.bulk_chunk_size):
+                        chunk = missing[start:start + self._cfg.bulk_chunk_size]
+                        found.update((model.id, Product.from_db_model(model)) for model in session.get_products(chunk))
+            except Exception as exc:
+                self._logger.error(f"Could not get {len(missing)} products: {exc}")
+                raise
+            for product_id in missing:
+                product = found.setdefault(product_id, None)
+                if use_cache:
+                    self._product_cache.put(product_id, product, token)
+        self._logger.debug(f"Got {len(unique_ids)} products, {len(unique_ids) - len(missing)} from the cache")
+        return [found[product_id] for product_id in product_ids]
+
+    def get_product_payload(self, product_id: int) -> nullable(ProductPayload):
+        """
+        The product encoded as JSON (`Product.to_dict()`), as sent by the HTTP API. With the payload cache enabled, a
+        hot product is a lookup: it's only read and encoded again after a write or when its entry expires.
+
+        :return: None if there's no such product
+        """
+        token = None
+        use_cache = self._payload_cache is not None and self._caches_usable()
+        if use_cache:
+            if (payload := self._payload_cache.get(product_id)) is not None:
+                return payload
+            token = self._payload_cache.token()
+        with self.primary_only() if use_cache else contextlib.nullcontext():
+            product = self.get_product(product_id)
+        if product is None:
+            return None
+        payload = ProductPayload.encode(product)
+        if use_cache:
+            self._payload_cache.put(payload, token)
+        return payload
+
+    def get_product_version(self, product_id: int) -> nullable(ProductVersion):
+        """
+        Version of a product without loading it, e.g. to answer a conditional request. Served from the payload or the
+        product cache when the product is in one of them.
+
+        :return: None if there's no such product
+        """
+        if self._caches_usable():
+            if self._payload_cache is not None and (payload := self._payload_cache.get(product_id)) is not None:
+                return ProductVersion(version=payload.version, updated_at=payload.updated_at)
+            if self._product_cache is not None:
+                found, product = self._product_cache.get(product_id)
+                if found:
+                    return ProductVersion(version=product.version, updated_at=product.updated_at) if product else None
+        try:
+            with self.in_session(read_only=True) as session:
+                row = session.get_product_version(product_id)
+        except Exception as exc:
+            self._logger.debug(f"Could not get the version of product {product_id}: {exc}")
+            return None
+        return ProductVersion(version=row.version, updated_at=as_utc(row.updated_at)) if row else None
 
     def search_products(self, name: str = None, category: int = None, min_price: Decimal = None,
                         max_price: Decimal = None,
-                        producer: str = None) -> list[Product]:
+                        producer: str = None, characteristics: CharacteristicsFilter = None) -> list[Product]:
+        filters = ProductFilters.build(name=name, category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        caches_usable = self._caches_usable()
+        if self._snapshot is not None and not filters.characteristics and caches_usable:
+            try:
+                return self._snapshot.search(filters)
+            except Exception as exc:
+                self._logger.error(f"Could not search the catalog snapshot: {exc}")
+                raise
+        if self._search_cache is None or not caches_usable:
+            return self._search_products(filters)
+
+        filters = filters.normalized()
+        products, refresh = self._search_cache.get(filters)
+        if products is None:
+            generation = self._search_cache.generation
+            products = self._search_products(filters, fills_cache=True)
+            self._search_cache.put(filters, products, generation)
+        elif refresh:
+            ContextThread(target=self._refresh_search, args=(filters,), daemon=True).start()
+        return products
+
+    def _search_products(self, filters: ProductFilters, fills_cache: bool = False) -> list[Product]:
         try:
-            with self.in_session() as session:
-                static_filters = {}
+            with self._read_session(fills_cache) as session:
+                return [Product.from_db_model(product) for product in session.search_products(filters)]
+        except Exception as exc:
+            self._logger.error(f"Could not search for products: {exc}")
+            raise
+
+    def _refresh_search(self, filters: ProductFilters):
+        try:
+            generation = self._search_cache.generation
+            self._search_cache.put(filters, self._search_products(filters, fills_cache=True), generation)
+        except Exception as exc:
+            self._logger.debug(f"Could not refresh cached search {filters}: {exc}")
+        finally:
+            self._search_cache.refresh_done(filters)
 
-                if name is not None:
-                    static_filters['name'] = name
-                if producer is not None:
-                    static_filters['producer'] = producer
+    def search_products_page(self, name: str = None, category: int = None, min_price: Decimal = None,
+                             max_price: Decimal = None, producer: str = None,
+                             characteristics: CharacteristicsFilter = None,
+                             order_by: str = "id", descending: bool = False, limit: int = DEFAULT_PAGE_SIZE,
+                             cursor: str = None) -> ProductPage:
+        """
+        Keyset paginated search. Pass the `next_cursor` of a page to get the following one. The cursor remembers the
+        ordering and is only valid with the filters it was created with.
+        """
+        filters = ProductFilters.build(name=name, category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        if order_by not in SORTABLE_COLUMNS:
+            raise ValueError(f"Cannot order products by {order_by}")
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"Page size must be between 1 and {MAX_PAGE_SIZE}, got {limit}")
 
-                return [Product.from_db_model(product) for product in
-                        session.search_products(static_filters=static_filters, category=category, min_price=min_price,
-                                                max_price=max_price)]
+        keyset = None
+        if cursor is not None:
+            keyset = KeysetCursor.decode(cursor)
+            if keyset.filters_fingerprint != filters.fingerprint():
+                raise ValueError("Cursor was created for a different search")
+            order_by, descending = keyset.order_by, keyset.descending
+
+        try:
+            with self.in_session(read_only=True) as session:
+                rows = session.search_products_page(filters, order_by, descending, limit + 1, keyset)
+                items = [Product.from_db_model(product) for product in rows[:limit]]
         except Exception as exc:
             self._logger.error(f"Could not search for products: {exc}")
             raise
 
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = KeysetCursor(order_by=order_by, descending=descending, last_value=getattr(last, order_by),
+                                       last_id=last.id, filters_fingerprint=filters.fingerprint()).encode()
+        return ProductPage(items=items, next_cursor=next_cursor)
+
+    def iter_products(self, name: str = None, category: int = None, min_price: Decimal = None,
+                      max_price: Decimal = None, producer: str = None,
+                      characteristics: CharacteristicsFilter = None,
+                      order_by: str = "id", descending: bool = False,
+                      batch_size: int = DEFAULT_STREAM_BATCH_SIZE) -> Iterator[Product]:
+        """
+        Generator over every matching product. Rows are streamed from a server side cursor `batch_size` at a time, so
+        memory use doesn't depend on the size of the result. The session stays open until the generator is exhausted
+        or closed.
+        """
+        filters = ProductFilters.build(name=name, category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        yield from self._stream_products(filters, order_by, descending, batch_size, versioned=False)
+
+    def iter_products_versioned(self, name: str = None, category: int = None, min_price: Decimal = None,
+                                max_price: Decimal = None, producer: str = None,
+                                characteristics: CharacteristicsFilter = None,
+                                order_by: str = "id", descending: bool = False,
+                                batch_size: int = DEFAULT_STREAM_BATCH_SIZE
+                                ) -> tuple[CatalogVersion, Iterator[Product]]:
+        """
+        `iter_products` together with the `catalog_version()`, read in the same session right before the rows. Both
+        come from the same node, so the version always describes the rows even when the replicas lag behind each
+        other. The session is open once this returns, close the iterator if the rows aren't needed after all.
+        """
+        filters = ProductFilters.build(name=name, category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        products = self._stream_products(filters, order_by, descending, batch_size, versioned=True)
+        return next(products), products
+
+    def _stream_products(self, filters: ProductFilters, order_by: str, descending: bool, batch_size: int,
+                         versioned: bool) -> Iterator:
+        """
+        :param versioned: Yield the catalog version before the products
+        """
+        if order_by not in SORTABLE_COLUMNS:
+            raise ValueError(f"Cannot order products by {order_by}")
+        try:
+            with self.in_session(read_only=True) as session:
+                if versioned:
+                    seq, changed_at = session.last_change()
+                    yield CatalogVersion(seq=seq, changed_at=as_utc(changed_at))
+                for product in session.iter_products(filters, order_by, descending, batch_size):
+                    yield Product.from_db_model(product)
+        except Exception as exc:
+            self._logger.error(f"Could not stream products: {exc}")
+            raise
+
+    def search_product_rows(self, name: str = None, category: int = None, min_price: Decimal = None,
+                            max_price: Decimal = None, producer: str = None,
+                            characteristics: CharacteristicsFilter = None,
+                            columns: tuple[str, ...] = LISTING_COLUMNS, order_by: str = "id",
+                            descending: bool = False, limit: int = None) -> list[Row]:
+        """
+        Lightweight search returning only the requested columns as compact rows (attribute, index and `_asdict()`
+        access). Much cheaper than `search_products` for listings, since the description and the characteristics JSON
+        are neither transferred nor decoded and no `Product` objects are built.
+        """
+        filters = ProductFilters.build(name=name, category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        if unknown := set(columns) - set(ProductModel.__table__.c.keys()):
+            raise ValueError(f"Unknown product columns: {', '.join(sorted(unknown))}")
+        if order_by not in SORTABLE_COLUMNS:
+            raise ValueError(f"Cannot order products by {order_by}")
+        try:
+            with self.in_session(read_only=True) as session:
+                return session.search_product_rows(filters, tuple(columns), order_by, descending, limit)
+        except Exception as exc:
+            self._logger.error(f"Could not search for product rows: {exc}")
+            raise
+
+    def search_products_text(self, query: str, limit: int = DEFAULT_PAGE_SIZE, category: int = None,
+                             min_price: Decimal = None, max_price: Decimal = None, producer: str = None,
+                             characteristics: CharacteristicsFilter = None) -> list[SearchHit]:
+        """
+        Ranked full text search over name and description. Every word of the query matches as a prefix ("note"
+        finds "notebooks") and a product needs to match only some of the words, so a misspelled word in a longer
+        query just doesn't contribute to the ranking. Results can be narrowed with the usual filters.
+        """
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"Limit must be between 1 and {MAX_PAGE_SIZE}, got {limit}")
+        if not (terms := fulltext_terms(query)):
+            return []
+        filters = ProductFilters.build(category=category, min_price=min_price, max_price=max_price,
+                                       producer=producer, characteristics=characteristics)
+        try:
+            with self.in_session(read_only=True) as session:
+                return [SearchHit(product=Product.from_db_model(product), score=score)
+                        for product, score in session.search_products_text(filters, terms, limit)]
+        except Exception as exc:
+            self._logger.error(f"Could not run full text search for {query!r}: {exc}")
+            raise
+
+    def facet_counts(self, filters: ProductFilters = None, top_producers: int = DEFAULT_TOP_PRODUCERS,
+                     price_boundaries: Iterable[Decimal] = DEFAULT_PRICE_BOUNDARIES) -> FacetCounts:
+        """
+        Counts for rendering filter sidebars: matches per category, the most common producers and a price histogram.
+        Everything is aggregated in SQL with a fixed number of statements, no matter how many products match.
+
+        :param filters: Restrict the counts to the products matching these filters (see `ProductFilters.build`)
+        :param price_boundaries: Increasing prices splitting the histogram buckets
+        """
+        filters = filters or ProductFilters()
+        boundaries = [Decimal(str(boundary)) for boundary in price_boundaries]
+        if boundaries != sorted(set(boundaries)):
+            raise ValueError(f"Price boundaries must be increasing, got {boundaries}")
+        categories = list(ProductCategory.members().values())
+        try:
+            with self.in_session(read_only=True) as session:
+                total, category_counts, producers, bucket_counts = session.facet_counts(filters, categories,
+                                                                                        top_producers, boundaries)
+        except Exception as exc:
+            self._logger.error(f"Could not count facets: {exc}")
+            raise
+
+        lowers = [None] + boundaries
+        uppers = boundaries + [None]
+        return FacetCounts(
+            total=total,
+            categories=dict(zip(categories, category_counts)),
+            producers=producers,
+            price_buckets=[PriceBucket(lower=lower, upper=upper, count=count)
+                           for lower, upper, count in zip(lowers, uppers, bucket_counts)],
+        )
+
     def insert_product(self, product: Product) -> bool:
         try:
             with self.in_session() as session:
                 # update unique constraints
                 product.id = session.insert_product(product.to_db_model())
                 self._logger.debug(f"Inserted product with id {product.id}")
-                return True
         except Exception as exc:
             self._logger.error(f"Could not insert product with id {product.id}\n Exception: {exc}")
-        return False
+            return False
+        # drop a cached miss for the new id
+        self._products_changed([product.id])
+        return True
+
+    def insert_products(self, products: Iterable[Product], chunk_size: int = None) -> BulkInsertResult:
+        """
+        Insert many products in a single transaction. Rows are written in chunks of `chunk_size` with one executemany
+        statement per chunk. If a chunk fails, it's retried row by row so only the offending rows are reported as
+        failed and the rest of the batch still goes through. The generated IDs are set on the given products once the
+        transaction commits.
+        """
+        chunk_size = self._cfg.bulk_chunk_size if chunk_size is None else chunk_size
+        if chunk_size < 1:
+            raise ValueError(f"Chunk size must be at least 1, got {chunk_size}")
+        result = BulkInsertResult()
+        inserted: list[tuple[int, Product, int]] = []
+        attempted: list[Product] = []
+        products = iter(products)
+        try:
+            with self.in_session() as session:
+                # every product taken from the input is recorded first, so a failure can still report it
+                for product in products:
+                    attempted.append(product)
+                    if len(attempted) % chunk_size == 0:
+                        offset = len(attempted) - chunk_size
+                        inserted.extend(self._insert_chunk(session, attempted[offset:], offset, result))
+                if remainder := len(attempted) % chunk_size:
+                    offset = len(attempted) - remainder
+                    inserted.extend(self._insert_chunk(session, attempted[offset:], offset, result))
+        except Exception as exc:
+            self._logger.error(f"Could not insert products\n Exception: {exc}")
+            self._fail_batch(result, attempted, products, str(exc))
+            return result
+
+        for _, product, product_id in inserted:
+            product.id = product_id
+            result.inserted.append(product)
+        self._products_changed([product.id for product in result.inserted])
+        self._logger.debug(f"Inserted {len(result.inserted)} products, {len(result.failed)} failed")
+        return result
+
+    @staticmethod
+    def _fail_batch(result: BulkInsertResult, attempted: list[Product], rest: Iterator[Product], error: str):
+        """
+        The transaction was rolled back: nothing was written, so every product of the batch is reported as failed,
+        including the ones never attempted. Rows which had already failed on their own keep their error.
+        """
+        try:
+            rest = list(rest)
+        except Exception:
+            # the input itself is what failed
+            rest = []
+        failed = {row.index for row in result.failed}
+        result.failed.extend(FailedRow(index=idx, product=product, error=error)
+                             for idx, product in enumerate(itertools.chain(attempted, rest)) if idx not in failed)
+        result.failed.sort(key=lambda row: row.index)
+
+    def copy_products(self, products: list[Product]) -> BulkInsertResult:
+        """
+        Fastest way to load a batch of products, meant for imports: one COPY on Postgres, `insert_products` elsewhere.
+        The batch is all-or-nothing on the COPY path; if it fails, it's retried with `insert_products` so only the
+        offending rows are reported as failed. Keep batches to a size which fits comfortably in memory.
+        """
+        if self._cfg.engine != DBEngineType.POSTGRESQL or not products:
+            return self.insert_products(products)
+        copied: list[tuple[Product, int]] = []
+        try:
+            with self.in_session() as session:
+                # a COPY either sets every id or none
+                for group in ([p for p in products if p.id is not None], [p for p in products if p.id is None]):
+                    copied.extend(zip(group, session.copy_products([product.to_db_row() for product in group])))
+        except Exception as exc:
+            self._logger.debug(f"COPY of {len(products)} products failed, retrying with inserts: {exc}")
+            return self.insert_products(products)
+
+        result = BulkInsertResult()
+        for product, product_id in copied:
+            product.id = product_id
+            result.inserted.append(product)
+        self._products_changed([product.id for product in result.inserted])
+        return result
+
+    def _insert_chunk(self, session: Session, chunk: list[Product], offset: int,
+                      result: BulkInsertResult) -> list[tuple[int, Product, int]]:
+        try:
+            with session.savepoint():
+                product_ids = session.insert_products([product.to_db_row() for product in chunk])
+                return list(zip(range(offset, offset + len(chunk)), chunk, product_ids))
+        except Exception as exc:
+            self._logger.debug(f"Bulk insert of chunk at offset {offset} failed, retrying row by row: {exc}")
+
+        inserted = []
+        for idx, product in enumerate(chunk, start=offset):
+            try:
+                with session.savepoint():
+                    inserted.append((idx, product, session.insert_products([product.to_db_row()])[0]))
+            except Exception as exc:
+                result.failed.append(FailedRow(index=idx, product=product, error=str(exc)))
+        return inserted
 
     def delete_product(self, product_id: int) -> bool:
         try:
             with self.in_session() as session:
-                if session.delete_product(product_id):
-                    self._logger.debug(f"Product with id {product_id} deleted")
-                    return True
-                self._logger.debug(f"Failed to delete product with id {product_id}")
-                return False
+                deleted = session.delete_product(product_id)
         except Exception as exc:
             self._logger.debug(f"Could not delete product with id {product_id}\n Exception: {exc}")
-        return False
+            return False
+
+        if deleted:
+            self._logger.debug(f"Product with id {product_id} deleted")
+            self._products_changed([product_id])
+        else:
+            self._logger.debug(f"Failed to delete product with id {product_id}")
+        return deleted
 
     def update_product(self, product: Product) -> bool:
         try:
             with self.in_session() as session:
-                if existing_product := session.get_product(product.id):
-                    return session.update_product(existing_product, product)
-                self._logger.debug(f"Product with ID: {product.id} does not exist")
+                updated = session.update_product(product)
         except Exception as exc:
             self._logger.debug(f"Could not update product with id {product.id}\n Exception: {exc}")
-        return False
+            return False
+
+        if not updated:
+            self._logger.debug(f"Product with ID: {product.id} does not exist")
+            return False
+        self._products_changed([product.id])
+        return True
 
     def delete_all_products(self):
         try:
@@ -135,4 +925,112 @@ class Database:
                 self._logger.debug("All products deleted")
         except Exception as exc:
             self._logger.debug(f"Could not delete all products: {exc}")
-        return False
+            return False
+        self._products_changed(None)
+        return True
+
+    def reserve_stock(self, lines: Iterable[tuple[int, int]]) -> StockResult:
+        """
+        Take stock for a batch of (product_id, amount) lines, e.g. an order at checkout. Either every line is reserved
+        or nothing is. Safe under concurrency: each product is decremented by a conditional UPDATE which only matches
+        while enough stock is left, so two checkouts can never both take the last item.
+        """
+        return self._adjust_stock(lines, sign=-1)
+
+    def release_stock(self, lines: Iterable[tuple[int, int]]) -> StockResult:
+        """
+        Give back stock taken by `reserve_stock` (cancelled or expired orders). All-or-nothing like reserving.
+        """
+        return self._adjust_stock(lines, sign=1)
+
+    def _adjust_stock(self, lines: Iterable[tuple[int, int]], sign: int) -> StockResult:
+        amounts = Counter()
+        for product_id, amount in lines:
+            if amount <= 0:
+                raise ValueError(f"Stock amounts must be positive, got {amount} for product {product_id}")
+            amounts[product_id] += amount
+        # a fixed locking order keeps concurrent multi-line reservations from deadlocking on Postgres
+        product_ids = sorted(amounts)
+        rejected = []
+        try:
+            with self.in_session() as session:
+                for product_id in product_ids:
+                    if not session.adjust_stock(product_id, sign * amounts[product_id]):
+                        rejected.append(product_id)
+                if rejected:
+                    raise _StockRejected()
+        except _StockRejected:
+            self._logger.debug(f"Stock adjustment rejected for products {rejected}")
+            return StockResult(ok=False, rejected=rejected)
+        except Exception as exc:
+            self._logger.error(f"Could not adjust stock of products {product_ids}: {exc}")
+            return StockResult(ok=False, error=str(exc))
+
+        if product_ids:
+            self._products_changed(product_ids)
+        return StockResult(ok=True)
+
+    def changes_since(self, seq: int = 0, limit: int = DEFAULT_CHANGE_BATCH_SIZE) -> ChangeBatch:
+        """
+        Changes to the products committed after `seq`, oldest first, for keeping derived data (caches, indexes,
+        snapshots) up to date in any process. Start from 0 (or from the `last_seq` of a reset) and keep passing the
+        `last_seq` of the previous batch:
+
+            batch = db.changes_since(last_seq)
+            if batch.reset_required:
+                reload_everything()
+            else:
+                for change in batch.changes:
+                    ...
+            last_seq = batch.last_seq
+
+        A change only says which product changed (or that all of them were deleted), read the product for its state.
+        """
+        if limit <= 0:
+            raise ValueError(f"Limit must be positive, got {limit}")
+        try:
+            with self.in_session(read_only=True) as session:
+                changes, pruned_through = session.changes_since(seq, limit)
+                if seq < pruned_through:
+                    return ChangeBatch(changes=[], last_seq=session.last_change_seq(), reset_required=True)
+                changes = [ProductChange(seq=change.seq, product_id=change.product_id, op=change.op,
+                                         changed_at=change.changed_at) for change in changes]
+        except Exception as exc:
+            self._logger.error(f"Could not read the changes since {seq}: {exc}")
+            raise
+        return ChangeBatch(changes=changes, last_seq=changes[-1].seq if changes else seq)
+
+    def last_change_seq(self) -> int:
+        """
+        Position of the latest change in the change log, 0 if nothing was ever written
+        """
+        with self.in_session(read_only=True) as session:
+            return session.last_change_seq()
+
+    def catalog_version(self) -> CatalogVersion:
+        """
+        Version of the whole catalog, it changes with every write to the products table. Usable as the validator of
+        any listing.
+        """
+        with self.in_session(read_only=True) as session:
+            seq, changed_at = session.last_change()
+        return CatalogVersion(seq=seq, changed_at=as_utc(changed_at))
+
+    def prune_changes(self, retention_s: float = None) -> nullable(int):
+        """
+        Delete the change log entries older than the retention (`change_retention_s` by default) and compact the rest
+        down to the latest change of every product. Meant to be run periodically.
+
+        :return: The number of deleted entries, None on failure
+        """
+        retention_s = self._cfg.change_retention_s if retention_s is None else retention_s
+        older_than = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=retention_s)
+        try:
+            with self.in_session() as session:
+                pruned = session.prune_changes(older_than)
+                compacted = session.compact_changes()
+        except Exception as exc:
+            self._logger.error(f"Could not prune the change log: {exc}")
+            return None
+        self._logger.debug(f"Pruned {pruned} and compacted {compacted} change log entries")
+        return pruned + compacted
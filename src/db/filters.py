@@ -0,0 +1,188 @@
+import base64
+import dataclasses
+import hashlib
+import json
+import re
+from decimal import Decimal
+from typing import Any, Iterable
+
+from sqlalchemy import String, and_, cast, func, literal, literal_column
+from sqlalchemy.dialects.postgresql import JSONB, JSONPATH
+
+from src.db.models import ProductModel
+from src.utils.types import nullable, const
+
+
+CHARACTERISTIC_OPERATORS: const(tuple[str, ...]) = ("=", "<", "<=", ">", ">=")
+# `{key: value}` for equality or `(key, op, value)` conditions
+CharacteristicsFilter = dict[str, Any] | Iterable[tuple[str, str, Any]] | None
+
+
+def check_characteristic_key(key: str):
+    """
+    Keys end up inside the JSON path literal (see `characteristic_path`), so quotes and backslashes are refused
+    """
+    if not isinstance(key, str) or not key or set(key) & {'"', "'", "\\"}:
+        raise ValueError(f"Invalid characteristic key: {key!r}")
+
+
+@dataclasses.dataclass(frozen=True)
+class CharacteristicPredicate:
+    """
+    A condition on one key of `Product.characteristics`, e.g. ("color", "=", "red") or ("pages", ">=", 100). Values
+    only match stored values of the same JSON type, so "100" never matches 100.
+    """
+    key: str
+    op: str
+    value: str | int | float | bool | None
+
+    def __post_init__(self):
+        check_characteristic_key(self.key)
+        if self.op not in CHARACTERISTIC_OPERATORS:
+            raise ValueError(f"Invalid characteristic operator {self.op!r}, expected one of {CHARACTERISTIC_OPERATORS}")
+        if not isinstance(self.value, (str, int, float, bool, type(None))):
+            raise ValueError(f"Characteristic values must be JSON scalars, got {self.value!r}")
+        if self.op != "=" and (self.value is None or isinstance(self.value, bool)):
+            raise ValueError(f"{self.value!r} can only be compared with '='")
+
+    @classmethod
+    def parse_all(cls, spec: CharacteristicsFilter = None) -> tuple['CharacteristicPredicate', ...]:
+        """
+        Accepts a `{key: value}` dict (equality on every key) or an iterable of `(key, op, value)` tuples. The result
+        is sorted, so the same conditions given in another order compare (and hash) equal.
+        """
+        if not spec:
+            return ()
+        items = [(key, "=", value) for key, value in spec.items()] if isinstance(spec, dict) else spec
+        return tuple(sorted((cls(*item) for item in items), key=repr))
+
+
+@dataclasses.dataclass(frozen=True)
+class ProductFilters:
+    """
+    The set of filters accepted by the product search methods. It's hashable so it can be used as a cache key.
+    """
+    name: nullable(str) = None
+    category: nullable(int) = None
+    min_price: nullable(Decimal) = None
+    max_price: nullable(Decimal) = None
+    producer: nullable(str) = None
+    characteristics: tuple[CharacteristicPredicate, ...] = ()
+
+    @classmethod
+    def build(cls, name: str = None, category: int = None, min_price: Decimal = None, max_price: Decimal = None,
+              producer: str = None, characteristics: CharacteristicsFilter = None) -> 'ProductFilters':
+        return cls(name=name, category=category, min_price=min_price, max_price=max_price, producer=producer,
+                   characteristics=CharacteristicPredicate.parse_all(characteristics))
+
+    def normalized(self) -> 'ProductFilters':
+        """
+        Same filters with prices as Decimals, so equal searches map to the same cache key however they were given
+        """
+        return dataclasses.replace(
+            self,
+            min_price=Decimal(str(self.min_price)) if self.min_price is not None else None,
+            max_price=Decimal(str(self.max_price)) if self.max_price is not None else None,
+        )
+
+    def fingerprint(self) -> str:
+        """
+        Short stable digest of the filters. Used to make sure a cursor is only reused with the filters it was made for.
+        """
+        data = json.dumps([str(v) if v is not None else None for v in dataclasses.astuple(self)])
+        return hashlib.sha1(data.encode()).hexdigest()[:12]
+
+
+def characteristic_path(key: str) -> str:
+    return f'$."{key}"'
+
+
+def characteristic_expression(key: str):
+    """
+    `json_extract(characteristics, '$."key"')` with the path inlined as a literal. SQLite can only use an expression
+    index when the query spells the expression exactly like the index does, which a bound parameter doesn't.
+    """
+    return func.json_extract(ProductModel.characteristics, literal_column(f"'{characteristic_path(key)}'"))
+
+
+def _sqlite_json_types(value: Any) -> tuple[str, ...]:
+    if value is None:
+        return "null",
+    if isinstance(value, bool):
+        return "true", "false"
+    if isinstance(value, (int, float)):
+        return "integer", "real"
+    return "text",
+
+
+def sqlite_characteristic_criteria(predicate: CharacteristicPredicate):
+    """
+    JSON1 version of the predicate. The json_type() guard keeps the semantics equal to Postgres', where values of
+    different JSON types never compare equal or ordered (SQLite would happily compare '100' with 100).
+    """
+    path = literal_column(f"'{characteristic_path(predicate.key)}'")
+    type_guard = func.json_type(ProductModel.characteristics, path).in_(_sqlite_json_types(predicate.value))
+    if predicate.value is None:
+        return type_guard
+    expression = characteristic_expression(predicate.key)
+    value = int(predicate.value) if isinstance(predicate.value, bool) else predicate.value
+    return and_(type_guard, expression.op(predicate.op)(value))
+
+
+def postgres_characteristic_criteria(predicate: CharacteristicPredicate):
+    """
+    JSONB version of the predicate. Both operators used can be served by the GIN (jsonb_path_ops) index:
+    equality is a containment check `@>`, comparisons are a strict jsonpath filter `@?`.
+    """
+    if predicate.op == "=":
+        document = json.dumps({predicate.key: predicate.value})
+        return ProductModel.characteristics.op("@>")(cast(literal(document, String), JSONB))
+    path = f"strict {characteristic_path(predicate.key)} ? (@ {predicate.op} {json.dumps(predicate.value)})"
+    return ProductModel.characteristics.op("@?")(cast(literal(path, String), JSONPATH))
+
+
+def fulltext_terms(query: str) -> list[str]:
+    """
+    Words of a free text query, lower cased and stripped of anything which has a meaning in FTS5 or tsquery syntax
+    """
+    return list(dict.fromkeys(re.findall(r"\w+", query.lower())))
+
+
+SORTABLE_COLUMNS: dict[str, Any] = {
+    "id": ProductModel.id,
+    "name": ProductModel.name,
+    "price": ProductModel.price,
+    "producer": ProductModel.producer,
+    "quantity": ProductModel.quantity,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class KeysetCursor:
+    """
+    Position of the last row of a page: the value of the sort column and the id (used as a tie-breaker). The next page
+    starts strictly after this position, so no OFFSET scan is ever needed.
+    """
+    order_by: str
+    descending: bool
+    last_value: Any
+    last_id: int
+    filters_fingerprint: str
+
+    def encode(self) -> str:
+        value = str(self.last_value) if isinstance(self.last_value, Decimal) else self.last_value
+        data = [self.order_by, self.descending, value, self.last_id, self.filters_fingerprint]
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> 'KeysetCursor':
+        try:
+            order_by, descending, value, last_id, fingerprint = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception as exc:
+            raise ValueError(f"Malformed cursor: {cursor}") from exc
+        if order_by not in SORTABLE_COLUMNS:
+            raise ValueError(f"Malformed cursor: unknown sort column {order_by}")
+        if order_by == "price" and value is not None:
+            value = Decimal(value)
+        return cls(order_by=order_by, descending=descending, last_value=value, last_id=last_id,
+                   filters_fingerprint=fingerprint)
@@ -1,9 +1,26 @@
-from sqlalchemy import Column, Integer, String, BigInteger, Numeric, JSON
+import datetime
+
+from sqlalchemy import (Column, Integer, String, BigInteger, Numeric, JSON, SmallInteger, ForeignKey, Index, DateTime,
+                        text)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
 
+def _utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def as_utc(value: datetime.datetime | None) -> datetime.datetime | None:
+    """
+    SQLite keeps no time zone, the naive values it returns are the UTC times they were written as
+    """
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
 class ProductModel(Base):
     __tablename__ = "products"
 
@@ -14,5 +31,71 @@ class ProductModel(Base):
     description = Column("description", String)
     image_path = Column("image_path", String)
     producer = Column("producer", String)
-    characteristics = Column("characteristics", JSON)
+    # JSONB on Postgres so characteristic filters can be served by a GIN index
+    characteristics = Column("characteristics", JSON().with_variant(JSONB(), "postgresql"))
     quantity = Column("quantity", Integer)
+    # bumped by every write to the row, together they make the ETag / Last-Modified of the product
+    version = Column("version", Integer, nullable=False, default=1, server_default=text("1"))
+    # None for rows written before the column existed
+    updated_at = Column("updated_at", DateTime(timezone=True), default=_utc_now, onupdate=_utc_now)
+
+    __table_args__ = (
+        # equality on name, ordered by id for pagination
+        Index("ix_products_name", "name", "id"),
+        # price ranges and keyset pagination ordered by price
+        Index("ix_products_price", "price", "id"),
+        # equality on producer, optionally with a price range
+        Index("ix_products_producer_price", "producer", "price"),
+        # keyset pagination ordered by producer / quantity
+        Index("ix_products_producer_id", "producer", "id"),
+        Index("ix_products_quantity", "quantity", "id"),
+    )
+
+
+class ProductCategoryBitModel(Base):
+    """
+    One row for every bit set in a product's category. Used when the category storage mode is `bits`, so category
+    filters become index lookups on (bit, product_id) instead of a bitwise `&` over the whole products table.
+    """
+    __tablename__ = "product_category_bits"
+
+    bit = Column("bit", SmallInteger, primary_key=True)
+    product_id = Column("product_id", Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True,
+                        index=True)
+
+
+class SchemaMetaModel(Base):
+    """
+    Key/value facts about the database itself, e.g. the schema version it was last brought up to date with
+    """
+    __tablename__ = "schema_meta"
+
+    key = Column("key", String, primary_key=True)
+    value = Column("value", String)
+
+
+class ChangeOp:
+    INSERT: str = "insert"
+    UPDATE: str = "update"
+    DELETE: str = "delete"
+    # every product was deleted
+    TRUNCATE: str = "truncate"
+
+
+class ProductChangeModel(Base):
+    """
+    Append only log of the writes to the products table, written in the same transaction as the write itself.
+    `seq` only grows, so a consumer can remember the last seq it processed and ask for what came after it.
+    """
+    __tablename__ = "product_changes"
+
+    # INTEGER PRIMARY KEY is the rowid on SQLite, BIGINT would not be
+    seq = Column("seq", BigInteger().with_variant(Integer(), "sqlite"), primary_key=True, autoincrement=True)
+    # None for changes which affect every product (truncate)
+    product_id = Column("product_id", Integer, index=True)
+    op = Column("op", String, nullable=False)
+    changed_at = Column("changed_at", DateTime(timezone=True), nullable=False, index=True,
+                        default=_utc_now)
+
+    # without AUTOINCREMENT SQLite hands out the seqs of deleted rows again after pruning
+    __table_args__ = {"sqlite_autoincrement": True}
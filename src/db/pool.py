@@ -0,0 +1,83 @@
+import dataclasses
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+@dataclasses.dataclass(repr=True)
+class PoolStats:
+    size: int = 0
+    checked_out: int = 0
+    overflow: int = 0
+    checkouts: int = 0
+    timeouts: int = 0
+    total_wait_s: float = 0.0
+    max_wait_s: float = 0.0
+
+    @property
+    def avg_wait_s(self) -> float:
+        return self.total_wait_s / self.checkouts if self.checkouts else 0.0
+
+
+class PoolTelemetry:
+    """
+    Counters about how long callers had to wait for a connection. They survive pool re-creation (e.g. on dispose).
+    """
+
+    def __init__(self):
+        self._lock: threading.Lock = threading.Lock()
+        self._stats: PoolStats = PoolStats()
+
+    def record_checkout(self, wait_s: float):
+        with self._lock:
+            self._stats.checkouts += 1
+            self._stats.total_wait_s += wait_s
+            self._stats.max_wait_s = max(self._stats.max_wait_s, wait_s)
+
+    def record_timeout(self):
+        with self._lock:
+            self._stats.timeouts += 1
+
+    def snapshot(self, pool: QueuePool) -> PoolStats:
+        with self._lock:
+            return dataclasses.replace(self._stats, size=pool.size(), checked_out=pool.checkedout(),
+                                       overflow=pool.overflow())
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool which times every connection checkout and counts checkout timeouts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.telemetry: PoolTelemetry = PoolTelemetry()
+        # QueuePool._do_get() calls itself when it loses a race, only the outermost call is timed
+        self._depth: threading.local = threading.local()
+
+    def _do_get(self):
+        depth = getattr(self._depth, "value", 0)
+        if depth:
+            return super()._do_get()
+
+        self._depth.value = 1
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            self.telemetry.record_timeout()
+            raise
+        finally:
+            self._depth.value = 0
+        self.telemetry.record_checkout(time.perf_counter() - start)
+        return record
+
+    def recreate(self) -> 'InstrumentedQueuePool':
+        pool = super().recreate()
+        pool.telemetry = self.telemetry
+        return pool
+
+    def stats(self) -> PoolStats:
+        return self.telemetry.snapshot(self)
@@ -0,0 +1,117 @@
+import dataclasses
+import datetime
+from decimal import Decimal
+
+from src.core.product import Product
+from src.utils.types import nullable
+
+
+@dataclasses.dataclass(repr=True)
+class FailedRow:
+    """
+    A single row which could not be written during a batch operation. The index is the position of the product in the
+    batch given by the caller.
+    """
+    index: int
+    product: Product
+    error: str
+
+
+@dataclasses.dataclass(repr=True)
+class BulkInsertResult:
+    inserted: list[Product] = dataclasses.field(default_factory=list)
+    failed: list[FailedRow] = dataclasses.field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+@dataclasses.dataclass(repr=True)
+class ProductPage:
+    """
+    One page of a keyset paginated search. `next_cursor` is None on the last page.
+    """
+    items: list[Product]
+    next_cursor: nullable(str) = None
+
+
+@dataclasses.dataclass(repr=True)
+class QueryPlanCheck:
+    shape: str
+    plan: list[str]
+    sequential_scan: bool
+
+
+@dataclasses.dataclass(repr=True)
+class SearchHit:
+    product: Product
+    score: float
+
+
+@dataclasses.dataclass(repr=True)
+class PriceBucket:
+    """
+    Products with lower <= price < upper. The first bucket has no lower bound and the last one no upper bound.
+    """
+    lower: nullable(Decimal)
+    upper: nullable(Decimal)
+    count: int
+
+
+@dataclasses.dataclass(repr=True)
+class FacetCounts:
+    total: int
+    # category bit value -> number of matching products in that category
+    categories: dict[int, int]
+    # most common producers first
+    producers: list[tuple[str, int]]
+    price_buckets: list[PriceBucket]
+
+
+@dataclasses.dataclass(repr=True)
+class StockResult:
+    """
+    Outcome of an all-or-nothing stock operation. When `ok` is False nothing was changed and `rejected` holds the ids
+    which caused it (unknown products, products without a quantity or, on reservation, without enough stock).
+    """
+    ok: bool
+    rejected: list[int] = dataclasses.field(default_factory=list)
+    error: nullable(str) = None
+
+
+@dataclasses.dataclass(repr=True)
+class ProductChange:
+    seq: int
+    # None when the change affects every product
+    product_id: nullable(int)
+    op: str
+    changed_at: datetime.datetime
+
+
+@dataclasses.dataclass(repr=True)
+class ChangeBatch:
+    """
+    Changes following a given seq. Pass `last_seq` to the next `changes_since` call. When `reset_required` is True
+    the changes the consumer asked for were pruned: it has to reload everything and continue from `last_seq`.
+    """
+    changes: list[ProductChange]
+    last_seq: int
+    reset_required: bool = False
+
+
+@dataclasses.dataclass(repr=True)
+class ProductVersion:
+    version: int
+    # None for products last written before the column existed
+    updated_at: nullable(datetime.datetime)
+
+
+@dataclasses.dataclass(repr=True)
+class CatalogVersion:
+    """
+    Changes with every write to the products table, the `seq` of the latest change log entry
+    """
+    seq: int
+    # None when the change log was pruned empty
+    changed_at: nullable(datetime.datetime)
@@ -0,0 +1,70 @@
+import itertools
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import sessionmaker
+
+from config import ReplicaRouting
+
+
+class ReplicaRouter:
+    """
+    Decides which engine serves a read only session. Reads go to the replicas (round robin or to the one with the
+    fewest checked out connections) except when the current thread is pinned to the primary, either explicitly with
+    `pinned()` or because it wrote something less than `read_your_writes_s` seconds ago.
+    """
+
+    def __init__(self, primary: sessionmaker, replicas: list[Engine], policy: str, read_your_writes_s: float,
+                 clock: Callable[[], float] = time.monotonic):
+        if policy not in (ReplicaRouting.ROUND_ROBIN, ReplicaRouting.LEAST_BUSY):
+            raise ValueError(f"Unrecognized replica routing policy: {policy}")
+        self._primary: sessionmaker = primary
+        self._replicas: list[Engine] = replicas
+        self._replica_sessions: list[sessionmaker] = [sessionmaker(bind=engine) for engine in replicas]
+        self._policy: str = policy
+        self._read_your_writes_s: float = read_your_writes_s
+        self._clock: Callable[[], float] = clock
+        self._next: itertools.count = itertools.count()
+        self._local: threading.local = threading.local()
+
+    @property
+    def replicas(self) -> list[Engine]:
+        return self._replicas
+
+    def pinned(self):
+        return _PrimaryPin(self._local)
+
+    def wrote(self):
+        """
+        Record that the current thread committed a write, so its next reads see it
+        """
+        self._local.last_write_at = self._clock()
+
+    def _is_pinned(self) -> bool:
+        if getattr(self._local, "pins", 0):
+            return True
+        last_write_at = getattr(self._local, "last_write_at", None)
+        return last_write_at is not None and self._clock() - last_write_at < self._read_your_writes_s
+
+    def read_session(self) -> sessionmaker:
+        if not self._replicas or self._is_pinned():
+            return self._primary
+        if self._policy == ReplicaRouting.LEAST_BUSY:
+            idx = min(range(len(self._replicas)), key=lambda i: self._replicas[i].pool.checkedout())
+        else:
+            idx = next(self._next) % len(self._replicas)
+        return self._replica_sessions[idx]
+
+
+class _PrimaryPin:
+
+    def __init__(self, local: threading.local):
+        self._local: threading.local = local
+
+    def __enter__(self):
+        self._local.pins = getattr(self._local, "pins", 0) + 1
+
+    def __exit__(self, *_):
+        self._local.pins -= 1
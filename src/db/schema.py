@@ -0,0 +1,264 @@
+import itertools
+import json
+import re
+from decimal import Decimal
+
+from sqlalchemy import Connection, Engine, delete, exc, inspect, insert, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import Select
+
+from config import DBEngineType
+from src.core.category import ProductCategory
+from src.db.filters import ProductFilters, characteristic_path, check_characteristic_key
+from src.db.models import Base, ProductModel, SchemaMetaModel
+from src.utils.types import const, nullable
+
+CHARACTERISTICS_GIN_INDEX: const(str) = "ix_products_characteristics"
+# Bump whenever the models, their indexes or the DDL below change, so existing databases get migrated on startup
+SCHEMA_VERSION: const(int) = 4
+SCHEMA_VERSION_KEY: const(str) = "schema_version"
+# the highest change log seq removed by pruning
+CHANGES_PRUNED_KEY: const(str) = "changes_pruned_through"
+
+# The filter combinations issued by the search endpoints. Each of them should be served by an index.
+SEARCH_SHAPES: const(dict[str, ProductFilters]) = {
+    "name": ProductFilters(name="name"),
+    "producer": ProductFilters(producer="producer"),
+    "producer_price": ProductFilters(producer="producer", min_price=Decimal(10), max_price=Decimal(20)),
+    "price_range": ProductFilters(min_price=Decimal(10), max_price=Decimal(20)),
+    "min_price": ProductFilters(min_price=Decimal(10)),
+    "category": ProductFilters(category=ProductCategory.TOYS),
+}
+
+
+def _index_names(conn: Connection, table: str) -> set[str]:
+    if conn.dialect.name == DBEngineType.SQLITE:
+        # the inspector skips expression indexes on SQLite
+        rows = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                            {"table": table})
+        return {row.name for row in rows}
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+def ensure_indexes(engine: Engine) -> list[str]:
+    """
+    Create every index declared on the models which is missing from the database. `create_all` only creates indexes
+    together with their table, so this is what brings existing databases up to date.
+
+    :return: The names of the created indexes
+    """
+    created = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = _index_names(conn, table.name)
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    created.append(index.name)
+    return created
+
+
+def ensure_columns(engine: Engine) -> list[str]:
+    """
+    Add the nullable columns declared on the models which are missing from existing tables. Anything more involved
+    (new NOT NULL columns, type changes) needs a hand written migration.
+
+    :return: The created columns as "table.column"
+    """
+    created = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} without a default")
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    # text() defaults are SQL already, plain strings are literals
+                    ddl += f" DEFAULT {default.text if hasattr(default, 'text') else repr(str(default))}"
+                conn.exec_driver_sql(ddl)
+                created.append(f"{table.name}.{column.name}")
+    return created
+
+
+def schema_stamp(category_storage: str, indexed_characteristics: list[str]) -> str:
+    """
+    What the schema of a database set up with this configuration looks like: the schema version plus the settings
+    which create tables or indexes of their own
+    """
+    return json.dumps([SCHEMA_VERSION, category_storage, sorted(indexed_characteristics)])
+
+
+def stamp_category_storage(stamp: nullable(str)) -> nullable(str):
+    """
+    :return: The category storage a database with this stamp was set up with, None if unknown (no stamp or one
+    written before the storage mode was part of it)
+    """
+    try:
+        parsed = json.loads(stamp) if stamp is not None else None
+    except ValueError:
+        return None
+    return parsed[1] if isinstance(parsed, list) and len(parsed) > 1 else None
+
+
+def read_schema_stamp(engine: Engine) -> nullable(str):
+    """
+    :return: The stamp written by the last schema setup, None if there isn't one (e.g. on a brand new database).
+    Failing to connect isn't handled, since on Postgres it may mean that the database doesn't exist yet.
+    """
+    with engine.connect() as conn:
+        try:
+            return conn.scalar(select(SchemaMetaModel.value).where(SchemaMetaModel.key == SCHEMA_VERSION_KEY))
+        except exc.DBAPIError:
+            return None
+
+
+def write_schema_stamp(engine: Engine, stamp: str):
+    with engine.begin() as conn:
+        conn.execute(delete(SchemaMetaModel).where(SchemaMetaModel.key == SCHEMA_VERSION_KEY))
+        conn.execute(insert(SchemaMetaModel).values(key=SCHEMA_VERSION_KEY, value=stamp))
+
+
+def ensure_characteristic_indexes(engine: Engine, keys: list[str]) -> list[str]:
+    """
+    Indexes for filtering on `Product.characteristics`:
+     - Postgres: the column is converted to JSONB if it's still JSON, then gets a GIN (jsonb_path_ops) index which
+       serves equality and comparison filters on any key.
+     - SQLite: one expression index on `json_extract(characteristics, '$."key"')` for every configured key. Filters on
+       other keys still work, they just aren't indexed.
+
+    :return: The names of the created indexes
+    """
+    # the keys are spelled into the DDL
+    for key in keys:
+        check_characteristic_key(key)
+    created = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        existing = _index_names(conn, ProductModel.__tablename__)
+        if conn.dialect.name == DBEngineType.POSTGRESQL:
+            columns = {column["name"]: column for column in inspector.get_columns(ProductModel.__tablename__)}
+            if not isinstance(columns["characteristics"]["type"], JSONB):
+                conn.execute(text("ALTER TABLE products ALTER COLUMN characteristics TYPE jsonb "
+                                  "USING characteristics::jsonb"))
+            if CHARACTERISTICS_GIN_INDEX not in existing:
+                conn.execute(text(f"CREATE INDEX {CHARACTERISTICS_GIN_INDEX} ON products "
+                                  f"USING gin (characteristics jsonb_path_ops)"))
+                created.append(CHARACTERISTICS_GIN_INDEX)
+            return created
+
+        for key in keys:
+            name = characteristic_index_name(key)
+            if name not in existing:
+                # must be spelled like `characteristic_expression(key)` for SQLite to match it
+                conn.exec_driver_sql(
+                    f"CREATE INDEX {name} ON products (json_extract(characteristics, '{characteristic_path(key)}'))")
+                created.append(name)
+    return created
+
+
+def characteristic_index_name(key: str) -> str:
+    return "ix_products_characteristic_" + re.sub(r"\W", "_", key).lower()
+
+
+def explain(conn: Connection, statement: Select) -> list[str]:
+    """
+    :return: The query plan of the statement, one line per plan node
+    """
+    sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == DBEngineType.SQLITE:
+        return [row.detail for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    # Tiny tables are always scanned sequentially, so we only want to know whether an index *could* be used
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    return [row[0] for row in conn.execute(text(f"EXPLAIN {sql}"))]
+
+
+def is_full_scan(plan: list[str], table: str) -> bool:
+    """
+    Like `is_sequential_scan`, but an index walked from one end without a condition to seek with counts too, since it
+    reads every row in front of the ones wanted
+    """
+    if is_sequential_scan(plan, table):
+        return True
+    for idx, line in enumerate(plan):
+        # SQLite: "SCAN products USING INDEX ix_x" vs "SEARCH products USING INDEX ix_x (price>?)"
+        if line.strip().startswith(f"SCAN {table} "):
+            return True
+        # Postgres: the "Index Cond" lines follow their scan node, up to the next node
+        if re.search(rf"Index (Only )?Scan (Backward )?using \w+ on {table}\b", line):
+            details = itertools.takewhile(lambda detail: "->" not in detail, plan[idx + 1:])
+            if not any("Index Cond" in detail for detail in details):
+                return True
+    return False
+
+
+def is_sequential_scan(plan: list[str], table: str) -> bool:
+    for line in plan:
+        # SQLite: "SCAN products" vs "SEARCH products USING INDEX ..." / Postgres: "Seq Scan on products"
+        if line.strip() == f"SCAN {table}" or f"Seq Scan on {table}" in line:
+            return True
+    return False
+
+
+FULLTEXT_TABLE: const(str) = "products_fts"
+FULLTEXT_COLUMN: const(str) = "search_vector"
+
+_SQLITE_FULLTEXT_DDL: const(tuple[str, ...]) = (
+    f"""CREATE VIRTUAL TABLE {FULLTEXT_TABLE} USING fts5(
+        name, description, content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FULLTEXT_TABLE}_insert AFTER INSERT ON products BEGIN
+        INSERT INTO {FULLTEXT_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FULLTEXT_TABLE}_delete AFTER DELETE ON products BEGIN
+        INSERT INTO {FULLTEXT_TABLE}({FULLTEXT_TABLE}, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FULLTEXT_TABLE}_update AFTER UPDATE OF id, name, description ON products BEGIN
+        INSERT INTO {FULLTEXT_TABLE}({FULLTEXT_TABLE}, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO {FULLTEXT_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    # index the rows which existed before the table was created
+    f"INSERT INTO {FULLTEXT_TABLE}({FULLTEXT_TABLE}) VALUES ('rebuild')",
+)
+
+_POSTGRES_FULLTEXT_DDL: const(tuple[str, ...]) = (
+    f"""ALTER TABLE products ADD COLUMN {FULLTEXT_COLUMN} tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED""",
+    f"CREATE INDEX ix_products_{FULLTEXT_COLUMN} ON products USING gin ({FULLTEXT_COLUMN})",
+)
+
+
+def ensure_fulltext(engine: Engine) -> bool:
+    """
+    Create the full text index over name and description if it doesn't exist. Both versions are maintained by the
+    database itself on every insert, update and delete, whichever code path issues them:
+     - Postgres: a generated tsvector column with a GIN index
+     - SQLite: an external content FTS5 table kept in sync by triggers
+
+    :return: True if the index was created
+    """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        if conn.dialect.name == DBEngineType.POSTGRESQL:
+            if FULLTEXT_COLUMN in {column["name"] for column in inspector.get_columns(ProductModel.__tablename__)}:
+                return False
+            statements = _POSTGRES_FULLTEXT_DDL
+        else:
+            if inspector.has_table(FULLTEXT_TABLE):
+                return False
+            statements = _SQLITE_FULLTEXT_DDL
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+    return True
@@ -1,18 +1,59 @@
+import contextlib
+import datetime
+import io
+import json
 from decimal import Decimal
-from typing import Any
+from typing import Any, Iterable, Iterator
 
+from sqlalchemy import (Row, and_, case, column, delete, func, insert, literal, literal_column, or_, select, table, text,
+                        update)
 from sqlalchemy.orm import Session as SQLAlchemySession
 
+from src.core.category import CATEGORY_BITS, ProductCategory
 from src.core.product import Product
 from src.utils.logging.logger import Logger
-from src.db.models import Base, ProductModel
+from config import DBEngineType
+from src.db.filters import (SORTABLE_COLUMNS, CharacteristicPredicate, KeysetCursor, ProductFilters,
+                            postgres_characteristic_criteria, sqlite_characteristic_criteria)
+from src.db.models import (Base, ChangeOp, ProductModel, ProductCategoryBitModel, ProductChangeModel,
+                           SchemaMetaModel)
+from src.db.schema import CHANGES_PRUNED_KEY, FULLTEXT_COLUMN, FULLTEXT_TABLE, explain
+from src.db.timing import StatementTimer
+from src.utils.types import const, nullable
+
+# any constant works, it only has to be the same for every writer
+_CHANGE_LOG_LOCK: const(int) = 0x70726F64
+_COPY_STAGING_TABLE: const(str) = "products_copy_staging"
+_COPY_COLUMNS: const(tuple[str, ...]) = ("name", "category", "price", "description", "image_path", "producer",
+                                         "characteristics", "quantity")
+
+
+def _copy_text_field(value: Any) -> str:
+    """
+    A value in COPY's text format: NULL is \\N and backslashes, tabs and line breaks are escaped
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+            .replace("\r", "\\r"))
 
 
 class Session:
 
-    def __init__(self, session: SQLAlchemySession, logger: Logger):
+    def __init__(self, session: SQLAlchemySession, logger: Logger, category_bits: bool = False,
+                 statement_timer: nullable(StatementTimer) = None):
         self._logger: Logger = logger
         self._session: SQLAlchemySession = session
+        self._category_bits: bool = category_bits
+        # times the statements sent to the driver directly, the engine events already time the rest
+        self._statement_timer: nullable(StatementTimer) = statement_timer
+
+    def _timed(self, statement: str, cursor: Any) -> contextlib.AbstractContextManager:
+        if self._statement_timer is None:
+            return contextlib.nullcontext()
+        return self._statement_timer.timed(statement, cursor)
 
     def _insert(self, what: Base) -> int:
         """
@@ -23,46 +64,469 @@ class Session:
         self._logger.debug(f"Inserted {what.__class__.__name__} with ID: {what.id}")
         return what.id
 
+    @contextlib.contextmanager
+    def savepoint(self):
+        """
+        Run a block inside a SAVEPOINT. If the block fails, only its changes are rolled back and the outer transaction
+        stays usable.
+        """
+        with self._session.begin_nested():
+            yield
+
     def get_product(self, product_id: int) -> ProductModel | None:
         return self._session.query(ProductModel).filter_by(id=product_id).first()
 
-    def search_products(self, static_filters: dict[str, Any], category: int = None, min_price: Decimal = None,
-                        max_price: Decimal = None
-                        ):
-        query = self._session.query(ProductModel).filter_by(**static_filters)
-        if min_price is not None:
-            query = query.filter(ProductModel.price >= min_price)
-        if max_price is not None:
-            query = query.filter(ProductModel.price <= max_price)
-        if category is not None:
-            query = query.filter(ProductModel.category.op('&')(category) == category)
-        products = query.all()
-        return products
+    def get_product_version(self, product_id: int) -> nullable(Row):
+        """
+        :return: (version, updated_at) of the product, the row itself isn't loaded
+        """
+        return self._session.execute(select(ProductModel.version, ProductModel.updated_at)
+                                     .where(ProductModel.id == product_id)).first()
+
+    def get_products(self, product_ids: list[int]) -> list[ProductModel]:
+        """
+        The existing products among the given ids, in no particular order
+        """
+        return list(self._session.scalars(select(ProductModel).where(ProductModel.id.in_(product_ids))))
+
+    def _filter_criteria(self, filters: ProductFilters) -> list:
+        criteria = []
+        if filters.name is not None:
+            criteria.append(ProductModel.name == filters.name)
+        if filters.producer is not None:
+            criteria.append(ProductModel.producer == filters.producer)
+        if filters.min_price is not None:
+            criteria.append(ProductModel.price >= filters.min_price)
+        if filters.max_price is not None:
+            criteria.append(ProductModel.price <= filters.max_price)
+        if filters.category is not None:
+            criteria.extend(self._category_criteria(filters.category))
+        for predicate in filters.characteristics:
+            criteria.append(self._characteristic_criteria(predicate))
+        return criteria
+
+    def _characteristic_criteria(self, predicate: CharacteristicPredicate):
+        if self._session.get_bind().dialect.name == DBEngineType.POSTGRESQL:
+            return postgres_characteristic_criteria(predicate)
+        return sqlite_characteristic_criteria(predicate)
+
+    def _category_criteria(self, category: int) -> list:
+        if not self._category_bits:
+            return [ProductModel.category.op('&')(category) == category]
+        if not (bits := ProductCategory.set_bits(category)):
+            # `x & 0 == 0` holds for every non-null mask
+            return [ProductModel.category.is_not(None)]
+        return [
+            ProductModel.id.in_(select(ProductCategoryBitModel.product_id).where(ProductCategoryBitModel.bit == bit))
+            for bit in bits
+        ]
+
+    def _sync_category_bits(self, categories: dict[int, int | None], replace: bool = True):
+        """
+        Keep the category bits table in line with the given `product_id -> category` mapping. Does nothing unless
+        the `bits` category storage is used.
+        """
+        if not self._category_bits or not categories:
+            return
+        if replace:
+            self._delete_category_bits(list(categories))
+        rows = [
+            {"product_id": product_id, "bit": bit}
+            for product_id, category in categories.items() if category is not None
+            for bit in ProductCategory.set_bits(category)
+        ]
+        if rows:
+            self._session.execute(insert(ProductCategoryBitModel), rows)
+
+    def _delete_category_bits(self, product_ids: list[int]):
+        if self._category_bits:
+            self._session.execute(
+                delete(ProductCategoryBitModel).where(ProductCategoryBitModel.product_id.in_(product_ids)))
+
+    def rebuild_category_bits(self) -> int:
+        """
+        Re-create the category bits table from the `category` column with one INSERT ... SELECT per bit.
+        """
+        self._session.execute(delete(ProductCategoryBitModel))
+        inserted = 0
+        for bit in range(CATEGORY_BITS):
+            # the top bit is the sign bit of the BIGINT column
+            mask = 1 << bit if bit < CATEGORY_BITS - 1 else -(1 << bit)
+            source = select(ProductModel.id, literal(bit)).where(ProductModel.category.op('&')(mask) != 0)
+            result = self._session.execute(
+                insert(ProductCategoryBitModel).from_select(["product_id", "bit"], source))
+            inserted += result.rowcount
+        return inserted
+
+    def explain_search(self, filters: ProductFilters) -> list[str]:
+        """
+        :return: The query plan the database picks for a search with the given filters
+        """
+        statement = select(ProductModel).where(*self._filter_criteria(filters))
+        return explain(self._session.connection(), statement)
+
+    @staticmethod
+    def _keyset_criteria(column, descending: bool, cursor: KeysetCursor):
+        """
+        Rows strictly after the cursor position in (column, id) order, among the rows with a value in the column.
+        Spelled so the (column, id) index can seek to the position: the first condition bounds the index range and
+        the second only skips the ties already returned.
+        """
+        after_id = ProductModel.id < cursor.last_id if descending else ProductModel.id > cursor.last_id
+        if column is ProductModel.id:
+            return after_id
+        if descending:
+            return and_(column <= cursor.last_value, or_(column < cursor.last_value, after_id))
+        return and_(column >= cursor.last_value, or_(column > cursor.last_value, after_id))
+
+    @staticmethod
+    def _order_clauses(column, descending: bool) -> list:
+        if column is ProductModel.id:
+            return [ProductModel.id.desc() if descending else ProductModel.id]
+        if descending:
+            return [column.desc().nulls_last(), ProductModel.id.desc()]
+        return [column.asc().nulls_last(), ProductModel.id]
+
+    def _ordered_query(self, filters: ProductFilters, order_by: str, descending: bool):
+        column = SORTABLE_COLUMNS[order_by]
+        query = self._session.query(ProductModel).filter(*self._filter_criteria(filters))
+        return query.order_by(*self._order_clauses(column, descending)), column
+
+    def search_products(self, filters: ProductFilters) -> list[ProductModel]:
+        products, _ = self._ordered_query(filters, "id", False)
+        return products.all()
+
+    def search_products_page(self, filters: ProductFilters, order_by: str, descending: bool, limit: int,
+                             cursor: KeysetCursor = None) -> list[ProductModel]:
+        """
+        Return at most `limit` products following the cursor (or from the start when no cursor is given).
+
+        Orderings other than id are paged in two phases, each of them a seek into an index: first the rows with a
+        value in the sort column, in (column, id) order, then the ones where it's NULL, in id order. A cursor whose
+        `last_value` is None is in the second phase.
+        """
+        column = SORTABLE_COLUMNS[order_by]
+        products = []
+        if column is ProductModel.id or cursor is None or cursor.last_value is not None:
+            statement = self._page_statement(filters, column, descending, cursor)
+            products = list(self._session.scalars(statement.limit(limit)))
+            if column is ProductModel.id or len(products) == limit:
+                return products
+        # the NULL tail, from its start unless the cursor is already in it
+        after_id = None if cursor is None or cursor.last_value is not None else cursor.last_id
+        statement = self._null_tail_statement(filters, column, descending, after_id)
+        return products + list(self._session.scalars(statement.limit(limit - len(products))))
+
+    def _page_statement(self, filters: ProductFilters, column, descending: bool, cursor: nullable(KeysetCursor)):
+        id_order = ProductModel.id.desc() if descending else ProductModel.id
+        statement = select(ProductModel).where(*self._filter_criteria(filters))
+        if column is not ProductModel.id:
+            statement = statement.where(column.is_not(None)).order_by(column.desc() if descending else column)
+        if cursor is not None:
+            statement = statement.where(self._keyset_criteria(column, descending, cursor))
+        return statement.order_by(id_order)
+
+    def _null_tail_statement(self, filters: ProductFilters, column, descending: bool, after_id: nullable(int)):
+        statement = select(ProductModel).where(*self._filter_criteria(filters), column.is_(None))
+        if after_id is not None:
+            statement = statement.where(ProductModel.id < after_id if descending else ProductModel.id > after_id)
+        return statement.order_by(ProductModel.id.desc() if descending else ProductModel.id)
+
+    def explain_page(self, filters: ProductFilters, cursor: KeysetCursor, limit: int) -> list[str]:
+        """
+        :return: The query plan of the page following the cursor, before the NULL tail
+        """
+        statement = self._page_statement(filters, SORTABLE_COLUMNS[cursor.order_by], cursor.descending, cursor)
+        return explain(self._session.connection(), statement.limit(limit))
+
+    def iter_products(self, filters: ProductFilters, order_by: str, descending: bool,
+                      batch_size: int) -> Iterator[ProductModel]:
+        """
+        Stream matching products using a server side cursor, fetching `batch_size` rows at a time.
+        """
+        query, _ = self._ordered_query(filters, order_by, descending)
+        yield from query.yield_per(batch_size)
+
+    def search_product_rows(self, filters: ProductFilters, columns: tuple[str, ...], order_by: str,
+                            descending: bool, limit: int = None) -> list[Row]:
+        """
+        Core SELECT of only the given columns. Rows are returned as they come from the driver, without building ORM
+        objects or going through the identity map.
+        """
+        table = ProductModel.__table__
+        statement = (select(*(table.c[name] for name in columns))
+                     .where(*self._filter_criteria(filters))
+                     .order_by(*self._order_clauses(SORTABLE_COLUMNS[order_by], descending)))
+        if limit is not None:
+            statement = statement.limit(limit)
+        return list(self._session.connection().execute(statement))
+
+    def search_products_text(self, filters: ProductFilters, terms: list[str],
+                             limit: int) -> list[tuple[ProductModel, float]]:
+        """
+        Products matching any of the terms (as a word prefix) in their name or description, best match first. Matches
+        in the name weigh more than matches in the description. The score is only comparable within one search.
+        """
+        if self._session.get_bind().dialect.name == DBEngineType.POSTGRESQL:
+            vector = literal_column(f"{ProductModel.__tablename__}.{FULLTEXT_COLUMN}")
+            query = func.to_tsquery(literal_column("'simple'::regconfig"), " | ".join(f"{term}:*" for term in terms))
+            score = func.ts_rank_cd(vector, query)
+            statement = select(ProductModel, score).where(vector.op("@@")(query)).order_by(score.desc())
+        else:
+            fts = table(FULLTEXT_TABLE, column("rowid"))
+            match = " OR ".join(f'"{term}"*' for term in terms)
+            # bm25 is lower for better matches, the weights are for the name and description columns
+            rank = func.bm25(literal_column(FULLTEXT_TABLE), 10.0, 1.0)
+            statement = (select(ProductModel, -rank)
+                         .join(fts, fts.c.rowid == ProductModel.id)
+                         .where(literal_column(FULLTEXT_TABLE).op("MATCH")(match))
+                         .order_by(rank))
+        statement = statement.where(*self._filter_criteria(filters)).order_by(ProductModel.id).limit(limit)
+        return [(product, float(score)) for product, score in self._session.execute(statement)]
+
+    def facet_counts(self, filters: ProductFilters, categories: list[int], top_producers: int,
+                     price_boundaries: list[Decimal]) -> tuple[int, list[int], list[tuple[str, int]], list[int]]:
+        """
+        Aggregates over the products matching the filters, computed by the database in three statements:
+         - total and the count for every category (one SUM(CASE ...) per category, a single pass)
+         - the `top_producers` most common producers
+         - the count for every price bucket, bucket i holding prices below `price_boundaries[i]`
+
+        :return: (total, category counts, producers with their counts, bucket counts)
+        """
+        criteria = self._filter_criteria(filters)
+        category_counts = [
+            func.coalesce(func.sum(case((ProductModel.category.op('&')(category) == category, 1), else_=0)), 0)
+            for category in categories
+        ]
+        total, *counts = self._session.execute(select(func.count(), *category_counts).where(*criteria)).one()
+
+        producer_count = func.count().label("products")
+        producers = self._session.execute(
+            select(ProductModel.producer, producer_count)
+            .where(ProductModel.producer.is_not(None), *criteria)
+            .group_by(ProductModel.producer)
+            .order_by(producer_count.desc(), ProductModel.producer)
+            .limit(top_producers)
+        ).all()
+
+        bucket = case(*((ProductModel.price < boundary, idx) for idx, boundary in enumerate(price_boundaries)),
+                      else_=len(price_boundaries)).label("bucket")
+        buckets = [0] * (len(price_boundaries) + 1)
+        for idx, count in self._session.execute(
+                select(bucket, func.count()).where(ProductModel.price.is_not(None), *criteria).group_by(bucket)):
+            buckets[idx] = count
+        return total, counts, [(producer, count) for producer, count in producers], buckets
 
     def insert_product(self, product: ProductModel):
         product_id = self._insert(product)
+        self._sync_category_bits({product_id: product.category}, replace=False)
+        self._record_changes([product_id], ChangeOp.INSERT)
         self._logger.debug(f"Product {product.name} inserted with id {product_id}")
         return product_id
 
+    def insert_products(self, rows: list[dict[str, Any]]) -> list[int]:
+        """
+        Insert many rows with a single executemany statement. The generated IDs are returned in the same order as the
+        given rows (RETURNING on both Postgres and SQLite).
+        """
+        if not rows:
+            return []
+        result = self._session.execute(insert(ProductModel).returning(ProductModel.id, sort_by_parameter_order=True),
+                                       rows)
+        product_ids = list(result.scalars())
+        self._sync_category_bits({product_id: row["category"] for product_id, row in zip(product_ids, rows)},
+                                 replace=False)
+        self._record_changes(product_ids, ChangeOp.INSERT)
+        self._logger.debug(f"Inserted {len(product_ids)} products")
+        return product_ids
+
+    def copy_products(self, rows: list[dict[str, Any]]) -> list[int]:
+        """
+        Postgres only bulk insert through COPY, much faster than executemany for large batches. Rows are copied into a
+        temporary staging table and moved to products with one INSERT ... SELECT, so the category bits and the change
+        log are maintained like on every other write path. Either every row has an id or none has.
+
+        :return: The ids of the rows, in the given order
+        """
+        if not rows:
+            return []
+        explicit_ids = "id" in rows[0]
+        if any(("id" in row) != explicit_ids for row in rows):
+            raise ValueError("Either every copied row has an id or none has")
+        sequence = self._session.scalar(text("SELECT pg_get_serial_sequence('products', 'id')"))
+        # temporary tables are per connection, the id default numbers the rows in the order they're copied
+        self._session.execute(text(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {_COPY_STAGING_TABLE} ("
+            f"id bigint DEFAULT nextval('{sequence}'), name text, category bigint, price numeric, description text, "
+            f"image_path text, producer text, characteristics jsonb, quantity integer) ON COMMIT DELETE ROWS"))
+        self._session.execute(text(f"TRUNCATE {_COPY_STAGING_TABLE}"))
+
+        columns = (("id",) if explicit_ids else ()) + _COPY_COLUMNS
+        data = io.StringIO()
+        for row in rows:
+            data.write("\t".join(_copy_text_field(row.get(name)) for name in columns))
+            data.write("\n")
+        data.seek(0)
+        statement = f"COPY {_COPY_STAGING_TABLE} ({', '.join(columns)}) FROM STDIN"
+        cursor = self._session.connection().connection.cursor()
+        try:
+            with self._timed(statement, cursor):
+                cursor.copy_expert(statement, data)
+        finally:
+            cursor.close()
+
+        staged = self._session.execute(text(f"SELECT id, category FROM {_COPY_STAGING_TABLE} ORDER BY id")).all()
+        all_columns = ", ".join(("id",) + _COPY_COLUMNS)
+        # the version comes from the column's server default, the Python side default of updated_at doesn't apply here
+        self._session.execute(text(f"INSERT INTO products ({all_columns}, updated_at) "
+                                   f"SELECT {all_columns}, now() FROM {_COPY_STAGING_TABLE}"))
+        if explicit_ids:
+            # keep the sequence ahead of the ids which were set by hand
+            self._session.execute(text(f"SELECT setval('{sequence}', (SELECT max(id) FROM products))"))
+            product_ids = [row["id"] for row in rows]
+        else:
+            product_ids = [product_id for product_id, _ in staged]
+        self._sync_category_bits({product_id: category for product_id, category in staged}, replace=False)
+        self._record_changes(product_ids, ChangeOp.INSERT)
+        self._logger.debug(f"Copied {len(product_ids)} products")
+        return product_ids
+
     def delete_product(self, product_id: int) -> bool:
-        if product := self._session.query(ProductModel).filter_by(id=product_id).first():
-            self._session.delete(product)
-            self._session.commit()
-            return True
-        return False
-
-    def update_product(self, existing_product: ProductModel, product: Product) -> bool:
-        existing_product.name = product.name
-        existing_product.category = product.category
-        existing_product.price = product.price
-        existing_product.description = product.description
-        existing_product.image_path = product.image_path
-        existing_product.producer = product.producer
-        existing_product.characteristics = product.characteristics
-        existing_product.quantity = product.quantity
-        self._session.commit()
+        """
+        Single DELETE by id, the product is never loaded. Existence is reported from the affected row count.
+        """
+        self._delete_category_bits([product_id])
+        result = self._session.execute(delete(ProductModel).where(ProductModel.id == product_id),
+                                       execution_options={"synchronize_session": False})
+        if result.rowcount == 0:
+            return False
+        self._record_changes([product_id], ChangeOp.DELETE)
+        return True
+
+    def update_product(self, product: Product) -> bool:
+        """
+        Single UPDATE by id, the product is never loaded. Existence is reported from the affected row count.
+        """
+        values = product.to_db_row()
+        values.pop("id", None)
+        result = self._session.execute(update(ProductModel).where(ProductModel.id == product.id)
+                                       .values(**values, version=ProductModel.version + 1),
+                                       execution_options={"synchronize_session": False})
+        if result.rowcount == 0:
+            return False
+        self._sync_category_bits({product.id: product.category})
+        self._record_changes([product.id], ChangeOp.UPDATE)
+        return True
+
+    def adjust_stock(self, product_id: int, delta: int) -> bool:
+        """
+        Add `delta` to the quantity in a single conditional UPDATE, so concurrent adjustments never overwrite each
+        other. Taking stock (a negative delta) only succeeds if enough is left.
+
+        :return: False if the product doesn't exist, has no quantity or not enough of it
+        """
+        criteria = [ProductModel.id == product_id, ProductModel.quantity.is_not(None)]
+        if delta < 0:
+            criteria.append(ProductModel.quantity >= -delta)
+        result = self._session.execute(update(ProductModel).where(*criteria)
+                                       .values(quantity=ProductModel.quantity + delta, version=ProductModel.version + 1),
+                                       execution_options={"synchronize_session": False})
+        if result.rowcount == 0:
+            return False
+        self._record_changes([product_id], ChangeOp.UPDATE)
         return True
 
     def delete_all_products(self):
+        if self._category_bits:
+            self._session.query(ProductCategoryBitModel).delete()
         self._session.query(ProductModel).delete()
+        self._record_changes([None], ChangeOp.TRUNCATE)
+
+    def _record_changes(self, product_ids: Iterable[int | None], op: str):
+        """
+        Append to the change log, as part of the transaction doing the write
+        """
+        rows = [{"product_id": product_id, "op": op} for product_id in product_ids]
+        if not rows:
+            return
+        # seqs become visible in order thanks to `lock_change_log()`, taken when the transaction began
+        self._session.execute(insert(ProductChangeModel), rows)
+
+    def lock_change_log(self):
+        """
+        Postgres only, SQLite writers are serialized anyway. Sequence values are handed out at insert time, not at
+        commit, so without this a consumer could see seq 11 committed and move past it before seq 10 commits. The lock
+        is held until the transaction ends, which makes seqs become visible in order.
+
+        It must be the first statement of the writing transaction: taken after a row lock, it deadlocks with a
+        transaction which holds the lock and waits for that row.
+        """
+        if self._session.get_bind().dialect.name == DBEngineType.POSTGRESQL:
+            self._session.execute(select(func.pg_advisory_xact_lock(_CHANGE_LOG_LOCK)))
+
+    def changes_since(self, seq: int, limit: int) -> tuple[list[ProductChangeModel], int]:
+        """
+        :return: Up to `limit` changes with a seq above `seq` in seq order, and the highest seq removed by pruning
+        """
+        changes = list(self._session.scalars(select(ProductChangeModel).where(ProductChangeModel.seq > seq)
+                                             .order_by(ProductChangeModel.seq).limit(limit)))
+        return changes, self._pruned_through()
+
+    def last_change_seq(self) -> int:
+        # the log may have been pruned empty
+        return max(self._session.scalar(select(func.coalesce(func.max(ProductChangeModel.seq), 0))),
+                   self._pruned_through())
+
+    def last_change(self) -> tuple[int, nullable(datetime.datetime)]:
+        """
+        :return: The seq and time of the latest change. The time is None when the log was pruned empty.
+        """
+        latest = self._session.execute(select(ProductChangeModel.seq, ProductChangeModel.changed_at)
+                                       .order_by(ProductChangeModel.seq.desc()).limit(1)).first()
+        pruned_through = self._pruned_through()
+        if latest is None or latest.seq < pruned_through:
+            return pruned_through, None
+        return latest.seq, latest.changed_at
+
+    def _pruned_through(self) -> int:
+        value = self._session.scalar(select(SchemaMetaModel.value).where(SchemaMetaModel.key == CHANGES_PRUNED_KEY))
+        return int(value) if value is not None else 0
+
+    def prune_changes(self, older_than: datetime.datetime) -> int:
+        """
+        Delete the changes made before `older_than`. The highest deleted seq is remembered, so consumers which hadn't
+        read that far yet can be told that they missed changes.
+
+        :return: The number of deleted changes
+        """
+        through = self._session.scalar(select(func.max(ProductChangeModel.seq))
+                                       .where(ProductChangeModel.changed_at < older_than))
+        if through is None:
+            return 0
+        result = self._session.execute(delete(ProductChangeModel).where(ProductChangeModel.seq <= through))
+        self._session.execute(delete(SchemaMetaModel).where(SchemaMetaModel.key == CHANGES_PRUNED_KEY))
+        self._session.execute(insert(SchemaMetaModel).values(key=CHANGES_PRUNED_KEY,
+                                                             value=str(max(through, self._pruned_through()))))
+        return result.rowcount
+
+    def compact_changes(self) -> int:
+        """
+        Drop the changes superseded by a later one: earlier changes of the same product, and everything before the
+        last truncate. A consumer only needs to know that a product changed and then reads its current state, so this
+        never makes it miss anything.
+
+        :return: The number of deleted changes
+        """
+        deleted = 0
+        last_truncate = select(func.max(ProductChangeModel.seq)).where(ProductChangeModel.op == ChangeOp.TRUNCATE)
+        if (truncated_at := self._session.scalar(last_truncate)) is not None:
+            deleted += self._session.execute(delete(ProductChangeModel).where(ProductChangeModel.seq < truncated_at),
+                                             execution_options={"synchronize_session": False}).rowcount
+        later = ProductChangeModel.__table__.alias("later")
+        superseded = select(later.c.seq).where(later.c.product_id == ProductChangeModel.product_id,
+                                               later.c.seq > ProductChangeModel.seq).exists()
+        deleted += self._session.execute(delete(ProductChangeModel).where(superseded),
+                                         execution_options={"synchronize_session": False}).rowcount
+        return deleted
 
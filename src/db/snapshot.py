@@ -0,0 +1,272 @@
+import bisect
+import threading
+import time
+from array import array
+from decimal import Decimal
+from operator import itemgetter
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from src.core.category import ProductCategory, CATEGORY_BITS
+from src.core.product import Product
+from src.db.filters import ProductFilters
+from src.db.models import ChangeOp
+from src.utils.types import const, nullable
+
+if TYPE_CHECKING:
+    from src.db.connection import Database
+
+# positions of the set bits of every byte value
+_BYTE_BITS: const(tuple[tuple[int, ...], ...]) = tuple(tuple(bit for bit in range(8) if value >> bit & 1)
+                                                        for value in range(256))
+_NO_PRODUCER: const(int) = -1
+_CHANGE_BATCH_SIZE: const(int) = 1000
+
+
+def _bitset(rows: Iterable[int], size: int) -> int:
+    """
+    Bitset with the given row positions set. Built through a bytearray, since setting bits one by one on an int copies
+    the whole int every time.
+    """
+    data = bytearray((size + 7) // 8)
+    for row in rows:
+        data[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(data, "little")
+
+
+def _rows_of(bits: int) -> Iterator[int]:
+    """
+    Positions of the set bits, in increasing order
+    """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for idx, byte in enumerate(data):
+        if byte:
+            offset = idx << 3
+            for bit in _BYTE_BITS[byte]:
+                yield offset + bit
+
+
+class CatalogSnapshot:
+    """
+    In-process copy of the products table answering `search_products` filters without SQL. Every product has a row
+    position; the filterable values are kept in columns (category mask, interned producer id) and posting sets, and
+    every filter is turned into a bitset over the rows (a Python int), so combining filters is one big-int AND per
+    filter instead of a loop over the products:
+     - category: one bitset per category bit, `category & mask == mask` is the AND of the bitsets of the mask's bits
+     - producer and name: row sets by value
+     - price: (price, row) pairs sorted by price, a range is found by bisection
+
+    Characteristic filters aren't supported, those searches stay in SQL.
+
+    The snapshot is loaded on first use and kept up to date from the product change log: `mark_dirty()` (called after
+    local writes) makes the next search catch up first, and writes made by other processes are picked up when the last
+    check is older than `refresh_interval_s`.
+    """
+
+    def __init__(self, db: 'Database', refresh_interval_s: float, clock: Callable[[], float] = time.monotonic):
+        self._db: 'Database' = db
+        self._refresh_interval_s: float = refresh_interval_s
+        self._clock: Callable[[], float] = clock
+        self._lock: threading.RLock = threading.RLock()
+        self._loaded: bool = False
+        self._dirty: bool = True
+        self._checked_at: float = float("-inf")
+        self._last_seq: int = 0
+        self._clear()
+
+    def _clear(self):
+        self._products: list[nullable(Product)] = []  # None once deleted
+        self._ids: array = array("q")
+        self._rows: dict[int, int] = {}
+        self._categories: array = array("q")
+        self._producers: array = array("l")
+        self._producer_ids: dict[str, int] = {}
+        self._by_producer: dict[int, set[int]] = {}
+        self._by_name: dict[str, set[int]] = {}
+        self._prices: list[tuple[Decimal, int]] = []
+        self._category_bits: list[int] = [0] * CATEGORY_BITS
+        self._has_category: int = 0
+        self._alive: int = 0
+        self._in_id_order: bool = True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    @property
+    def last_seq(self) -> int:
+        """
+        The change log position the snapshot is up to date with
+        """
+        return self._last_seq
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def search(self, filters: ProductFilters) -> list[Product]:
+        """
+        Same result as `Database.search_products` for these filters: matching products ordered by id
+        """
+        with self._lock:
+            return [self._products[row].copy() for row in self._search_rows(filters)]
+
+    def search_ids(self, filters: ProductFilters) -> list[int]:
+        with self._lock:
+            return [self._ids[row] for row in self._search_rows(filters)]
+
+    def _search_rows(self, filters: ProductFilters) -> list[int]:
+        if filters.characteristics:
+            raise ValueError("The catalog snapshot cannot filter on characteristics")
+        self._ensure_fresh()
+        filters = filters.normalized()
+        size = len(self._products)
+        mask = self._alive
+        if filters.name is not None:
+            mask &= _bitset(self._by_name.get(filters.name, ()), size)
+        if filters.producer is not None:
+            mask &= _bitset(self._by_producer.get(self._producer_ids.get(filters.producer), ()), size)
+        if filters.min_price is not None or filters.max_price is not None:
+            lower = 0 if filters.min_price is None else \
+                bisect.bisect_left(self._prices, filters.min_price, key=itemgetter(0))
+            upper = len(self._prices) if filters.max_price is None else \
+                bisect.bisect_right(self._prices, filters.max_price, key=itemgetter(0))
+            mask &= _bitset((row for _, row in self._prices[lower:upper]), size)
+        if filters.category is not None:
+            if not (bits := ProductCategory.set_bits(filters.category)):
+                # `x & 0 == 0` holds for every non-null mask
+                mask &= self._has_category
+            for bit in bits:
+                mask &= self._category_bits[bit]
+
+        rows = list(_rows_of(mask))
+        if not self._in_id_order:
+            rows.sort(key=self._ids.__getitem__)
+        return rows
+
+    def _ensure_fresh(self):
+        if not self._loaded:
+            self.reload()
+        elif self._dirty or self._clock() - self._checked_at >= self._refresh_interval_s:
+            self.refresh()
+
+    def reload(self):
+        """
+        Load every product from scratch
+        """
+        with self._lock, self._db.primary_only():
+            self._dirty = False
+            self._checked_at = self._clock()
+            # anything committed after this seq is applied again by the next refresh, which is harmless
+            last_seq = self._db.last_change_seq()
+            self._clear()
+            products = list(self._db.iter_products())
+            size = len(products)
+            category_rows: list[list[int]] = [[] for _ in range(CATEGORY_BITS)]
+            has_category = []
+            for product in products:
+                row = self._append(product, bulk=True)
+                if product.category is not None:
+                    has_category.append(row)
+                    for bit in ProductCategory.set_bits(product.category):
+                        category_rows[bit].append(row)
+            self._prices.sort()
+            self._category_bits = [_bitset(rows, size) for rows in category_rows]
+            self._has_category = _bitset(has_category, size)
+            self._alive = (1 << size) - 1
+            self._last_seq = last_seq
+            self._loaded = True
+
+    def refresh(self):
+        """
+        Apply the changes committed since the last refresh. Falls back to a full reload when the change log was pruned
+        past our position, after a truncate or when too much changed.
+        """
+        with self._lock, self._db.primary_only():
+            self._dirty = False
+            self._checked_at = self._clock()
+            while True:
+                batch = self._db.changes_since(self._last_seq, limit=_CHANGE_BATCH_SIZE)
+                if batch.reset_required or len(batch.changes) >= _CHANGE_BATCH_SIZE or \
+                        any(change.op == ChangeOp.TRUNCATE for change in batch.changes):
+                    self.reload()
+                    return
+                if not batch.changes:
+                    return
+                self._apply({change.product_id for change in batch.changes})
+                self._last_seq = batch.last_seq
+
+    def _apply(self, product_ids: set[int]):
+        with self._db.in_session(read_only=True) as session:
+            current = {model.id: Product.from_db_model(model) for model in session.get_products(list(product_ids))}
+        for product_id in sorted(product_ids):
+            row = self._rows.get(product_id)
+            product = current.get(product_id)
+            if row is not None:
+                self._unindex(row)
+                if product is None:
+                    # the slot stays behind as a tombstone
+                    del self._rows[product_id]
+                    self._products[row] = None
+                    continue
+            elif product is None:
+                continue
+            else:
+                row = self._append(product)
+            self._products[row] = product
+            self._index(row, product)
+        if len(self._products) > 2 * len(self._rows) + _CHANGE_BATCH_SIZE:
+            # mostly tombstones
+            self.reload()
+
+    def _append(self, product: Product, bulk: bool = False) -> int:
+        """
+        Give the product a new row at the end of the columns. Only the postings are filled when loading in `bulk`, the
+        caller builds the bitsets and sorts the prices afterwards.
+        """
+        row = len(self._products)
+        if self._ids and product.id < self._ids[-1]:
+            self._in_id_order = False
+        self._products.append(product)
+        self._ids.append(product.id)
+        self._rows[product.id] = row
+        self._categories.append(0)
+        self._producers.append(_NO_PRODUCER)
+        if bulk:
+            self._index_postings(row, product)
+            if product.price is not None:
+                self._prices.append((product.price, row))
+        return row
+
+    def _index_postings(self, row: int, product: Product):
+        self._categories[row] = product.category or 0
+        if product.producer is not None:
+            producer = self._producer_ids.setdefault(product.producer, len(self._producer_ids))
+            self._by_producer.setdefault(producer, set()).add(row)
+            self._producers[row] = producer
+        if product.name is not None:
+            self._by_name.setdefault(product.name, set()).add(row)
+
+    def _index(self, row: int, product: Product):
+        self._index_postings(row, product)
+        if product.price is not None:
+            bisect.insort(self._prices, (product.price, row))
+        bit = 1 << row
+        if product.category is not None:
+            self._has_category |= bit
+            for category_bit in ProductCategory.set_bits(product.category):
+                self._category_bits[category_bit] |= bit
+        self._alive |= bit
+
+    def _unindex(self, row: int):
+        product = self._products[row]
+        clear = ~(1 << row)
+        self._alive &= clear
+        self._has_category &= clear
+        for bit in ProductCategory.set_bits(self._categories[row]):
+            self._category_bits[bit] &= clear
+        if (producer := self._producers[row]) != _NO_PRODUCER:
+            self._by_producer[producer].discard(row)
+            self._producers[row] = _NO_PRODUCER
+        if product.name is not None:
+            self._by_name[product.name].discard(row)
+        if product.price is not None:
+            del self._prices[bisect.bisect_left(self._prices, (product.price, row))]
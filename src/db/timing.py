@@ -0,0 +1,143 @@
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Iterator
+
+from sqlalchemy import Engine, event
+
+from src.context import ThreadLocalContextTable
+from src.utils.logging.logger import Logger
+from src.utils.types import const, nullable
+
+QUERY_STATS_KEY: const(str) = "db_query_stats"
+_STATEMENT_LOG_LENGTH: const(int) = 500
+_START_ATTRIBUTE: const(str) = "_bookshop_statement_start"
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(statement: str) -> str:
+    """
+    The statement with literals and parameters replaced by `?` and IN lists collapsed, so every execution of the same
+    query looks the same whatever the values or the number of ids
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    return _IN_LISTS.sub("(?...)", statement)
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    return hashlib.sha1(normalize_statement(statement).encode()).hexdigest()[:12]
+
+
+@dataclasses.dataclass(repr=True)
+class QueryStats:
+    """
+    SQL executed while handling one request. `total_s` is the time spent executing statements; fetching the rows and
+    building objects out of them comes on top of it.
+    """
+    count: int = 0
+    total_s: float = 0.0
+    slow: int = 0
+    # statement fingerprint -> executions, many executions of one fingerprint usually means an N+1 pattern
+    statements: Counter = dataclasses.field(default_factory=Counter)
+    # background threads started by the request share the stats
+    _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, statement_fingerprint: str, duration_s: float, slow: bool):
+        with self._lock:
+            self.count += 1
+            self.total_s += duration_s
+            self.slow += slow
+            self.statements[statement_fingerprint] += 1
+
+    def most_repeated(self, n: int = 5) -> list[tuple[str, int]]:
+        with self._lock:
+            return self.statements.most_common(n)
+
+
+@contextlib.contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """
+    Count the statements executed by the current thread (and the ContextThreads it starts) inside the block:
+
+        with track_queries() as stats:
+            handle_request()
+        logger.info(f"{stats.count} queries in {stats.total_s * 1000:.1f} ms")
+
+    Nested blocks share the stats of the outermost one.
+    """
+    if (stats := current_query_stats()) is not None:
+        yield stats
+        return
+    stats = QueryStats()
+    with ThreadLocalContextTable().in_context(**{QUERY_STATS_KEY: stats}):
+        yield stats
+
+
+def current_query_stats() -> nullable(QueryStats):
+    return ThreadLocalContextTable().get(QUERY_STATS_KEY)
+
+
+class StatementTimer:
+    """
+    Times every statement executed through the engines it's attached to. Statements slower than the threshold are
+    logged as warnings, and every statement is counted in the `QueryStats` of the current request, if any.
+    """
+
+    def __init__(self, logger: Logger, slow_threshold_ms: nullable(float)):
+        self._logger: Logger = logger
+        self._slow_threshold_s: nullable(float) = slow_threshold_ms / 1000 if slow_threshold_ms is not None else None
+
+    def attach(self, engine: Engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    @staticmethod
+    def _before(conn, cursor, statement: str, parameters: Any, context, executemany: bool):
+        if context is not None:
+            setattr(context, _START_ATTRIBUTE, time.perf_counter())
+
+    def _after(self, conn, cursor, statement: str, parameters: Any, context, executemany: bool):
+        if context is None or (start := getattr(context, _START_ATTRIBUTE, None)) is None:
+            return
+        self._record(statement, time.perf_counter() - start, cursor, executemany)
+
+    @contextlib.contextmanager
+    def timed(self, statement: str, cursor: Any = None) -> Iterator[None]:
+        """
+        Time a statement sent straight to the driver, which the engine events never see (e.g. COPY):
+
+            with timer.timed(statement, cursor):
+                cursor.copy_expert(statement, data)
+
+        :param cursor: The DBAPI cursor the statement runs on, for the row count of slow statements
+        """
+        start = time.perf_counter()
+        yield
+        self._record(statement, time.perf_counter() - start, cursor, executemany=False)
+
+    def _record(self, statement: str, duration_s: float, cursor: Any, executemany: bool):
+        slow = self._slow_threshold_s is not None and duration_s >= self._slow_threshold_s
+        stats = current_query_stats()
+        if stats is None and not slow:
+            return
+        statement_fingerprint = fingerprint(statement)
+        if stats is not None:
+            stats.record(statement_fingerprint, duration_s, slow)
+        if slow:
+            # SELECT row counts are only known after fetching on some drivers, they report -1
+            rowcount = getattr(cursor, "rowcount", -1)
+            self._logger.warning(f"Slow query took {duration_s * 1000:.1f} ms: "
+                                 f"{normalize_statement(statement)[:_STATEMENT_LOG_LENGTH]}",
+                                 fingerprint=statement_fingerprint, duration_ms=round(duration_s * 1000, 3),
+                                 rows=rowcount if rowcount >= 0 else None, executemany=executemany)
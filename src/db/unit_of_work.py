@@ -0,0 +1,45 @@
+import threading
+from typing import Iterable
+
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from src.db.session import Session
+from src.utils.types import nullable
+
+
+class UnitOfWork:
+    """
+    The session shared by every `Database` call a thread makes inside `Database.unit_of_work()`. It also collects the
+    products written through it, their caches are only invalidated once the transaction commits.
+
+    It's found through the thread's context table, which ContextThreads copy; only the thread which opened it joins
+    it, a session can't be used by two threads at once. Reads only join it once a write has (`pinned`), before that
+    they're routed like outside of a unit, so a unit which never writes can still be served by the replicas.
+    """
+
+    def __init__(self, raw_session: SQLAlchemySession, session: Session):
+        self.raw_session: SQLAlchemySession = raw_session
+        self.session: Session = session
+        self._thread_id: int = threading.get_ident()
+        self._changed: set[int] = set()
+        self._changed_all: bool = False
+        self.written: bool = False
+        # a write joined the session, later reads must see it
+        self.pinned: bool = False
+
+    def owned_by_current_thread(self) -> bool:
+        return threading.get_ident() == self._thread_id
+
+    def products_changed(self, product_ids: nullable(Iterable[int])):
+        self.written = True
+        if product_ids is None:
+            self._changed_all = True
+        elif not self._changed_all:
+            self._changed.update(product_ids)
+
+    @property
+    def changed_products(self) -> nullable(list[int]):
+        """
+        Ids of the written products, None if every product may have changed
+        """
+        return None if self._changed_all else sorted(self._changed)
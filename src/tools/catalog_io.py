@@ -0,0 +1,258 @@
+"""
+Bulk import and export of the products table as CSV or JSONL.
+
+    python -m src.tools.catalog_io import products.csv
+    python -m src.tools.catalog_io export products.jsonl --category 128
+
+Both directions stream: the input is read, validated and written `--chunk-size` rows at a time and the export is read
+from a server side cursor, so memory use doesn't depend on the size of the catalog. Parsing and validation of large
+inputs runs in a process pool. Use `-` as the file for stdin / stdout.
+"""
+import argparse
+import contextlib
+import csv
+import dataclasses
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+from typing import IO, Iterable, Iterator
+
+from config import Config, LoggingConfig
+from src.core.product import Product
+from src.db.connection import Database
+from src.utils.logging import level
+from src.utils.logging.logger import Logger
+from src.utils.types import const
+
+CSV: const(str) = "csv"
+JSONL: const(str) = "jsonl"
+FORMATS: const(tuple[str, ...]) = (CSV, JSONL)
+FIELDS: const(tuple[str, ...]) = ("id", "name", "category", "price", "description", "image_path", "producer",
+                                  "characteristics", "quantity")
+DEFAULT_CHUNK_SIZE: const(int) = 5000
+# smaller inputs are parsed in process, starting the pool would cost more than it saves
+POOL_MIN_BYTES: const(int) = 8 * 1024 * 1024
+_LOGGED_ERRORS: const(int) = 100
+
+
+@dataclasses.dataclass(repr=True)
+class RowError:
+    # 1 based position of the record in the input, the CSV header not counted
+    record: int
+    error: str
+
+
+@dataclasses.dataclass(repr=True)
+class TransferReport:
+    rows: int = 0
+    seconds: float = 0.0
+    errors: list[RowError] = dataclasses.field(default_factory=list)
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def format_of(path: str, fmt: str = None) -> str:
+    fmt = fmt or Path(path).suffix.lstrip(".").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS} (use --format)")
+    return fmt
+
+
+def _records(stream: IO[str], fmt: str) -> Iterator[str]:
+    """
+    Raw text of every record. A CSV record can span lines when a quoted field contains a line break; it's complete
+    once the number of quotes is even, since escaped quotes are doubled.
+    """
+    pending, quotes = "", 0
+    for line in stream:
+        pending += line
+        if fmt == CSV:
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+        if pending.strip():
+            yield pending
+        pending, quotes = "", 0
+    if pending.strip():
+        yield pending
+
+
+def _chunks(records: Iterator[str], size: int) -> Iterator[tuple[int, list[str]]]:
+    """
+    :return: (number of the first record, records) for every chunk
+    """
+    chunk, first = [], 1
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield first, chunk
+            first += len(chunk)
+            chunk = []
+    if chunk:
+        yield first, chunk
+
+
+def parse_chunk(fmt: str, header: list[str], first: int, records: list[str],
+                keep_ids: bool) -> tuple[list[Product], list[int], list[RowError]]:
+    """
+    Turn raw records into validated products. Runs in the worker processes, so it only gets and returns picklable
+    values.
+
+    :return: The valid products, their record numbers and the errors of the invalid ones
+    """
+    products, numbers, errors = [], [], []
+    if fmt == CSV:
+        data = csv.DictReader(io.StringIO("".join(records)), fieldnames=header)
+    else:
+        data = iter(records)
+    for number, record in enumerate(data, start=first):
+        try:
+            if fmt == JSONL:
+                record = json.loads(record)
+                if not isinstance(record, dict):
+                    raise ValueError("every line must be a JSON object")
+            products.append(Product.from_dict(record, keep_id=keep_ids))
+            numbers.append(number)
+        except ValueError as exc:
+            errors.append(RowError(record=number, error=str(exc)))
+    return products, numbers, errors
+
+
+def _parsed(chunks: Iterable[tuple[int, list[str]]], fmt: str, header: list[str], keep_ids: bool,
+            workers: int) -> Iterator[tuple[list[Product], list[int], list[RowError]]]:
+    """
+    Parse chunks in order, in a pool of `workers` processes if there's more than one. At most two chunks per worker are
+    in flight, so a fast reader can't pile up the whole input in memory.
+    """
+    if workers <= 1:
+        for first, records in chunks:
+            yield parse_chunk(fmt, header, first, records, keep_ids)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for first, records in chunks:
+            pending.append(pool.submit(parse_chunk, fmt, header, first, records, keep_ids))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_catalog(db: Database, stream: IO[str], fmt: str, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 1,
+                   keep_ids: bool = False) -> TransferReport:
+    """
+    Load products from a CSV (with a header row) or JSONL stream. Invalid records are reported and skipped, every
+    chunk of valid ones is written with `Database.copy_products` in its own transaction.
+
+    :param keep_ids: Use the ids found in the input instead of letting the database assign new ones
+    """
+    report = TransferReport()
+    start = time.perf_counter()
+    header = []
+    records = _records(stream, fmt)
+    if fmt == CSV:
+        header = next(csv.reader([next(records, "")]), [])
+        if "name" not in header:
+            raise ValueError(f"The CSV header must name the columns, expected some of {FIELDS}")
+
+    for products, numbers, errors in _parsed(_chunks(records, chunk_size), fmt, header, keep_ids, workers):
+        report.errors.extend(errors)
+        result = db.copy_products(products)
+        report.rows += len(result.inserted)
+        report.errors.extend(RowError(record=numbers[failed.index], error=failed.error) for failed in result.failed)
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def _csv_value(value):
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+def export_catalog(db: Database, stream: IO[str], fmt: str, batch_size: int = DEFAULT_CHUNK_SIZE,
+                   **filters) -> TransferReport:
+    """
+    Write every product matching the `search_products` style filters, in id order. Products are streamed from the
+    database and written one by one, none of them is kept around.
+    """
+    report = TransferReport()
+    start = time.perf_counter()
+    writer = None
+    if fmt == CSV:
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+    for product in db.iter_products(batch_size=batch_size, **filters):
+        # the row version is the database's own bookkeeping, an import assigns new ones
+        data = product.to_dict()
+        data = {field: data[field] for field in FIELDS}
+        if writer is not None:
+            writer.writerow({field: _csv_value(value) for field, value in data.items()})
+        else:
+            stream.write(json.dumps(data))
+            stream.write("\n")
+        report.rows += 1
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    # newline="" as the csv module wants, JSONL doesn't care
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def _workers(path: str, requested: int = None) -> int:
+    if requested is not None:
+        return requested
+    if path == "-" or os.path.getsize(path) < POOL_MIN_BYTES:
+        return 1
+    return os.cpu_count() or 1
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("direction", choices=("import", "export"))
+    parser.add_argument("file", help="CSV or JSONL file, - for stdin / stdout")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to the file extension")
+    parser.add_argument("--config", default="config.json", type=Path)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, help="parser processes, by default one per CPU for large files")
+    parser.add_argument("--keep-ids", action="store_true", help="import: keep the ids found in the input")
+    parser.add_argument("--category", type=int, help="export: only products in all of these categories")
+    parser.add_argument("--producer", help="export: only products of this producer")
+    parser.add_argument("--min-price", type=Decimal)
+    parser.add_argument("--max-price", type=Decimal)
+    args = parser.parse_args(argv)
+
+    cfg = Config.from_file(args.config)
+    logger = Logger.from_config("CATALOG_IO", cfg.logging or LoggingConfig(log_level=level.INFO, log_to_file=False))
+    db = Database(cfg.database, logger.clone("DB"))
+    fmt = format_of(args.file, args.format)
+
+    if args.direction == "import":
+        with _open(args.file, "r") as stream:
+            report = import_catalog(db, stream, fmt, chunk_size=args.chunk_size,
+                                    workers=_workers(args.file, args.workers), keep_ids=args.keep_ids)
+        for error in report.errors[:_LOGGED_ERRORS]:
+            logger.warning(f"Skipped record {error.record}: {error.error}")
+        summary = f"Imported {report.rows} products, skipped {len(report.errors)}"
+    else:
+        with _open(args.file, "w") as stream:
+            report = export_catalog(db, stream, fmt, batch_size=args.chunk_size, category=args.category,
+                                    producer=args.producer, min_price=args.min_price, max_price=args.max_price)
+        summary = f"Exported {report.rows} products"
+    logger.info(f"{summary} in {report.seconds:.1f} s ({report.rows_per_s:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
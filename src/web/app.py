@@ -0,0 +1,76 @@
+import contextlib
+
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.exceptions import HTTPException, InternalServerError
+
+from src.db.connection import Database
+from src.db.timing import track_queries
+from src.utils.logging.logger import Logger
+from src.web.products import products
+from src.utils.types import const
+from src.web.state import DATABASE_EXTENSION, LOGGER_EXTENSION, database, logger
+
+# requests which run in a unit of work
+WRITE_METHODS: const(frozenset[str]) = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+
+
+def create_app(db: Database, app_logger: Logger) -> Flask:
+    """
+    The product HTTP API. Every writing request runs in one `Database.unit_of_work()`, committed before the response
+    is sent; reads run without one, so they can be served by the replicas. The SQL every request executes is counted
+    with `track_queries()`.
+    """
+    app = Flask(__name__)
+    app.extensions[DATABASE_EXTENSION] = db
+    app.extensions[LOGGER_EXTENSION] = app_logger
+    app.register_blueprint(products)
+    app.before_request(_begin_request)
+    app.after_request(_commit_request)
+    app.teardown_request(_end_request)
+    app.register_error_handler(HTTPException, _http_error)
+    return app
+
+
+def _begin_request():
+    queries = contextlib.ExitStack()
+    g.query_stats = queries.enter_context(track_queries())
+    g.queries = queries
+    if request.method not in WRITE_METHODS:
+        return
+    unit = contextlib.ExitStack()
+    unit.enter_context(database().unit_of_work())
+    g.unit_of_work = unit
+
+
+def _commit_request(response: Response) -> Response:
+    if (unit := g.pop("unit_of_work", None)) is None:
+        return response
+    if response.status_code >= 500:
+        # Flask turned an error raised by the view into this response, nothing it wrote may be kept
+        error = InternalServerError()
+        unit.__exit__(type(error), error, None)
+    else:
+        # a failed commit raises here, before anything was sent, and the client gets a 500 instead
+        unit.close()
+    return response
+
+
+def _end_request(exc: BaseException = None):
+    """
+    Runs once the response is sent, for streamed responses after the last chunk
+    """
+    if (unit := g.pop("unit_of_work", None)) is not None:
+        # the request failed before `_commit_request`
+        if exc is None:
+            unit.close()
+        else:
+            unit.__exit__(type(exc), exc, exc.__traceback__)
+    if (queries := g.pop("queries", None)) is not None:
+        queries.close()
+        stats = g.pop("query_stats")
+        logger().debug(f"{request.method} {request.path}: {stats.count} queries in {stats.total_s * 1000:.1f} ms",
+                       queries=stats.count, slow_queries=stats.slow)
+
+
+def _http_error(error: HTTPException):
+    return jsonify(error=error.description), error.code
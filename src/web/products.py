@@ -0,0 +1,206 @@
+import datetime
+import json
+from decimal import Decimal, InvalidOperation
+from typing import Any, Iterator
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context, url_for
+
+from src.core.product import Product
+from src.db.cache import ProductPayload
+from src.db.filters import SORTABLE_COLUMNS
+from src.utils.types import const, nullable
+from src.web.state import database
+
+# ids accepted by one batch lookup
+MAX_BATCH_IDS: const(int) = 500
+# smaller bodies are sent uncompressed, gzip would barely shrink them
+GZIP_MIN_BYTES: const(int) = 1024
+_EPOCH: const(datetime.datetime) = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+products = Blueprint("products", __name__, url_prefix="/products")
+
+
+@products.get("/<int:product_id>")
+def get_product(product_id: int):
+    """
+    Conditional requests are answered from the product's version alone, a 304 never loads or serializes the product.
+    The body is the product's cached payload, gzip compressed if the client accepts it and it's large enough.
+    """
+    db = database()
+    if _is_conditional():
+        if (version := db.get_product_version(product_id)) is None:
+            abort(404, f"No product with id {product_id}")
+        etags = _product_etags(product_id, version.version, version.updated_at)
+        if (etag := _not_modified(etags, version.updated_at)) is not None:
+            return _not_modified_response(etag, version.updated_at)
+    if (payload := db.get_product_payload(product_id)) is None:
+        abort(404, f"No product with id {product_id}")
+    return _payload_response(payload)
+
+
+@products.get("/batch")
+def get_products():
+    """
+    Many products by id in one request, `?ids=3,1,2`. The products come back in the requested order, ids with no
+    product are listed under "missing" and get a null in their place.
+    """
+    raw_ids = request.args.get("ids", "")
+    try:
+        product_ids = [int(product_id) for product_id in raw_ids.split(",") if product_id.strip()]
+    except ValueError:
+        abort(400, f"ids must be a comma separated list of integers, got {raw_ids!r}")
+    if not 0 < len(product_ids) <= MAX_BATCH_IDS:
+        abort(400, f"Between 1 and {MAX_BATCH_IDS} ids are required, got {len(product_ids)}")
+    found = database().get_products(product_ids)
+    return jsonify(products=[product.to_dict() if product is not None else None for product in found],
+                   missing=[product_id for product_id, product in zip(product_ids, found) if product is None])
+
+
+@products.get("")
+def search_products():
+    """
+    Every product matching the query string filters, as a JSON array streamed one product at a time: the first rows
+    are sent while the rest are still being read, and the result is never held in memory as a whole. A database error
+    in the middle of the stream can only cut the array short, the status has been sent by then.
+    """
+    # the version is read on the node streaming the products, right before them, so a write landing in between makes
+    # the next request miss rather than hit
+    catalog, product_iter = database().iter_products_versioned(**_search_filters())
+    etag = f"catalog-{catalog.seq}"
+    if _not_modified((etag,), catalog.changed_at) is not None:
+        product_iter.close()
+        return _not_modified_response(etag, catalog.changed_at)
+    response = Response(stream_with_context(_json_array(product_iter)), mimetype="application/json")
+    _set_validators(response, etag, catalog.changed_at)
+    return response
+
+
+@products.post("")
+def create_product():
+    product = _product_from_body()
+    db = database()
+    if not db.insert_product(product):
+        abort(500, "Could not create the product")
+    # read back for the version and time the database gave it
+    response = _payload_response(db.get_product_payload(product.id))
+    response.status_code = 201
+    response.headers["Location"] = url_for("products.get_product", product_id=product.id)
+    return response
+
+
+@products.put("/<int:product_id>")
+def update_product(product_id: int):
+    product = _product_from_body()
+    product.id = product_id
+    db = database()
+    # a missing product matches no row, no need to look it up first
+    if not db.update_product(product):
+        abort(404, f"No product with id {product_id}")
+    return _payload_response(db.get_product_payload(product_id))
+
+
+@products.delete("/<int:product_id>")
+def delete_product(product_id: int):
+    if not database().delete_product(product_id):
+        abort(404, f"No product with id {product_id}")
+    return "", 204
+
+
+def _product_etags(product_id: int, version: int, updated_at: nullable(datetime.datetime)) -> tuple[str, str]:
+    """
+    ETags of the plain and of the gzip compressed body. A strong ETag names exact bytes, so they must differ.
+    Ids are reused and the version starts over when a product is deleted and inserted again, the time of the last
+    write tells those products apart.
+    """
+    written = (updated_at - _EPOCH) // datetime.timedelta(microseconds=1) if updated_at is not None else 0
+    etag = f"{product_id}-{version}-{written:x}"
+    return etag, f"{etag}-gzip"
+
+
+def _payload_response(payload: ProductPayload) -> Response:
+    plain_etag, gzip_etag = _product_etags(payload.product_id, payload.version, payload.updated_at)
+    if len(payload.body) >= GZIP_MIN_BYTES and request.accept_encodings["gzip"]:
+        response = Response(payload.gzipped(), mimetype="application/json")
+        response.content_encoding = "gzip"
+        etag = gzip_etag
+    else:
+        response = Response(payload.body, mimetype="application/json")
+        etag = plain_etag
+    response.vary.add("Accept-Encoding")
+    _set_validators(response, etag, payload.updated_at)
+    return response
+
+
+def _set_validators(response: Response, etag: str, last_modified: nullable(datetime.datetime)):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+
+def _is_conditional() -> bool:
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+
+def _not_modified(etags: tuple[str, ...], last_modified: nullable(datetime.datetime)) -> nullable(str):
+    """
+    If-None-Match wins over If-Modified-Since when both are given (RFC 9110 13.2.2)
+
+    :param etags: The current ETags of every representation, the first one is used when only the date is compared
+    :return: The ETag to answer 304 with, None if the client's copy is outdated
+    """
+    if request.if_none_match:
+        return next((etag for etag in etags if request.if_none_match.contains_weak(etag)), None)
+    if last_modified is None or request.if_modified_since is None:
+        return None
+    # HTTP dates have a one second resolution
+    return etags[0] if last_modified.replace(microsecond=0) <= request.if_modified_since else None
+
+
+def _not_modified_response(etag: str, last_modified: nullable(datetime.datetime)) -> Response:
+    response = Response(status=304)
+    _set_validators(response, etag, last_modified)
+    return response
+
+
+def _json_array(product_iter: Iterator[Product]) -> Iterator[str]:
+    yield "["
+    for idx, product in enumerate(product_iter):
+        yield ("," if idx else "") + json.dumps(product.to_dict())
+    yield "]"
+
+
+def _product_from_body() -> Product:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "The body must be a JSON object")
+    try:
+        # the id comes from the URL or the database, never from the body
+        return Product.from_dict(data, keep_id=False)
+    except ValueError as exc:
+        abort(400, str(exc))
+
+
+def _search_filters() -> dict[str, Any]:
+    args = request.args
+    order_by = args.get("order_by", "id")
+    if order_by not in SORTABLE_COLUMNS:
+        abort(400, f"Cannot order products by {order_by}")
+    return {
+        "name": args.get("name"),
+        "producer": args.get("producer"),
+        "category": _query_value("category", int),
+        "min_price": _query_value("min_price", Decimal),
+        "max_price": _query_value("max_price", Decimal),
+        "order_by": order_by,
+        "descending": args.get("descending", "").lower() in ("1", "true", "yes"),
+    }
+
+
+def _query_value(name: str, type_: type) -> Any:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return type_(value)
+    except (ValueError, InvalidOperation):
+        abort(400, f"{name} must be a number, got {value!r}")
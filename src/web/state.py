@@ -0,0 +1,19 @@
+from flask import current_app
+
+from src.db.connection import Database
+from src.utils.logging.logger import Logger
+from src.utils.types import const
+
+DATABASE_EXTENSION: const(str) = "bookshop.database"
+LOGGER_EXTENSION: const(str) = "bookshop.logger"
+
+
+def database() -> Database:
+    """
+    The database of the app handling the current request
+    """
+    return current_app.extensions[DATABASE_EXTENSION]
+
+
+def logger() -> Logger:
+    return current_app.extensions[LOGGER_EXTENSION]
@@ -1,14 +1,53 @@
+import json
+import sqlite3
+import threading
 import unittest
 from decimal import Decimal
 
-from config import DBConfig, DBEngineType, LoggingConfig
+from sqlalchemy import event
+
+from config import CacheConfig, CategoryStorage, DBConfig, DBEngineType, LoggingConfig
 from src.core.category import ProductCategory
 from src.core.product import Product
 from src.db.connection import Database
+from src.db.filters import ProductFilters
+from src.db.timing import track_queries
+from src.utils.logging.handler import BaseLogHandler
 from src.utils.logging import level
 from src.utils.logging.logger import Logger
 
 
+class _CapturingHandler(BaseLogHandler):
+    """
+    Keeps the warnings logged through it (and its clones)
+    """
+
+    def __init__(self, name: str, lvl: int, warnings: list = None):
+        super().__init__(name, lvl)
+        self.warnings: list[tuple[str, dict]] = warnings if warnings is not None else []
+
+    def format(self, lvl: int, message: str, **tags):
+        return message
+
+    def clone(self, name: str) -> '_CapturingHandler':
+        return _CapturingHandler(name, self._level, self.warnings)
+
+    def info(self, message: str, **tags):
+        pass
+
+    def debug(self, message: str, **tags):
+        pass
+
+    def warning(self, message: str, **tags):
+        self.warnings.append((message, tags))
+
+    def error(self, message: str, traceback: bool = True, **tags):
+        pass
+
+    def close(self):
+        pass
+
+
 class TestDatabase(unittest.TestCase):
 
     def setUp(self):
@@ -55,6 +94,9 @@ class TestDatabase(unittest.TestCase):
         # fail to delete non-existent product
         self.assertFalse(self.db.delete_product(product_id=test_product.id))
 
+        # fail to update non-existent product
+        self.assertFalse(self.db.update_product(product=test_product))
+
     def test_search_products(self):
         test_product_1 = Product(
             name="test product 1",
@@ -105,7 +147,698 @@ class TestDatabase(unittest.TestCase):
         results_by_producer = self.db.search_products(producer="test producer 1")
         self.assertEqual(test_product_1, results_by_producer[0])
 
+    def test_insert_products(self):
+        products = [
+            Product(
+                name=f"bulk product {i}",
+                category=ProductCategory.NOTEBOOKS,
+                price=float(i),
+                description=f"bulk description {i}",
+                image_path="bulk path",
+                producer="bulk producer",
+                characteristics={'index': i},
+                quantity=i
+            ) for i in range(5)
+        ]
+        result = self.db.insert_products(products, chunk_size=2)
+        self.assertTrue(result.ok)
+        self.assertListEqual(products, result.inserted)
+        for product in products:
+            self.assertIsNotNone(product.id)
+            self.assertEqual(product, self.db.get_product(product_id=product.id))
+
+        # a clashing id only fails its own row, the rest of the chunk is still inserted
+        duplicate = Product(**{**products[0].__dict__, "name": "duplicate"})
+        fresh = Product(**{**products[1].__dict__, "id": None, "name": "fresh"})
+        result = self.db.insert_products([fresh, duplicate], chunk_size=2)
+        self.assertListEqual([fresh], result.inserted)
+        self.assertEqual(1, len(result.failed))
+        self.assertEqual(1, result.failed[0].index)
+        self.assertIs(duplicate, result.failed[0].product)
+        self.assertEqual(fresh, self.db.get_product(product_id=fresh.id))
+        self.assertEqual(products[0], self.db.get_product(product_id=products[0].id))
+
+        for chunk_size in (0, -1):
+            with self.assertRaises(ValueError):
+                self.db.insert_products([fresh], chunk_size=chunk_size)
+
+    def test_insert_products_rolled_back(self):
+        products = [Product(name=f"rolled back {i}", category=ProductCategory.NOTEBOOKS, price=1.0, description="",
+                            image_path="", producer="", characteristics={}, quantity=i) for i in range(5)]
+
+        def failing_input():
+            yield from products[:3]
+            raise RuntimeError("input failed")
+
+        # the first chunk was written and the second one never completed: nothing is kept
+        result = self.db.insert_products(failing_input(), chunk_size=2)
+        self.assertListEqual([], result.inserted)
+        self.assertListEqual(products[:3], [row.product for row in result.failed])
+        self.assertListEqual([], self.db.search_products(producer=""))
+
+        def fail_commit(conn):
+            raise RuntimeError("commit failed")
+
+        # a failed commit loses the whole batch, including a row which had failed on its own
+        existing = Product(**{**products[0].__dict__, "name": "existing"})
+        self.assertTrue(self.db.insert_product(existing))
+        clashing = Product(**{**existing.__dict__, "name": "clashing"})
+        event.listen(self.db._db, "commit", fail_commit)
+        try:
+            result = self.db.insert_products(iter(products[1:] + [clashing]), chunk_size=2)
+        finally:
+            event.remove(self.db._db, "commit", fail_commit)
+        self.assertListEqual([], result.inserted)
+        self.assertListEqual(products[1:] + [clashing], [row.product for row in result.failed])
+        self.assertListEqual(["commit failed"] * 4, [row.error for row in result.failed[:4]])
+        self.assertNotEqual("commit failed", result.failed[4].error)
+        self.assertIsNone(products[1].id)
+
+    def test_search_products_paginated(self):
+        products = [
+            Product(
+                name=f"paged product {i}",
+                category=ProductCategory.BAGS | (ProductCategory.TOYS if i % 2 else 0),
+                price=float(i % 4) if i != 7 else None,
+                description="",
+                image_path="",
+                producer="paged producer",
+                characteristics={},
+                quantity=i
+            ) for i in range(10)
+        ]
+        self.assertTrue(self.db.insert_products(products).ok)
+
+        def collect(**kwargs) -> list[Product]:
+            collected, cursor = [], None
+            while True:
+                page = self.db.search_products_page(limit=3, cursor=cursor, **kwargs)
+                self.assertLessEqual(len(page.items), 3)
+                collected.extend(page.items)
+                if (cursor := page.next_cursor) is None:
+                    return collected
+
+        self.assertListEqual(products, collect())
+        self.assertListEqual(products[::-1], collect(descending=True))
+
+        # price has ties and a NULL, which must come last in both directions
+        by_price = sorted(products[:7] + products[8:], key=lambda p: (p.price, p.id)) + [products[7]]
+        self.assertListEqual(by_price, collect(order_by="price"))
+        by_price_desc = sorted(products[:7] + products[8:], key=lambda p: (p.price, p.id), reverse=True)
+        self.assertListEqual(by_price_desc + [products[7]], collect(order_by="price", descending=True))
+
+        # every page seeks into a (column, id) index, ties are broken by id
+        self.assertListEqual(products, collect(order_by="producer"))
+        self.assertListEqual(products, collect(order_by="quantity"))
+        self.assertListEqual(products[::-1], collect(order_by="quantity", descending=True))
+
+        toys = [product for product in products if product.category & ProductCategory.TOYS]
+        self.assertListEqual(toys, collect(category=ProductCategory.TOYS))
+        self.assertListEqual(toys, list(self.db.iter_products(category=ProductCategory.TOYS, batch_size=2)))
+
+        page = self.db.search_products_page(limit=3)
+        with self.assertRaises(ValueError):
+            self.db.search_products_page(category=ProductCategory.TOYS, cursor=page.next_cursor)
+        with self.assertRaises(ValueError):
+            self.db.search_products_page(order_by="description")
+
+        # a NULL tail which starts mid page and spans several pages
+        for product in products[:4]:
+            product.price = None
+            self.assertTrue(self.db.update_product(product))
+        priced = sorted(products[4:7] + products[8:], key=lambda p: (p.price, p.id))
+        nulls = products[:4] + [products[7]]
+        self.assertListEqual(priced + nulls, collect(order_by="price"))
+        self.assertListEqual(priced[::-1] + nulls[::-1], collect(order_by="price", descending=True))
+
+    def test_search_by_characteristics(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                   indexed_characteristics=["color", "pages"]), logger=self.logger)
+        characteristics = [
+            {'color': 'red', 'pages': 100},
+            {'color': 'blue', 'pages': 250.5},
+            {'color': 'red', 'pages': '300', 'hardcover': True},
+            {'color': None, 'hardcover': False},
+        ]
+        products = [
+            Product(name=f"characteristic {i}", category=ProductCategory.NOTEBOOKS, price=1.0, description="",
+                    image_path="", producer="", characteristics=value, quantity=1)
+            for i, value in enumerate(characteristics)
+        ]
+        self.assertTrue(db.insert_products(products).ok)
+
+        def names(**kwargs) -> list[str]:
+            return [product.name for product in db.search_products(**kwargs)]
+
+        self.assertListEqual(["characteristic 0", "characteristic 2"], names(characteristics={'color': 'red'}))
+        # '300' is a string, it's never compared with numbers
+        self.assertListEqual(["characteristic 1"], names(characteristics=[('pages', '>', 100)]))
+        self.assertListEqual(["characteristic 0", "characteristic 1"], names(characteristics=[('pages', '>=', 100)]))
+        self.assertListEqual(["characteristic 2"], names(characteristics={'pages': '300'}))
+        self.assertListEqual(["characteristic 2"], names(characteristics={'hardcover': True}))
+        self.assertListEqual(["characteristic 3"], names(characteristics={'hardcover': False, 'color': None}))
+        self.assertListEqual(["characteristic 0"],
+                             names(characteristics=[('color', '=', 'red'), ('pages', '<', 200)]))
+        with self.assertRaises(ValueError):
+            db.search_products(characteristics=[('pages', 'LIKE', 1)])
+
+        checks = {check.shape: check for check in db.check_query_plans()}
+        self.assertFalse(checks["characteristic color"].sequential_scan)
+        self.assertFalse(checks["characteristic pages"].sequential_scan)
+
+        # configured keys are refused like query keys, before any DDL is built from them
+        for key in ('color"', "it's", "back\\slash", ""):
+            bad = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                        indexed_characteristics=["pages", key]), logger=self.logger)
+            with self.assertRaises(ValueError):
+                bad.connect()
+
+    def test_search_products_text(self):
+        def product(name: str, description: str) -> Product:
+            return Product(name=name, category=ProductCategory.NOTEBOOKS, price=1.0, description=description,
+                           image_path="", producer="", characteristics={}, quantity=1)
+
+        in_name = product("Spiral notebook", "A5, 100 sheets")
+        in_description = product("Sketch pad", "Works great next to a notebook")
+        unrelated = product("Ballpoint pen", "Blue ink")
+        self.assertTrue(self.db.insert_product(in_name))
+        self.assertTrue(self.db.insert_products([in_description, unrelated]).ok)
+
+        def found(query: str, **kwargs) -> list[Product]:
+            return [hit.product for hit in self.db.search_products_text(query, **kwargs)]
+
+        # prefixes match and name matches rank first
+        self.assertListEqual([in_name, in_description], found("NOTE"))
+        # the misspelled word doesn't prevent the match
+        self.assertListEqual([unrelated], found("blue pne"))
+        self.assertListEqual([], found("  *:()  "))
+        self.assertListEqual([in_name], found("notebook", limit=1))
+
+        unrelated.description = "Refill for any notebook pen"
+        self.assertTrue(self.db.update_product(unrelated))
+        results = found("notebook")
+        self.assertEqual(in_name, results[0])
+        self.assertCountEqual([in_description, unrelated], results[1:])
+        self.assertTrue(self.db.delete_product(in_name.id))
+        self.assertCountEqual([in_description, unrelated], found("notebook"))
+
+    def test_facet_counts(self):
+        specs = [
+            (ProductCategory.TOYS, 5.0, "acme"),
+            (ProductCategory.TOYS | ProductCategory.ARTS, 15.0, "acme"),
+            (ProductCategory.ARTS, 30.0, "globex"),
+            (ProductCategory.BAGS, 300.0, "initech"),
+            (ProductCategory.TOYS, None, None),
+        ]
+        products = [
+            Product(name=f"faceted {i}", category=category, price=price, description="", image_path="",
+                    producer=producer, characteristics={}, quantity=1)
+            for i, (category, price, producer) in enumerate(specs)
+        ]
+        self.assertTrue(self.db.insert_products(products).ok)
+
+        facets = self.db.facet_counts(top_producers=2, price_boundaries=[10, 100])
+        self.assertEqual(5, facets.total)
+        self.assertEqual(3, facets.categories[ProductCategory.TOYS])
+        self.assertEqual(2, facets.categories[ProductCategory.ARTS])
+        self.assertEqual(0, facets.categories[ProductCategory.OFFICE])
+        self.assertListEqual([("acme", 2), ("globex", 1)], facets.producers)
+        self.assertListEqual([(None, Decimal(10), 1), (Decimal(10), Decimal(100), 2), (Decimal(100), None, 1)],
+                             [(bucket.lower, bucket.upper, bucket.count) for bucket in facets.price_buckets])
+
+        facets = self.db.facet_counts(ProductFilters.build(category=ProductCategory.TOYS))
+        self.assertEqual(3, facets.total)
+        self.assertEqual(1, facets.categories[ProductCategory.ARTS])
+        self.assertEqual(0, facets.categories[ProductCategory.BAGS])
+        self.assertEqual(2, sum(bucket.count for bucket in facets.price_buckets))
+
+        with self.assertRaises(ValueError):
+            self.db.facet_counts(price_boundaries=[100, 10])
+
+    def test_search_product_rows(self):
+        products = [
+            Product(name=f"listed {i}", category=ProductCategory.TOYS if i else ProductCategory.ARTS, price=float(i),
+                    description="long text", image_path=f"img {i}", producer=f"producer {i}",
+                    characteristics={'pages': i}, quantity=i)
+            for i in range(3)
+        ]
+        self.assertTrue(self.db.insert_products(products).ok)
+
+        rows = self.db.search_product_rows(category=ProductCategory.TOYS, descending=True)
+        self.assertEqual(("id", "name", "price", "category", "image_path"), rows[0]._fields)
+        self.assertListEqual([products[2].id, products[1].id], [row.id for row in rows])
+        self.assertEqual({"id": products[2].id, "name": "listed 2", "price": Decimal(2),
+                          "category": ProductCategory.TOYS, "image_path": "img 2"}, rows[0]._asdict())
+
+        rows = self.db.search_product_rows(columns=("id", "producer"), order_by="price", limit=1)
+        self.assertListEqual([(products[0].id, "producer 0")], [tuple(row) for row in rows])
+
+        with self.assertRaises(ValueError):
+            self.db.search_product_rows(columns=("id", "secret"))
+
+    def test_product_cache(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                   cache=CacheConfig(product_cache_size=10)), logger=self.logger)
+        self.assertIsNone(db.get_product(product_id=1000))
+        self.assertIsNone(db.get_product(product_id=1000))
+        self.assertEqual(1, db.product_cache_stats().negative_hits)
+
+        product = Product(name="cached", category=ProductCategory.ARTS, price=1.0, description="", image_path="",
+                          producer="", characteristics={}, quantity=1, id=1000)
+        self.assertTrue(db.insert_product(product))
+        self.assertEqual(product, db.get_product(product_id=1000))
+        self.assertEqual(product, db.get_product(product_id=1000))
+        self.assertEqual(1, db.product_cache_stats().hits)
+
+        product.quantity = 0
+        self.assertTrue(db.update_product(product))
+        self.assertEqual(product, db.get_product(product_id=1000))
+
+        self.assertTrue(db.delete_product(product_id=1000))
+        self.assertIsNone(db.get_product(product_id=1000))
+
+    def test_get_products(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE, bulk_chunk_size=2,
+                                   cache=CacheConfig(product_cache_size=10)), logger=self.logger)
+        products = [Product(name=f"batch {i}", category=ProductCategory.BAGS, price=1.0, description="",
+                            image_path="", producer="", characteristics={}, quantity=i) for i in range(4)]
+        self.assertTrue(db.insert_products(products).ok)
+        ids = [product.id for product in products]
+        missing = max(ids) + 1
+        self.assertEqual(products[2], db.get_product(ids[2]))
+
+        requested = [ids[3], missing, ids[0], ids[2], ids[1], ids[3]]
+        with track_queries() as stats:
+            found = db.get_products(requested)
+        self.assertListEqual([products[3], None, products[0], products[2], products[1], products[3]], found)
+        # one cached, four ids left in chunks of two
+        self.assertEqual(2, stats.count)
+
+        # everything is cached now, misses included
+        with track_queries() as stats:
+            self.assertListEqual(found, db.get_products(requested))
+        self.assertEqual(0, stats.count)
+        self.assertListEqual([], db.get_products([]))
+
+    def test_search_cache(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                   cache=CacheConfig(search_cache_items=100, search_stale_s=0)), logger=self.logger)
+        product = Product(name="cached search", category=ProductCategory.TOYS, price=5.0, description="",
+                          image_path="", producer="", characteristics={}, quantity=1)
+        self.assertListEqual([], db.search_products(category=ProductCategory.TOYS, max_price=10.0))
+        self.assertTrue(db.insert_product(product))
+        self.assertListEqual([product], db.search_products(category=ProductCategory.TOYS, max_price=10.0))
+        # the same filters given as a Decimal hit the cached result
+        self.assertListEqual([product], db.search_products(category=ProductCategory.TOYS, max_price=Decimal(10)))
+        self.assertEqual(1, db.search_cache_stats().hits)
+
+    def test_reserve_stock(self):
+        products = [Product(name=f"stock {i}", category=ProductCategory.TOYS, price=1.0, description="",
+                            image_path="", producer="", characteristics={}, quantity=quantity)
+                    for i, quantity in enumerate((5, 2, None))]
+        self.assertTrue(self.db.insert_products(products).ok)
+        first, second, untracked = (product.id for product in products)
+
+        def quantities() -> list[int]:
+            return [self.db.get_product(product_id).quantity for product_id in (first, second)]
+
+        # lines for the same product add up
+        self.assertTrue(self.db.reserve_stock([(first, 2), (second, 1), (first, 1)]).ok)
+        self.assertListEqual([2, 1], quantities())
+
+        # all or nothing
+        result = self.db.reserve_stock([(first, 1), (second, 2), (untracked, 1), (-1, 1)])
+        self.assertFalse(result.ok)
+        self.assertListEqual([-1, second, untracked], result.rejected)
+        self.assertListEqual([2, 1], quantities())
+
+        self.assertTrue(self.db.release_stock([(first, 3), (second, 1)]).ok)
+        self.assertListEqual([5, 2], quantities())
+        self.assertFalse(self.db.release_stock([(untracked, 1)]).ok)
+        with self.assertRaises(ValueError):
+            self.db.reserve_stock([(first, 0)])
+
+    def test_concurrent_reservations(self):
+        products = [Product(name=f"concurrent {i}", category=ProductCategory.TOYS, price=1.0, description="",
+                            image_path="", producer="", characteristics={}, quantity=100) for i in range(3)]
+        self.assertTrue(self.db.insert_products(products).ok)
+        ids = [product.id for product in products]
+        results = []
+
+        def checkout(lines: list[tuple[int, int]]):
+            for _ in range(5):
+                results.append(self.db.reserve_stock(lines).ok)
+                # several writes in one transaction
+                with self.db.unit_of_work():
+                    results.append(self.db.reserve_stock(lines[:1]).ok)
+                    results.append(self.db.reserve_stock(lines[1:]).ok)
+
+        # the same products, listed in different orders
+        orders = ([0, 1, 2], [2, 1, 0], [1, 2], [2, 0])
+        threads = [threading.Thread(target=checkout, args=([(ids[i], 1) for i in order],)) for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertTrue(all(results))
+        self.assertEqual(len(orders) * 5 * 3, len(results))
+        # every line was taken twice per round: once alone, once in the unit of work
+        expected = [100 - 10 * sum(order.count(i) for order in orders) for i in range(3)]
+        self.assertListEqual(expected, [self.db.get_product(product_id).quantity for product_id in ids])
+
+    def test_unit_of_work(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                   cache=CacheConfig(product_cache_size=10)), logger=self.logger)
+        product = Product(name="unit of work", category=ProductCategory.TOYS, price=3.0, description="",
+                          image_path="", producer="", characteristics={}, quantity=5)
+        self.assertTrue(db.insert_product(product))
+        self.assertEqual(5, db.get_product(product.id).quantity)
+        commits = []
+        event.listen(db._db, "commit", lambda conn: commits.append(conn))
+
+        with db.unit_of_work():
+            self.assertTrue(db.reserve_stock([(product.id, 2)]).ok)
+            # the unit's own write, not the cached product
+            self.assertEqual(3, db.get_product(product.id).quantity)
+            # a failed call only rolls back itself
+            self.assertFalse(db.reserve_stock([(product.id, 10)]).ok)
+            with db.unit_of_work():
+                self.assertTrue(db.reserve_stock([(product.id, 1)]).ok)
+            self.assertListEqual([], commits)
+            # other sessions don't see it before the commit
+            self.assertEqual(5, self.db.get_product(product.id).quantity)
+        self.assertEqual(1, len(commits))
+        # the cached product was invalidated by the commit
+        self.assertEqual(2, db.get_product(product.id).quantity)
+
+        with self.assertRaises(RuntimeError):
+            with db.unit_of_work():
+                self.assertTrue(db.release_stock([(product.id, 3)]).ok)
+                raise RuntimeError("request failed")
+        self.assertEqual(2, db.get_product(product.id).quantity)
+        self.assertEqual(2, self.db.get_product(product.id).quantity)
+
+    def test_changes_since(self):
+        # start from an empty log
+        self.db.prune_changes(retention_s=0)
+        start = self.db.changes_since(0).last_seq
+        products = [Product(name=f"change {i}", category=ProductCategory.TOYS, price=1.0, description="",
+                            image_path="", producer="", characteristics={}, quantity=5) for i in range(3)]
+        self.assertTrue(self.db.insert_product(products[0]))
+        self.assertTrue(self.db.insert_products(products[1:]).ok)
+        products[0].name = "changed"
+        self.assertTrue(self.db.update_product(products[0]))
+        self.assertTrue(self.db.reserve_stock([(products[1].id, 1)]).ok)
+        self.assertTrue(self.db.delete_product(products[2].id))
+        # failed writes leave no trace
+        self.assertFalse(self.db.delete_product(products[2].id))
+        self.assertFalse(self.db.reserve_stock([(products[0].id, 100)]).ok)
+
+        expected = [(products[0].id, "insert"), (products[1].id, "insert"), (products[2].id, "insert"),
+                    (products[0].id, "update"), (products[1].id, "update"), (products[2].id, "delete")]
+        first = self.db.changes_since(start, limit=4)
+        rest = self.db.changes_since(first.last_seq, limit=4)
+        self.assertListEqual(expected, [(c.product_id, c.op) for c in first.changes + rest.changes])
+        self.assertEqual(rest.last_seq, self.db.changes_since(rest.last_seq).last_seq)
+
+        # compaction keeps the latest change of every product, pruning everything older than the retention
+        self.assertEqual(3, self.db.prune_changes())
+        self.assertListEqual(expected[3:], [(c.product_id, c.op) for c in self.db.changes_since(start).changes])
+        self.assertEqual(3, self.db.prune_changes(retention_s=0))
+        missed = self.db.changes_since(start)
+        self.assertTrue(missed.reset_required)
+        self.assertEqual(rest.last_seq, missed.last_seq)
+
+        self.assertTrue(self.db.delete_all_products())
+        batch = self.db.changes_since(missed.last_seq)
+        self.assertFalse(batch.reset_required)
+        self.assertListEqual([(None, "truncate")], [(c.product_id, c.op) for c in batch.changes])
+
+    def test_catalog_snapshot(self):
+        snapshot_db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                            catalog_snapshot=True, snapshot_refresh_s=0), logger=self.logger)
+        products = [Product(name=f"snapshot {i % 4}", category=category, price=price, description="",
+                            image_path="", producer=producer, characteristics={"n": i}, quantity=i)
+                    for i, (category, price, producer) in enumerate([
+                        (ProductCategory.TOYS, 5.0, "a"), (ProductCategory.TOYS | ProductCategory.ARTS, 10.0, "b"),
+                        (ProductCategory.ARTS, 10.0, "a"), (None, 20.0, None), ((1 << 40) | ProductCategory.TOYS,
+                                                                                None, "b"), (0, 7.5, "c")])]
+        self.assertTrue(self.db.insert_products(products).ok)
+        searches = [{}, {"category": ProductCategory.TOYS}, {"category": 0}, {"category": 1 << 40},
+                    {"category": ProductCategory.TOYS | ProductCategory.ARTS}, {"producer": "a"},
+                    {"producer": "missing"}, {"name": "snapshot 1"}, {"min_price": 7.5}, {"max_price": 10},
+                    {"min_price": 6, "max_price": 10, "producer": "a"}, {"characteristics": {"n": 2}}]
+
+        def assert_same_results():
+            for search in searches:
+                self.assertListEqual(self.db.search_products(**search), snapshot_db.search_products(**search), search)
+
+        assert_same_results()
+        self.assertEqual(len(products), len(snapshot_db.snapshot))
+        # writes from this instance and from another one
+        products[0].category = ProductCategory.ARTS
+        products[0].price = 8
+        self.assertTrue(snapshot_db.update_product(products[0]))
+        self.assertTrue(self.db.delete_product(products[1].id))
+        self.assertTrue(snapshot_db.reserve_stock([(products[2].id, 1)]).ok)
+        self.assertTrue(self.db.insert_product(Product(name="snapshot 1", category=ProductCategory.TOYS, price=9,
+                                                       description="", image_path="", producer="a",
+                                                       characteristics={}, quantity=1)))
+        assert_same_results()
+        self.assertListEqual(sorted(product.id for product in self.db.search_products(producer="a")),
+                             snapshot_db.snapshot.search_ids(ProductFilters(producer="a")))
+
+        self.assertTrue(self.db.delete_all_products())
+        self.assertListEqual([], snapshot_db.search_products())
+
+    def test_query_timing(self):
+        handler = _CapturingHandler("TEST", level.DEBUG)
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE, slow_query_ms=0),
+                      logger=Logger("TEST", level.DEBUG, [handler]))
+        db.connect()
+        handler.warnings.clear()
+        with track_queries() as stats:
+            for product_id in (1, 2, 3):
+                db.get_product(product_id)
+        self.assertEqual(3, stats.count)
+        self.assertGreater(stats.total_s, 0)
+        # the same statement three times over, an N+1 pattern
+        [(repeated, times)] = stats.most_repeated()
+        self.assertEqual(3, times)
+        self.assertEqual(3, stats.slow)
+        self.assertEqual(3, len(handler.warnings))
+        message, tags = handler.warnings[0]
+        self.assertIn("SELECT", message)
+        self.assertEqual(repeated, tags["fingerprint"])
+        self.assertGreaterEqual(tags["duration_ms"], 0)
+
+        # nothing is counted outside of a request
+        db.get_product(1)
+        self.assertEqual(3, stats.count)
+
+    def test_pool_stats(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE, pool_size=1, max_overflow=0,
+                                   pool_timeout_s=0.05), logger=self.logger)
+        self.assertIsNone(db.get_product(product_id=1))
+        with db.in_session() as session:
+            session.get_product(1)
+            stats = db.pool_stats()
+            self.assertEqual((1, 1, 0), (stats.size, stats.checked_out, stats.timeouts))
+            # the only connection is taken
+            self.assertIsNone(db.get_product(product_id=1))
+
+        stats = db.pool_stats()
+        self.assertEqual(0, stats.checked_out)
+        self.assertEqual(1, stats.timeouts)
+        self.assertGreaterEqual(stats.checkouts, 2)
+        self.assertGreaterEqual(stats.max_wait_s, 0)
+
+    def test_indexes(self):
+        with sqlite3.connect(self.db.name + ".db") as conn:
+            conn.execute("DROP INDEX ix_products_price")
+        self.assertListEqual(["ix_products_price"], self.db.ensure_indexes())
+        self.assertListEqual([], self.db.ensure_indexes())
+
+        checks = {check.shape: check for check in self.db.check_query_plans()}
+        self.assertFalse(checks["price_range"].sequential_scan)
+        self.assertFalse(checks["producer_price"].sequential_scan)
+        # keyset pages seek to the cursor instead of walking the index from its start
+        self.assertIn("SEARCH products USING INDEX ix_products_price (price>?)", checks["page by price"].plan)
+        for order_by in ("id", "name", "price", "producer", "quantity"):
+            self.assertFalse(checks[f"page by {order_by}"].sequential_scan, checks[f"page by {order_by}"].plan)
+        # the bitmask predicate can't be served by an index
+        self.assertTrue(checks["category"].sequential_scan)
+        self.assertListEqual(["category"], [shape for shape, check in checks.items() if check.sequential_scan])
+
+    def test_schema_stamp(self):
+        def index_names() -> set[str]:
+            with sqlite3.connect(self.db.name + ".db") as conn:
+                return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+        def restart() -> Database:
+            db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE), logger=self.logger)
+            db.connect()
+            return db
+
+        self.db.connect()
+        with sqlite3.connect(self.db.name + ".db") as conn:
+            conn.execute("DROP INDEX ix_products_price")
+            # the column can't be dropped while an index uses it
+            conn.execute("DROP INDEX ix_products_quantity")
+            conn.execute("ALTER TABLE products DROP COLUMN quantity")
+        # stamped as up to date, so nothing is checked
+        restart()
+        self.assertNotIn("ix_products_price", index_names())
+
+        with sqlite3.connect(self.db.name + ".db") as conn:
+            conn.execute("DELETE FROM schema_meta")
+        self.db = restart()
+        self.assertTrue({"ix_products_price", "ix_products_quantity"} <= index_names())
+        product = Product(name="stamped", category=ProductCategory.TOYS, price=1.0, description="", image_path="",
+                          producer="", characteristics={}, quantity=3)
+        self.assertTrue(self.db.insert_product(product))
+        self.assertEqual(3, self.db.get_product(product.id).quantity)
+
     def tearDown(self):
         self.db.delete_all_products()
         # delete_sqlite_file(self.db.name + ".db")
 
+
+
+class TestCategoryBitsStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = Logger.from_config(name="TEST", cfg=LoggingConfig(log_level=level.DEBUG, log_to_file=False))
+        self.db = Database(cfg=DBConfig(db_name="bookshop_tests_bits", engine=DBEngineType.SQLITE,
+                                        category_storage=CategoryStorage.BITS), logger=self.logger)
+        # set up the bits table before anything is written in bitmask mode
+        self.db.connect()
+        # same file, read through the plain bitmask predicate as the reference
+        self.bitmask_db = Database(cfg=DBConfig(db_name="bookshop_tests_bits", engine=DBEngineType.SQLITE),
+                                   logger=self.logger)
+
+    @staticmethod
+    def _product(name: str, category: int) -> Product:
+        return Product(name=name, category=category, price=1.0, description="", image_path="", producer="",
+                       characteristics={}, quantity=1)
+
+    def _assert_same_results(self):
+        masks = (0, ProductCategory.TOYS, ProductCategory.CASES | ProductCategory.TOYS, ProductCategory.ARTS,
+                 ProductCategory.STATIONERY | ProductCategory.DOCUMENTS | ProductCategory.OFFICE, 1 << 40)
+        for mask in masks:
+            self.assertListEqual(self.bitmask_db.search_products(category=mask), self.db.search_products(category=mask))
+
+    def test_bits_match_bitmask(self):
+        products = [
+            self._product("toy", ProductCategory.TOYS),
+            self._product("case toy", ProductCategory.CASES | ProductCategory.TOYS),
+            self._product("office", ProductCategory.STATIONERY | ProductCategory.DOCUMENTS | ProductCategory.OFFICE),
+            self._product("big", (1 << 40) | ProductCategory.TOYS),
+            self._product("none", None),
+        ]
+        self.assertTrue(self.db.insert_product(products[0]))
+        self.assertTrue(self.db.insert_products(products[1:]).ok)
+        self._assert_same_results()
+
+        products[1].category = ProductCategory.ARTS
+        self.assertTrue(self.db.update_product(products[1]))
+        self.assertTrue(self.db.delete_product(products[0].id))
+        self._assert_same_results()
+        self.assertListEqual([products[1]], self.db.search_products(category=ProductCategory.ARTS))
+
+    def test_migrate_existing_rows(self):
+        # rows written in bitmask mode have no bits until the migration runs
+        for product in (self._product("toy", ProductCategory.TOYS),
+                        self._product("case toy", ProductCategory.CASES | ProductCategory.TOYS)):
+            self.assertTrue(self.bitmask_db.insert_product(product))
+        self.assertListEqual([], self.db.search_products(category=ProductCategory.TOYS))
+
+        self.assertTrue(self.db.migrate_category_storage())
+        self._assert_same_results()
+
+    def test_rebuild_after_bitmask_mode(self):
+        products = [self._product("toy", ProductCategory.TOYS), self._product("arts", ProductCategory.ARTS)]
+        self.assertTrue(self.db.insert_products(products).ok)
+        # the bits table isn't empty, but goes stale while the database runs in bitmask mode
+        self.assertTrue(self.bitmask_db.insert_product(self._product("case toy", ProductCategory.CASES)))
+        products[1].category = ProductCategory.TOYS
+        self.assertTrue(self.bitmask_db.update_product(products[1]))
+        self.assertTrue(self.bitmask_db.delete_product(products[0].id))
+
+        self.db = Database(cfg=DBConfig(db_name="bookshop_tests_bits", engine=DBEngineType.SQLITE,
+                                        category_storage=CategoryStorage.BITS), logger=self.logger)
+        self._assert_same_results()
+        self.assertListEqual([products[1]], self.db.search_products(category=ProductCategory.TOYS))
+
+    def tearDown(self):
+        self.db.delete_all_products()
+
+
+class TestReadReplicas(unittest.TestCase):
+    REPLICAS = ("bookshop_tests_replica_1", "bookshop_tests_replica_2")
+
+    def setUp(self):
+        self.logger = Logger.from_config(name="TEST", cfg=LoggingConfig(log_level=level.DEBUG, log_to_file=False))
+        # stand-ins for replicas: each file only holds a product named after it, so results show who served them
+        self.replicas = [Database(cfg=DBConfig(db_name=name, engine=DBEngineType.SQLITE), logger=self.logger)
+                         for name in self.REPLICAS]
+        for replica in self.replicas:
+            self.assertTrue(replica.insert_product(self._product(replica.name)))
+        self.db = self._database(read_your_writes_s=0)
+        self.assertTrue(self.db.insert_product(self._product("primary")))
+
+    def _database(self, read_your_writes_s: float, cache: dict = None) -> Database:
+        return Database(cfg=DBConfig.from_dict({
+            "db_name": "bookshop_tests", "engine": DBEngineType.SQLITE, "read_your_writes_s": read_your_writes_s,
+            "replicas": [{"db_name": name} for name in self.REPLICAS], "cache": cache or {},
+        }), logger=self.logger)
+
+    @staticmethod
+    def _product(name: str) -> Product:
+        return Product(name=name, category=ProductCategory.TOYS, price=1.0, description="", image_path="",
+                       producer="", characteristics={}, quantity=1)
+
+    def _served_by(self) -> str:
+        return self.db.search_products()[0].name
+
+    def test_round_robin(self):
+        self.assertListEqual(list(self.REPLICAS) * 2, [self._served_by() for _ in range(4)])
+        self.assertEqual(2, len(self.db.replica_pool_stats()))
+
+    def test_primary_only(self):
+        with self.db.primary_only():
+            self.assertEqual("primary", self._served_by())
+        self.assertIn(self._served_by(), self.REPLICAS)
+
+    def test_caches_filled_from_primary(self):
+        db = self._database(read_your_writes_s=0, cache={"product_cache_size": 10, "search_cache_items": 10,
+                                                         "payload_cache_size": 10})
+        with db.primary_only():
+            [primary] = db.search_products(name="primary")
+        # the replicas lag behind the primary, a cached read from them would outlive the lag
+        self.assertEqual("primary", db.get_product(primary.id).name)
+        self.assertEqual(["primary"], [product.name for product in db.get_products([primary.id])])
+        self.assertEqual("primary", json.loads(db.get_product_payload(primary.id).body)["name"])
+        self.assertListEqual(["primary"], [product.name for product in db.search_products()])
+        self.assertListEqual(["primary"], [product.name for product in db.search_products()])
+        # reads which don't fill a cache still go to the replicas
+        self.assertIn(db.search_products_page().items[0].name, self.REPLICAS)
+
+    def test_unit_of_work(self):
+        with self.db.unit_of_work():
+            # nothing written yet, the reads may go to the replicas
+            self.assertIn(self._served_by(), self.REPLICAS)
+            self.assertTrue(self.db.insert_product(self._product("written")))
+            self.assertListEqual(["primary", "written"], [product.name for product in self.db.search_products()])
+
+    def test_read_your_writes(self):
+        db = self._database(read_your_writes_s=60)
+        self.assertIn(db.search_products()[0].name, self.REPLICAS)
+        self.assertTrue(db.insert_product(self._product("written")))
+        self.assertListEqual(["primary", "written"], [product.name for product in db.search_products()])
+
+    def tearDown(self):
+        self.db.delete_all_products()
+        for replica in self.replicas:
+            replica.delete_all_products()
@@ -0,0 +1,65 @@
+import io
+import unittest
+from decimal import Decimal
+
+from config import DBConfig, DBEngineType, LoggingConfig
+from src.core.category import ProductCategory
+from src.core.product import Product
+from src.db.connection import Database
+from src.tools.catalog_io import CSV, JSONL, export_catalog, import_catalog
+from src.utils.logging import level
+from src.utils.logging.logger import Logger
+
+
+class TestCatalogIO(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = Logger.from_config(name="TEST", cfg=LoggingConfig(log_level=level.DEBUG, log_to_file=False))
+        self.db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE), logger=self.logger)
+        self.products = [
+            Product(name=f"product {i}", category=ProductCategory.TOYS if i % 2 else ProductCategory.ARTS,
+                    price=Decimal(i) + Decimal("0.25"), description=f"line one\nline \"two\", {i}\ttabbed",
+                    image_path=f"/images/{i}.png", producer="producer", characteristics={"pages": i, "tags": ["a"]},
+                    quantity=i)
+            for i in range(1, 8)
+        ]
+        self.assertTrue(self.db.insert_products(self.products).ok)
+
+    def _round_trip(self, fmt: str, workers: int):
+        exported = io.StringIO()
+        report = export_catalog(self.db, exported, fmt, batch_size=3)
+        self.assertEqual(len(self.products), report.rows)
+
+        self.assertTrue(self.db.delete_all_products())
+        exported.seek(0)
+        report = import_catalog(self.db, exported, fmt, chunk_size=2, workers=workers, keep_ids=True)
+        self.assertEqual((len(self.products), []), (report.rows, report.errors))
+        self.assertListEqual(self.products, self.db.search_products())
+
+    def test_csv_round_trip(self):
+        self._round_trip(CSV, workers=1)
+
+    def test_jsonl_round_trip_in_process_pool(self):
+        self._round_trip(JSONL, workers=2)
+
+    def test_invalid_records(self):
+        self.assertTrue(self.db.delete_all_products())
+        data = io.StringIO('name,price,category,characteristics\n'
+                           'good,1.5,128,"{""color"": ""red""}"\n'
+                           ',1,1,\n'
+                           'bad price,free,1,\n'
+                           'bad json,1,1,{nope\n'
+                           '"multi\nline",2,,\n')
+        report = import_catalog(self.db, data, CSV)
+        self.assertEqual(2, report.rows)
+        self.assertListEqual([2, 3, 4], [error.record for error in report.errors])
+        self.assertListEqual([("good", {"color": "red"}), ("multi\nline", {})],
+                             [(p.name, p.characteristics) for p in self.db.search_products()])
+
+        data = io.StringIO('{"name": "ok", "quantity": 1}\n\n[1]\n{"name": "negative", "quantity": -1}\n')
+        report = import_catalog(self.db, data, JSONL)
+        self.assertEqual(1, report.rows)
+        self.assertListEqual([2, 3], [error.record for error in report.errors])
+
+    def tearDown(self):
+        self.db.delete_all_products()
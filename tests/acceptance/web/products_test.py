@@ -0,0 +1,215 @@
+import gzip
+import json
+import unittest
+from decimal import Decimal
+
+from config import CacheConfig, DBConfig, DBEngineType, LoggingConfig
+from src.core.category import ProductCategory
+from src.core.product import Product
+from src.db.connection import Database
+from src.utils.logging import level
+from src.utils.logging.logger import Logger
+from src.web.app import create_app
+
+
+class TestProductsAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = Logger.from_config(name="TEST", cfg=LoggingConfig(log_level=level.DEBUG, log_to_file=False))
+        self.db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE), logger=self.logger)
+        self.client = create_app(self.db, self.logger).test_client()
+        self.products = [
+            Product(name=f"web product {i}", category=ProductCategory.TOYS if i % 2 else ProductCategory.ARTS,
+                    price=Decimal(i) + Decimal("0.5"), description="", image_path="", producer="web producer",
+                    characteristics={"pages": i}, quantity=i)
+            for i in range(1, 6)
+        ]
+        self.assertTrue(self.db.insert_products(self.products).ok)
+
+    def test_crud(self):
+        body = {"name": "created", "category": ProductCategory.BAGS, "price": "12.30", "description": "new",
+                "image_path": "", "producer": "web producer", "characteristics": {"size": "L"}, "quantity": 3}
+        response = self.client.post("/products", json=body)
+        self.assertEqual(201, response.status_code)
+        created = response.get_json()
+        self.assertEqual(Decimal("12.30"), Decimal(created["price"]))
+        self.assertEqual(1, created["version"])
+        self.assertEqual(f"/products/{created['id']}", response.headers["Location"])
+
+        response = self.client.get(f"/products/{created['id']}")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(Product.from_dict(created), Product.from_dict(response.get_json()))
+
+        response = self.client.put(f"/products/{created['id']}", json={**body, "quantity": 7})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(7, self.db.get_product(created["id"]).quantity)
+
+        self.assertEqual(204, self.client.delete(f"/products/{created['id']}").status_code)
+        self.assertEqual(404, self.client.get(f"/products/{created['id']}").status_code)
+        self.assertEqual(404, self.client.delete(f"/products/{created['id']}").status_code)
+        self.assertEqual(404, self.client.put(f"/products/{created['id']}", json=body).status_code)
+
+    def test_invalid_requests(self):
+        response = self.client.post("/products", json={"name": "", "price": "1"})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("name is required", response.get_json()["error"])
+        self.assertEqual(400, self.client.post("/products", data="not json",
+                                               content_type="application/json").status_code)
+        self.assertEqual(400, self.client.get("/products?min_price=cheap").status_code)
+        self.assertEqual(400, self.client.get("/products?order_by=description").status_code)
+
+    def test_search_is_streamed(self):
+        response = self.client.get("/products?category=128&order_by=price&descending=true")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.is_streamed)
+        expected = [product for product in reversed(self.products) if product.category == ProductCategory.TOYS]
+        self.assertListEqual(expected, self._products(json.loads(response.get_data(as_text=True))))
+
+        response = self.client.get("/products?min_price=100")
+        self.assertListEqual([], response.get_json())
+
+        response = self.client.get("/products?producer=web+producer&max_price=2.5")
+        self.assertListEqual(self.products[:2], self._products(response.get_json()))
+
+    def test_get_products(self):
+        ids = [product.id for product in self.products]
+        missing = max(ids) + 1
+        response = self.client.get(f"/products/batch?ids={ids[2]},{missing},{ids[0]}")
+        self.assertEqual(200, response.status_code)
+        data = response.get_json()
+        self.assertEqual(None, data["products"][1])
+        self.assertListEqual([self.products[2], self.products[0]],
+                             self._products([data["products"][0], data["products"][2]]))
+        self.assertListEqual([missing], data["missing"])
+
+        self.assertEqual(400, self.client.get("/products/batch").status_code)
+        self.assertEqual(400, self.client.get("/products/batch?ids=1,two").status_code)
+
+    def test_conditional_get(self):
+        product = self.products[0]
+        response = self.client.get(f"/products/{product.id}")
+        etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+        self.assertTrue(etag.startswith(f'"{product.id}-1-'))
+        self.assertEqual(304, self.client.get(f"/products/{product.id}", headers={"If-None-Match": etag}).status_code)
+        response = self.client.get(f"/products/{product.id}", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.data)
+        self.assertEqual(etag, response.headers["ETag"])
+
+        self.assertTrue(self.db.reserve_stock([(product.id, 1)]).ok)
+        response = self.client.get(f"/products/{product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers["ETag"].startswith(f'"{product.id}-2-'))
+        self.assertEqual(2, response.get_json()["version"])
+        self.assertEqual(404, self.client.get("/products/0", headers={"If-None-Match": etag}).status_code)
+
+        response = self.client.get("/products?category=128")
+        listing_etag = response.headers["ETag"]
+        self.assertTrue(response.get_json())
+        self.assertEqual(304, self.client.get("/products?category=128",
+                                              headers={"If-None-Match": listing_etag}).status_code)
+        self.assertTrue(self.db.update_product(self.products[1]))
+        response = self.client.get("/products?category=128", headers={"If-None-Match": listing_etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(listing_etag, response.headers["ETag"])
+        self.assertTrue(response.get_json())
+
+    def test_reused_id(self):
+        product = self.products[0]
+        etag = self.client.get(f"/products/{product.id}").headers["ETag"]
+        self.assertTrue(self.db.delete_product(product.id))
+        # same id, and the version starts over
+        replacement = Product(**{**product.__dict__, "name": "replacement"})
+        self.assertTrue(self.db.insert_product(replacement))
+        self.assertEqual(product.id, replacement.id)
+
+        response = self.client.get(f"/products/{product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(("replacement", 1), (response.get_json()["name"], response.get_json()["version"]))
+        self.assertNotEqual(etag, response.headers["ETag"])
+
+    def test_payload_cache(self):
+        db = Database(cfg=DBConfig(db_name="bookshop_tests", engine=DBEngineType.SQLITE,
+                                   cache=CacheConfig(payload_cache_size=10)), logger=self.logger)
+        client = create_app(db, self.logger).test_client()
+        product = self.products[0]
+        product.description = "long " * 500
+        self.assertTrue(db.update_product(product))
+
+        plain = client.get(f"/products/{product.id}")
+        self.assertEqual(self.db.get_product(product.id), Product.from_dict(plain.get_json()))
+        self.assertIsNone(plain.content_encoding)
+        compressed = client.get(f"/products/{product.id}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", compressed.content_encoding)
+        self.assertEqual(plain.data, gzip.decompress(compressed.data))
+        self.assertNotEqual(plain.headers["ETag"], compressed.headers["ETag"])
+        self.assertEqual(1, db.payload_cache_stats().hits)
+
+        # either representation is still current
+        for etag in (plain.headers["ETag"], compressed.headers["ETag"]):
+            response = client.get(f"/products/{product.id}", headers={"If-None-Match": etag})
+            self.assertEqual((304, etag), (response.status_code, response.headers["ETag"]))
+
+        # a write through the API replaces the cached payload
+        body = {**plain.get_json(), "name": "renamed"}
+        self.assertEqual(200, client.put(f"/products/{product.id}", json=body).status_code)
+        self.assertEqual("renamed", client.get(f"/products/{product.id}").get_json()["name"])
+        self.assertEqual(1, db.payload_cache_stats().invalidations)
+
+    def test_reads_use_replicas(self):
+        replica = Database(cfg=DBConfig(db_name="bookshop_tests_replica_1", engine=DBEngineType.SQLITE),
+                           logger=self.logger)
+        replicated = Product(id=10_000, name="replicated", category=ProductCategory.ARTS, price=Decimal(1),
+                             description="", image_path="", producer="", characteristics={}, quantity=1)
+        self.assertTrue(replica.insert_product(replicated))
+        try:
+            db = Database(cfg=DBConfig.from_dict({
+                "db_name": "bookshop_tests", "engine": DBEngineType.SQLITE, "read_your_writes_s": 0,
+                "replicas": [{"db_name": replica.name}],
+            }), logger=self.logger)
+            client = create_app(db, self.logger).test_client()
+            # only the replica has it
+            self.assertEqual("replicated", client.get(f"/products/{replicated.id}").get_json()["name"])
+            self.assertEqual(["replicated"], [item["name"] for item in client.get("/products").get_json()])
+            # writes go to the primary, and so do the reads made after them
+            body = {**self.products[1].to_dict(), "name": "renamed"}
+            response = client.put(f"/products/{self.products[1].id}", json=body)
+            self.assertEqual((200, "renamed"), (response.status_code, response.get_json()["name"]))
+            self.assertEqual(404, client.put(f"/products/{replicated.id}", json=body).status_code)
+            self.assertEqual(204, client.delete(f"/products/{self.products[0].id}").status_code)
+            self.assertIsNone(self.db.get_product(self.products[0].id))
+        finally:
+            replica.delete_all_products()
+
+    def test_listing_version_matches_rows(self):
+        replicas = [Database(cfg=DBConfig(db_name=name, engine=DBEngineType.SQLITE), logger=self.logger)
+                    for name in ("bookshop_tests_replica_1", "bookshop_tests_replica_2")]
+        stored = [Product(name=replica.name, category=ProductCategory.ARTS, price=Decimal(1), description="",
+                          image_path="", producer="", characteristics={}, quantity=1) for replica in replicas]
+        for replica, product in zip(replicas, stored):
+            self.assertTrue(replica.insert_product(product))
+        # replicas lagging differently are at different points of the change log
+        while replicas[1].catalog_version().seq <= replicas[0].catalog_version().seq:
+            self.assertTrue(replicas[1].update_product(stored[1]))
+        etags = {replica.name: f'"catalog-{replica.catalog_version().seq}"' for replica in replicas}
+        try:
+            db = Database(cfg=DBConfig.from_dict({
+                "db_name": "bookshop_tests", "engine": DBEngineType.SQLITE, "read_your_writes_s": 0,
+                "replicas": [{"db_name": replica.name} for replica in replicas],
+            }), logger=self.logger)
+            client = create_app(db, self.logger).test_client()
+            # the replicas take turns, every listing must carry the version of the replica which served it
+            for _ in range(4):
+                response = client.get("/products")
+                [served] = [item["name"] for item in response.get_json()]
+                self.assertEqual(etags[served], response.headers["ETag"])
+        finally:
+            for replica in replicas:
+                replica.delete_all_products()
+
+    @staticmethod
+    def _products(data: list[dict]) -> list[Product]:
+        return [Product.from_dict(item) for item in data]
+
+    def tearDown(self):
+        self.db.delete_all_products()
@@ -0,0 +1,174 @@
+import gzip
+import json
+import unittest
+
+from src.core.category import ProductCategory
+from src.core.product import Product
+from src.db.cache import PayloadCache, ProductCache, ProductPayload, SearchCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now: float = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestProductCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ProductCache(max_size=2, ttl_s=10, negative_ttl_s=1, clock=self.clock)
+
+    @staticmethod
+    def _product(product_id: int) -> Product:
+        return Product(id=product_id, name=f"product {product_id}", category=ProductCategory.ARTS, price=1.0,
+                       description="", image_path="", producer="", characteristics={'pages': 10}, quantity=1)
+
+    def test_hit_miss_and_copies(self):
+        self.assertEqual((False, None), self.cache.get(1))
+        product = self._product(1)
+        self.cache.put(1, product)
+
+        found, cached = self.cache.get(1)
+        self.assertTrue(found)
+        self.assertEqual(product, cached)
+        cached.characteristics['pages'] = 20
+        self.assertEqual(product, self.cache.get(1)[1])
+
+        stats = self.cache.stats()
+        self.assertEqual((2, 1, 1), (stats.hits, stats.misses, stats.size))
+
+    def test_lru_eviction(self):
+        for product_id in (1, 2):
+            self.cache.put(product_id, self._product(product_id))
+        self.cache.get(1)
+        self.cache.put(3, self._product(3))
+        self.assertFalse(self.cache.get(2)[0])
+        self.assertTrue(self.cache.get(1)[0])
+        self.assertTrue(self.cache.get(3)[0])
+        self.assertEqual(1, self.cache.stats().evictions)
+
+    def test_ttl_and_negative_caching(self):
+        self.cache.put(1, self._product(1))
+        self.cache.put(2, None)
+        self.assertEqual((True, None), self.cache.get(2))
+        self.assertEqual(1, self.cache.stats().negative_hits)
+
+        self.clock.now = 5
+        self.assertFalse(self.cache.get(2)[0])
+        self.assertTrue(self.cache.get(1)[0])
+        self.clock.now = 10
+        self.assertFalse(self.cache.get(1)[0])
+        self.assertEqual(2, self.cache.stats().expirations)
+
+    def test_invalidation(self):
+        self.cache.put(1, self._product(1))
+        token = self.cache.token()
+        self.cache.invalidate([1])
+        self.assertFalse(self.cache.get(1)[0])
+
+        # a value read before the invalidation must not be cached
+        self.cache.put(1, self._product(1), token)
+        self.assertFalse(self.cache.get(1)[0])
+        self.cache.put(1, self._product(1), self.cache.token())
+        self.assertTrue(self.cache.get(1)[0])
+
+        self.cache.clear()
+        self.assertEqual(0, self.cache.stats().size)
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = SearchCache(max_items=6, ttl_s=10, stale_s=2, clock=self.clock)
+
+    @staticmethod
+    def _products(*ids: int) -> list[Product]:
+        return [TestProductCache._product(product_id) for product_id in ids]
+
+    def test_generation_invalidation_and_stale_while_refresh(self):
+        self.cache.put("toys", self._products(1, 2), self.cache.generation)
+        self.assertEqual((self._products(1, 2), False), self.cache.get("toys"))
+
+        self.cache.bump()
+        self.clock.now = 1
+        # stale: served, and only the first caller is asked to refresh
+        self.assertEqual((self._products(1, 2), True), self.cache.get("toys"))
+        self.assertEqual((self._products(1, 2), False), self.cache.get("toys"))
+
+        generation = self.cache.generation
+        self.cache.put("toys", self._products(1), generation)
+        self.cache.refresh_done("toys")
+        self.assertEqual((self._products(1), False), self.cache.get("toys"))
+
+        # a refresh started before the last write can't replace a newer result
+        self.cache.bump()
+        self.cache.put("toys", self._products(3), self.cache.generation)
+        self.cache.put("toys", self._products(4), generation)
+        self.assertEqual(self._products(3), self.cache.get("toys")[0])
+
+    def test_too_stale(self):
+        self.cache.put("toys", self._products(1), self.cache.generation)
+        self.clock.now = 12.5
+        self.assertEqual((None, False), self.cache.get("toys"))
+
+        self.cache.put("toys", self._products(1), self.cache.generation)
+        self.cache.bump()
+        self.clock.now = 15
+        self.assertEqual((None, False), self.cache.get("toys"))
+
+    def test_memory_bound(self):
+        self.cache.put("a", self._products(1, 2), 0)
+        self.cache.put("b", self._products(3, 4), 0)
+        self.cache.get("a")
+        self.cache.put("c", self._products(5), 0)
+        self.assertIsNone(self.cache.get("b")[0])
+        self.assertIsNotNone(self.cache.get("a")[0])
+        self.assertIsNotNone(self.cache.get("c")[0])
+        # larger than the whole cache
+        self.cache.put("d", self._products(*range(10)), 0)
+        self.assertIsNone(self.cache.get("d")[0])
+
+
+class TestPayloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = PayloadCache(max_size=2, ttl_s=10, clock=self.clock)
+
+    @staticmethod
+    def _payload(product_id: int, version: int = 1) -> ProductPayload:
+        product = TestProductCache._product(product_id)
+        product.version = version
+        return ProductPayload.encode(product)
+
+    def test_encoding(self):
+        payload = self._payload(1)
+        self.assertEqual(TestProductCache._product(1), Product.from_dict(json.loads(payload.body)))
+        self.assertEqual(payload.body, gzip.decompress(payload.gzipped()))
+        self.assertIs(payload.gzipped(), payload.gzipped())
+
+    def test_versions_and_invalidation(self):
+        self.assertIsNone(self.cache.get(1))
+        payload = self._payload(1)
+        self.cache.put(payload)
+        self.assertIs(payload, self.cache.get(1))
+        self.assertIs(payload, self.cache.get(1, version=1))
+        self.assertIsNone(self.cache.get(1, version=2))
+
+        token = self.cache.token()
+        self.cache.invalidate([1])
+        self.assertIsNone(self.cache.get(1))
+        # encoded from a read made before the invalidation
+        self.cache.put(self._payload(1), token)
+        self.assertIsNone(self.cache.get(1))
+
+        self.cache.put(self._payload(1, version=2), self.cache.token())
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        stats = self.cache.stats()
+        self.assertEqual((2, 5, 1, 1), (stats.hits, stats.misses, stats.expirations, stats.invalidations))
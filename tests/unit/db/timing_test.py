@@ -0,0 +1,47 @@
+import unittest
+
+from config import LoggingConfig
+from src.db.timing import (QueryStats, StatementTimer, current_query_stats, fingerprint, normalize_statement,
+                           track_queries)
+from src.utils.logging import level
+from src.utils.logging.logger import Logger
+
+
+class TestStatementFingerprint(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual("SELECT * FROM products WHERE id IN (?...) AND name = ? AND price >= ?",
+                         normalize_statement("SELECT *\n  FROM products WHERE id IN (1, 2,3) "
+                                             "AND name = 'it''s' AND price >= 10.5"))
+        self.assertEqual("SELECT anon_1.id FROM t AS anon_1 WHERE x = ? LIMIT ?",
+                         normalize_statement("SELECT anon_1.id FROM t AS anon_1 WHERE x = %(x_1)s LIMIT %s"))
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM products WHERE id IN (?, ?)"),
+                         fingerprint("SELECT * FROM products WHERE id IN (?, ?, ?, ?)"))
+        self.assertNotEqual(fingerprint("SELECT * FROM products WHERE id = ?"),
+                            fingerprint("SELECT * FROM products WHERE name = ?"))
+
+
+class TestTrackQueries(unittest.TestCase):
+
+    def test_nested_blocks_share_stats(self):
+        self.assertIsNone(current_query_stats())
+        with track_queries() as outer:
+            with track_queries() as inner:
+                inner.record("abc", 0.5, slow=True)
+            outer.record("abc", 0.25, slow=False)
+            self.assertIs(outer, current_query_stats())
+        self.assertIsNone(current_query_stats())
+        self.assertEqual((2, 0.75, 1, [("abc", 2)]), (outer.count, outer.total_s, outer.slow, outer.most_repeated()))
+        self.assertIsInstance(outer, QueryStats)
+
+    def test_timed_statement(self):
+        logger = Logger.from_config(name="TEST", cfg=LoggingConfig(log_level=level.DEBUG, log_to_file=False))
+        timer = StatementTimer(logger, slow_threshold_ms=None)
+        statement = "COPY staging (name, price) FROM STDIN"
+        with track_queries() as stats:
+            with timer.timed(statement):
+                pass
+        self.assertEqual((1, 0), (stats.count, stats.slow))
+        self.assertEqual([(fingerprint(statement), 1)], stats.most_repeated())